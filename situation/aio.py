@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+# situation (c) Ian Dennis Miller
+
+"""
+Awaitable reads for asyncio services.
+
+The models use synchronous Flask-SQLAlchemy sessions, so every read is run on a
+bounded pool of threads, each inside an application context with its own
+session, which is removed when the read finishes.  The event loop is never
+blocked, and at most ``max_workers`` reads touch the database at once.
+
+::
+
+    from situation import aio, Person
+    aio.configure(app, max_workers=8)
+
+    async def handler(person_id):
+        person = await Person.aget(person_id)
+        situation = await aio.dump()
+        async for obj in aio.iterate("events"):
+            ...
+
+Objects returned by :func:`get` are detached from their session: their columns
+can be read, but relationships cannot be loaded; use :func:`dump_object` for
+nested data.  This module requires Python 3.5 or later.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from . import db, serialize
+
+_pool = None
+_app = None
+
+
+def configure(app, max_workers=8):
+    """
+    Choose the application and the number of threads used for reads.
+
+    :param app: the Flask application whose database is read
+    :param int max_workers: the largest number of reads running at once
+    """
+    global _pool, _app
+    if _pool is not None:
+        _pool.shutdown(wait=False)
+    _app = app
+    _pool = ThreadPoolExecutor(max_workers=max_workers)
+
+
+def shutdown():
+    "Stop the threads once the reads in progress have finished."
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=True)
+        _pool = None
+
+
+def _call(function, args, kwargs):
+    with _app.app_context():
+        try:
+            return(function(*args, **kwargs))
+        finally:
+            db.session.remove()
+
+
+async def run(function, *args, **kwargs):
+    """
+    Call a function on the thread pool within the application context.
+
+    :param function: a callable reading the Situation
+    :returns: the value returned by the function
+    """
+    if _pool is None:
+        raise RuntimeError("situation.aio is not configured; call situation.aio.configure(app)")
+    loop = asyncio.get_event_loop()
+    return(await loop.run_in_executor(_pool, partial(_call, function, args, kwargs)))
+
+
+def _get(model, ident):
+    obj = model.query.get(ident)
+    if obj is not None:
+        db.session.expunge(obj)
+    return(obj)
+
+
+async def get(model, ident):
+    """
+    Look up an object by its primary key.
+
+    :param model: a model class such as :class:`situation.Person`
+    :param ident: the primary key
+    :returns: the detached object, or None
+    """
+    return(await run(_get, model, ident))
+
+
+def _dump_object(model, ident):
+    obj = model.query.get(ident)
+    return(None if obj is None else obj.dump())
+
+
+async def dump_object(model, ident):
+    """
+    Dump one object through its schema.
+
+    :param model: a model class such as :class:`situation.Person`
+    :param ident: the primary key
+    :returns: a Dict, or None when there is no such object
+    """
+    return(await run(_dump_object, model, ident))
+
+
+async def dump(batch_size=None, since=None, fields=None):
+    """
+    Build a dictionary containing the entire Situation; see :func:`situation.dump`.
+
+    :returns: a Dict
+    """
+    from . import dump as _dump
+    return(await run(_dump, batch_size=batch_size, since=since, fields=fields))
+
+
+def _page(key, batch_size, resume):
+    pages = serialize.iter_rows(db.session, db.metadata.tables, key, batch_size, resume=resume)
+    rows = next(pages, None)
+    if rows is None:
+        return(None, None)
+    ordering = serialize.section(key)[2]
+    return(serialize.serialize_page(db.session, db.metadata.tables, key, rows),
+        [rows[-1][c] for c in ordering])
+
+
+class iterate(object):
+    """
+    Iterate over the serialized objects of a collection without blocking.
+
+    Each page is read by one call on the thread pool, resuming after the last object of the
+    previous page.
+
+    :param str key: the name of the collection, e.g. "persons"
+    :param int batch_size: the number of objects read per call
+    """
+
+    def __init__(self, key, batch_size=1000):
+        serialize.section(key)
+        self.key = key
+        self.batch_size = batch_size
+        self._page = []
+        self._resume = None
+        self._done = False
+
+    def __aiter__(self):
+        return(self)
+
+    async def __anext__(self):
+        if not self._page:
+            if self._done:
+                raise StopAsyncIteration
+            page, self._resume = await run(_page, self.key, self.batch_size, self._resume)
+            if not page:
+                self._done = True
+                raise StopAsyncIteration
+            self._done = len(page) < self.batch_size
+            self._page = page[::-1]
+        return(self._page.pop())
+
+
+async def graph(kinds=None, directed=False):
+    """
+    Load the acquaintance graph; see :meth:`situation.graph.Graph.load`.
+
+    :returns: a :class:`situation.graph.Graph`, whose queries run in memory
+    """
+    from .graph import Graph, KINDS
+    return(await run(Graph.load, kinds or KINDS, directed))
+
+
+async def within(person_id, hops):
+    """
+    Find the persons within a number of hops using a recursive query; see :func:`situation.graph.within_sql`.
+
+    :returns: a Dict mapping person ids to their distance
+    """
+    from .graph import within_sql
+    return(await run(within_sql, person_id, hops))
+
+
+async def timeline(person_id=None, place_id=None, start=None, end=None):
+    """
+    Load a timeline of events; see :meth:`situation.timeline.Timeline.load`.
+
+    :returns: a :class:`situation.timeline.Timeline`, whose queries run in memory
+    """
+    from .timeline import Timeline
+    return(await run(Timeline.load, person_id, place_id, start, end))
@@ -0,0 +1,471 @@
+# -*- coding: utf-8 -*-
+# situation (c) Ian Dennis Miller
+
+"""
+Benchmarks for the model layer and the dump and save paths.
+
+A synthetic Situation of a chosen size is written straight into the database
+with bulk inserts, and then each operation is timed while counting the SQL
+statements it issues and the rows it reads and tracing its peak memory.
+Results are compared with the baselines stored in ``baselines.json`` so that a
+regression, or an operation missing from the baseline, fails the run.
+
+Wall time and memory depend on the machine, so the baselines shipped with the
+package only hold the query and row counts, which are the same everywhere;
+``--update`` records every metric for a local baseline, and ``--update
+--exact-only`` records the shipped kind.
+
+::
+
+    python -m situation.bench --scale 1k
+    python -m situation.bench --scale 100k --update
+    python -m situation.bench --scale 1k --update --exact-only
+    python -m situation.bench --imports
+
+Operations that change the Situation, such as ``create`` and ``isa``, are
+repeated on a sample of objects rather than on the whole Situation, so their
+cost reflects a database of the chosen size.
+"""
+
+import gc
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from timeit import default_timer
+from sqlalchemy import event
+
+from .. import counts, instrument, migrate, serialize, storage
+
+try:
+    import tracemalloc
+except ImportError:  # pragma: no cover
+    tracemalloc = None
+
+"The number of persons at each scale; other collections are sized from it."
+SCALES = OrderedDict([
+    ("1k", 1000),
+    ("100k", 100000),
+    ("1m", 1000000),
+])
+
+"The baselines shipped with the package."
+BASELINES = os.path.join(os.path.dirname(__file__), "baselines.json")
+
+"Metrics compared against baselines: (name, exact)."
+METRICS = (
+    ("queries", True),
+    ("rows", True),
+    ("seconds", False),
+    ("peak_mb", False),
+)
+
+"Modules whose import time is measured, lightest first."
+IMPORTS = ("situation", "situation.core", "situation.models", "situation.debug_app")
+
+"The tables written by :class:`Synthetic`, in an order that satisfies foreign keys."
+TABLES = ("resource", "excerpt", "person", "place", "item", "group", "event", "acquaintance",
+    "acquaintance_excerpts", "groups_members", "events_actors", "events_excerpts",
+    "events_items", "persons_excerpts", "places_owners", "items_owners")
+
+START = datetime(2010, 1, 1)
+
+
+class Synthetic(object):
+    """
+    A deterministic synthetic Situation.
+
+    Rows are produced lazily, table by table, so that a large Situation never has to be
+    held in memory.  The same parameters always produce the same rows.
+
+    :param int persons: the number of persons
+    :param int groups: the number of groups; each person belongs to one
+    :param int events: the number of events; each has two actors
+    :param int excerpts: the number of excerpts; every person and event quotes one
+    :param int density: the number of acquaintances of each person
+    :param int seed: the random seed
+    """
+
+    def __init__(self, persons=1000, groups=None, events=None, excerpts=None, density=5, seed=0):
+        self.persons = persons
+        self.groups = groups if groups is not None else max(1, persons // 10)
+        self.events = events if events is not None else persons
+        self.excerpts = excerpts if excerpts is not None else persons
+        self.places = max(1, persons // 10)
+        self.items = max(1, persons // 10)
+        self.resources = max(1, self.excerpts // 10)
+        self.density = min(density, persons - 1)
+        self.seed = seed
+
+    @classmethod
+    def scale(cls, name, seed=0):
+        """
+        Create the Situation for a named scale.
+
+        :param str name: one of the keys of :data:`SCALES`
+        :returns: a Synthetic
+        """
+        return(cls(persons=SCALES[name], seed=seed))
+
+    def counts(self):
+        "Report the number of objects in each collection."
+        return({
+            "acquaintances": self.persons * self.density,
+            "events": self.events,
+            "excerpts": self.excerpts,
+            "groups": self.groups,
+            "items": self.items,
+            "persons": self.persons,
+            "places": self.places,
+            "resources": self.resources,
+        })
+
+    def _random(self, name):
+        return(random.Random("%d-%s" % (self.seed, name)))
+
+    def rows(self, name):
+        """
+        Produce the rows of one table.
+
+        :param str name: one of :data:`TABLES`
+        :returns: a generator of dictionaries of column values
+        """
+        return(getattr(self, "_" + name)())
+
+    def _resource(self):
+        for i in range(1, self.resources + 1):
+            yield {"id": i, "unique": "re%d" % i, "name": "Resource %d" % i,
+                "url": "http://example.com/%d" % i, "publisher": "Publisher %d" % (i % 50),
+                "author": "Author %d" % (i % 500), "description": "A synthetic resource"}
+
+    def _excerpt(self):
+        for i in range(1, self.excerpts + 1):
+            yield {"id": i, "unique": "ex%d" % i, "content": "Excerpt %d of a resource" % i,
+                "resource_id": (i - 1) % self.resources + 1, "xpath": None}
+
+    def _named(self, prefix, label, count):
+        for i in range(1, count + 1):
+            yield {"id": i, "unique": "%s%d" % (prefix, i), "name": "%s %d" % (label, i),
+                "slug": "%s-%d" % (label.lower(), i)}
+
+    def _person(self):
+        for row in self._named("pe", "Person", self.persons):
+            row["alias"] = None
+            yield row
+
+    def _place(self):
+        rng = self._random("place")
+        for row in self._named("pl", "Place", self.places):
+            row.update({"description": None, "address": "%d Road St" % row["id"],
+                "lat": rng.uniform(-60, 60), "lon": rng.uniform(-180, 180)})
+            yield row
+
+    def _item(self):
+        for row in self._named("it", "Item", self.items):
+            row["description"] = None
+            yield row
+
+    def _group(self):
+        return(self._named("gr", "Group", self.groups))
+
+    def _event(self):
+        rng = self._random("event")
+        for row in self._named("ev", "Event", self.events):
+            row.update({"description": None, "phone": False,
+                "place_id": rng.randint(1, self.places),
+                "timestamp": START + timedelta(minutes=rng.randint(0, 5000000))})
+            yield row
+
+    def _acquaintance(self):
+        rng = self._random("acquaintance")
+        others = range(1, self.persons)
+        for person_id in range(1, self.persons + 1):
+            for offset in sorted(rng.sample(others, self.density)):
+                yield {"person_id": person_id, "isa": "friend",
+                    "acquainted_id": (person_id - 1 + offset) % self.persons + 1}
+
+    def _acquaintance_excerpts(self):
+        for index, row in enumerate(self._acquaintance()):
+            if index % 10 == 0:
+                yield {"person_id": row["person_id"], "acquainted_id": row["acquainted_id"],
+                    "excerpt_id": index // 10 % self.excerpts + 1}
+
+    def _groups_members(self):
+        for i in range(1, self.persons + 1):
+            yield {"group_id": (i - 1) % self.groups + 1, "member_id": i}
+
+    def _events_actors(self):
+        rng = self._random("actors")
+        for i in range(1, self.events + 1):
+            first = rng.randint(1, self.persons)
+            yield {"event_id": i, "actor_id": first}
+            if self.persons > 1:
+                yield {"event_id": i, "actor_id": first % self.persons + 1}
+
+    def _events_excerpts(self):
+        for i in range(1, self.events + 1):
+            yield {"event_id": i, "excerpt_id": (i - 1) % self.excerpts + 1}
+
+    def _events_items(self):
+        for i in range(1, self.events + 1, 2):
+            yield {"event_id": i, "item_id": (i - 1) // 2 % self.items + 1}
+
+    def _persons_excerpts(self):
+        for i in range(1, self.persons + 1):
+            yield {"person_id": i, "excerpt_id": (i - 1) % self.excerpts + 1}
+
+    def _places_owners(self):
+        rng = self._random("properties")
+        for i in range(1, self.places + 1):
+            yield {"place_id": i, "owner_id": rng.randint(1, self.persons)}
+
+    def _items_owners(self):
+        rng = self._random("possessions")
+        for i in range(1, self.items + 1):
+            yield {"item_id": i, "owner_id": rng.randint(1, self.persons)}
+
+    def populate(self, conn, tables, batch_size=10000):
+        """
+        Write the Situation with bulk inserts.  The caller is responsible for the transaction.
+
+        :param conn: a session or connection
+        :param dict tables: table objects by name
+        :param int batch_size: the number of rows per executemany
+        """
+        for name in TABLES:
+            serialize._insert(conn, tables[name], self.rows(name), batch_size)
+
+
+def _rows_read():
+    "Total the rows charged to every scope of :mod:`situation.instrument`."
+    return(sum(counters["rows"] for counters in instrument.stats.as_dict().values()))
+
+
+class QueryCounter(object):
+    """
+    Count the statements executed on an engine within a block.
+
+    :param engine: a SQLAlchemy engine
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _count(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self._count)
+        return(self)
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, "before_cursor_execute", self._count)
+
+
+def measure(engine, operation):
+    """
+    Run an operation once, measuring its cost.
+
+    :param engine: the engine whose statements are counted
+    :param operation: a callable taking no arguments
+    :returns: a Dict with the wall time in ``seconds``, the number of ``queries``, the number of ``rows`` read and the peak traced memory in ``peak_mb``, which is None when tracemalloc is unavailable
+    """
+    gc.collect()
+    was_enabled = instrument.enabled
+    instrument.enable(reset=False)
+    before = _rows_read()
+    if tracemalloc is not None:
+        tracemalloc.start()
+    try:
+        with QueryCounter(engine) as counter:
+            start = default_timer()
+            operation()
+            seconds = default_timer() - start
+        peak = None
+        if tracemalloc is not None:
+            peak = round(tracemalloc.get_traced_memory()[1] / 1048576.0, 2)
+    finally:
+        if tracemalloc is not None:
+            tracemalloc.stop()
+        if not was_enabled:
+            instrument.disable()
+    return({"seconds": round(seconds, 4), "queries": counter.count,
+        "rows": _rows_read() - before, "peak_mb": peak})
+
+
+def run(scale="1k", sample=1000, directory=None, seed=0, indexes=True, bulk=False):
+    """
+    Benchmark every operation against a synthetic Situation.
+
+    Must be called within an application context whose database is empty.
+
+    :param str scale: one of the keys of :data:`SCALES`
+    :param int sample: the number of objects used by per-object operations
+    :param str directory: where saved files are written; a temporary directory by default
+    :param int seed: the random seed of the synthetic Situation
+    :param bool indexes: keep the indexes of the association tables; without them, joins scan
+    :param bool bulk: populate in :func:`situation.storage.bulk` mode
+    :returns: an OrderedDict mapping operation names to measurements
+    """
+    from .. import db, dump, save, Acquaintance, Event, Excerpt, Group, Item, Person, Place
+    from .. import Resource
+    engine = db.engine
+    tables = db.metadata.tables
+    if directory is None:
+        directory = tempfile.mkdtemp()
+    synthetic = Synthetic.scale(scale, seed=seed)
+    sample = min(sample, synthetic.persons)
+    results = OrderedDict()
+
+    def populate():
+        with counts.suppressed():
+            synthetic.populate(db.session, tables)
+        counts.refresh(db.session, tables)
+        db.session.commit()
+
+    if bulk:
+        db.session.commit()
+        with storage.bulk(engine):
+            results["populate"] = measure(engine, populate)
+    else:
+        results["populate"] = measure(engine, populate)
+    if not indexes:
+        migrate.drop_link_indexes(db.session.connection(), tables)
+        db.session.commit()
+    results["dump"] = measure(engine, dump)
+    results["save"] = measure(engine, lambda: save(os.path.join(directory, "situation.json")))
+    results["save.stream"] = measure(engine,
+        lambda: save(os.path.join(directory, "stream.json"), stream=True))
+    for model in (Acquaintance, Event, Excerpt, Group, Item, Person, Place, Resource):
+        objs = model.query.limit(sample).all()
+        results["%s.dump" % model.__name__] = measure(engine,
+            lambda: [obj.dump() for obj in objs])
+        db.session.expire_all()
+
+    groups = Group.query.limit(sample).all()
+    persons = Person.query.limit(sample).all()
+    events = Event.query.limit(sample).all()
+    results["join.members"] = measure(engine, lambda: [g.members.all() for g in groups])
+    results["join.groups"] = measure(engine, lambda: [list(p.groups) for p in persons])
+    results["join.actors"] = measure(engine, lambda: [e.actors.all() for e in events])
+    results["join.events"] = measure(engine, lambda: [list(p.events) for p in persons])
+    db.session.expire_all()
+
+    created = []
+    results["create"] = measure(engine, lambda: created.extend(
+        Person.create(name="Created %d" % i) for i in range(sample)))
+    results["isa"] = measure(engine, lambda: [person.isa("colleague", of=other)
+        for person, other in zip(created, created[1:] + created[:1])])
+    group = Group.create(name="Benchmark Group")
+    results["members.extend"] = measure(engine, lambda: (group.members.extend(created),
+        db.session.commit()))
+    return(results)
+
+
+def load_baselines(filename=BASELINES):
+    """
+    Read stored baselines.
+
+    :param str filename: a JSON file written by :func:`save_baselines`
+    :returns: a Dict mapping scales to results
+    """
+    if not os.path.exists(filename):
+        return({})
+    with open(filename) as f:
+        return(json.load(f))
+
+
+def save_baselines(baselines, filename=BASELINES):
+    "Write baselines as JSON."
+    with open(filename, "w") as f:
+        json.dump(baselines, f, indent=True, sort_keys=True)
+
+
+def import_times(modules=IMPORTS, repeat=5):
+    """
+    Measure how long importing each module takes in a fresh interpreter.
+
+    :param modules: the names of the modules
+    :param int repeat: the number of interpreters started per module; the fastest is kept
+    :returns: an OrderedDict mapping "import <module>" to measurements, like :func:`run`
+    """
+    results = OrderedDict()
+    code = ("from timeit import default_timer; start = default_timer(); "
+        "import %s; print(default_timer() - start)")
+    for module in modules:
+        seconds = min(float(subprocess.check_output([sys.executable, "-c", code % module],
+            universal_newlines=True)) for _ in range(repeat))
+        results["import %s" % module] = {"seconds": seconds, "queries": 0, "rows": 0,
+            "peak_mb": None}
+    return(results)
+
+
+def exact(results):
+    """
+    Keep only the metrics that do not depend on the machine.
+
+    :param dict results: measurements from :func:`run`
+    :returns: an OrderedDict of the same operations with their query and row counts
+    """
+    names = [metric for metric, is_exact in METRICS if is_exact]
+    return(OrderedDict((name, dict((metric, measured.get(metric)) for metric in names))
+        for name, measured in results.items()))
+
+
+def compare(results, baseline, tolerance=0.5):
+    """
+    Find the measurements that regressed.
+
+    Query and row counts are deterministic and may not grow at all; wall time and peak
+    memory may exceed their baseline by the tolerance.  An operation with no baseline
+    counts as a regression, so that new operations are recorded before they are relied on.
+
+    :param dict results: measurements from :func:`run`
+    :param dict baseline: stored measurements for the same scale
+    :param float tolerance: the allowed relative growth of time and memory
+    :returns: a list of messages, empty when nothing regressed
+    """
+    regressions = []
+    for name, measured in results.items():
+        expected = baseline.get(name)
+        if expected is None:
+            regressions.append("%s: no baseline" % name)
+            continue
+        for metric, exact in METRICS:
+            value, limit = measured.get(metric), expected.get(metric)
+            if value is None or limit is None:
+                continue
+            if not exact:
+                limit = limit * (1 + tolerance)
+            if value > limit:
+                regressions.append("%s: %s is %s, baseline %s" % (
+                    name, metric, value, expected[metric]))
+    return(regressions)
+
+
+def report(results, baseline=None):
+    """
+    Format measurements as a table.
+
+    :param dict results: measurements from :func:`run`
+    :param dict baseline: earlier measurements; when given, a column shows the speedup over them
+    :returns: a string
+    """
+    lines = ["%-20s %10s %8s %8s %10s" % ("operation", "seconds", "queries", "rows", "peak MB")]
+    if baseline is not None:
+        lines[0] += " %8s" % "speedup"
+    for name, measured in results.items():
+        line = "%-20s %10.4f %8d %8s %10s" % (name, measured["seconds"], measured["queries"],
+            "-" if measured.get("rows") is None else measured["rows"],
+            "-" if measured["peak_mb"] is None else "%.2f" % measured["peak_mb"])
+        if baseline is not None:
+            before = baseline.get(name, {}).get("seconds")
+            line += " %8s" % ("-" if not before or not measured["seconds"] else
+                "%.2fx" % (before / measured["seconds"]))
+        lines.append(line)
+    return("\n".join(lines))
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# situation (c) Ian Dennis Miller
+
+"""
+Run the benchmarks against a fresh SQLite database and compare them with the baselines.
+
+Exits with status 1 when a measurement regressed or has no baseline.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+
+from . import SCALES, BASELINES, compare, exact, import_times, load_baselines, report, run
+from . import save_baselines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m situation.bench",
+        description="Benchmark the Situation model layer.")
+    parser.add_argument("--scale", choices=list(SCALES), default="1k")
+    parser.add_argument("--sample", type=int, default=1000,
+        help="objects used by per-object operations")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+        help="allowed relative growth of time and memory")
+    parser.add_argument("--baselines", default=BASELINES)
+    parser.add_argument("--without-indexes", action="store_true",
+        help="drop the association table indexes to measure joins without them")
+    parser.add_argument("--profile", default=None,
+        help="storage profile of the database, e.g. fast; baselines are kept per profile")
+    parser.add_argument("--bulk", action="store_true",
+        help="populate the database in bulk-load mode")
+    parser.add_argument("--imports", action="store_true",
+        help="measure the import time of the package instead of the model layer")
+    parser.add_argument("--update", action="store_true",
+        help="store the results as the new baseline for this scale")
+    parser.add_argument("--exact-only", action="store_true",
+        help="with --update, store only the query and row counts, as in the shipped baselines")
+    args = parser.parse_args(argv)
+
+    if args.imports:
+        return(check("imports", import_times(), args, required=False))
+
+    directory = tempfile.mkdtemp()
+    settings = os.path.join(directory, "bench.conf")
+    with open(settings, "w") as f:
+        f.write("LOG = %r\nSQLALCHEMY_DATABASE_URI = %r\n" % (os.path.join(directory, "bench.log"),
+            "sqlite:///%s" % os.path.join(directory, "bench.db")))
+    os.environ["SETTINGS"] = settings
+    from ..debug_app import create_app, reset_db
+    with create_app(profile=args.profile).app_context():
+        reset_db()
+        results = run(args.scale, sample=args.sample, directory=directory,
+            indexes=not args.without_indexes, bulk=args.bulk)
+    if args.without_indexes:
+        print(report(results))
+        return(0)
+    name = args.scale if args.profile is None else "%s-%s" % (args.scale, args.profile)
+    return(check(name, results, args, reference=args.scale if args.profile else None))
+
+
+def check(name, results, args, reference=None, required=True):
+    """
+    Print results and compare them with their baseline, or store them as the new baseline.
+
+    :param str name: the name of the baseline
+    :param dict results: the measurements
+    :param args: the parsed command line
+    :param str reference: another baseline whose speedup is shown when ``name`` has none
+    :param bool required: fail when there is no baseline named ``name``
+    :returns: the exit status
+    """
+    baselines = load_baselines(args.baselines)
+    if args.update or name in baselines or reference not in baselines:
+        print(report(results))
+    else:
+        print(report(results, baselines[reference]))
+    if args.update:
+        baselines[name] = exact(results) if args.exact_only else results
+        save_baselines(baselines, args.baselines)
+        print("baseline for %s written to %s" % (name, args.baselines))
+        return(0)
+    if name not in baselines:
+        print("no baseline for %s; run with --update to record one" % name)
+        return(1 if required else 0)
+    regressions = compare(results, baselines[name], args.tolerance)
+    for message in regressions:
+        print("REGRESSION %s" % message)
+    return(1 if regressions else 0)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+# situation (c) Ian Dennis Miller
+
+"""
+A read-through cache for ``Model.dump()``.
+
+Dumps are kept in a least-recently-used map keyed by table and primary key;
+each entry holds the full dump and any projections of it requested through
+``Model.dump(only=..., exclude=...)``.
+While the cache is enabled, every write that could change a cached dump evicts
+it: mapper events catch changes to objects, and engine events catch inserts
+and deletes in the association tables that feed nested id lists.  A rollback
+empties the cache.  Writes made by other processes are not seen.
+
+Objects with unflushed changes, or whose session has any, are always dumped
+afresh.  Once a transaction has written, the dumps it builds are kept apart
+for its thread, whose scoped session it is, and only shared with other
+threads when it commits; a rollback discards them.
+
+::
+
+    from situation.cache import dump_cache
+    dump_cache.enable(maxsize=50000)
+    Person.get(1).dump()
+    print(dump_cache.stats())
+
+Cached dumps are shared between callers and must not be modified.
+"""
+
+import threading
+from collections import OrderedDict
+from sqlalchemy import event, inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.expression import Delete, Insert, Update
+
+from . import serialize
+
+
+def statement_rows(multiparams, params):
+    """
+    Recover the parameter dictionaries of an executed statement.
+
+    :returns: a list of dictionaries, empty when the values are not known
+    """
+    if multiparams:
+        first = multiparams[0]
+        if isinstance(first, (list, tuple)) and first and isinstance(first[0], dict):
+            return(list(first))
+        if isinstance(first, dict):
+            return([p for p in multiparams if isinstance(p, dict)])
+    if params:
+        return([params])
+    return([])
+
+
+class DumpCache(object):
+    """
+    A size-limited, least-recently-used map of dumps.
+
+    :param int maxsize: the largest number of dumps kept
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.enabled = False
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._pending = threading.local()
+
+    def __len__(self):
+        return(len(self._entries))
+
+    def get(self, key, projection=None):
+        "Return a cached dump, or None."
+        with self._lock:
+            value = self._entries.get(key, {}).get(projection)
+            if value is None:
+                self.misses += 1
+                return(None)
+            self.hits += 1
+            self._entries[key] = self._entries.pop(key)
+            return(value)
+
+    def put(self, key, value, generation, projection=None):
+        """
+        Store a dump unless something was invalidated while it was being built.
+
+        :param tuple key: the table name and primary key
+        :param dict value: the dump
+        :param int generation: the value of :attr:`generation` before the dump was built
+        :param projection: the fields the dump is limited to, or None for a full dump
+        """
+        with self._lock:
+            if generation != self.generation:
+                return
+            dumps = self._entries.pop(key, {})
+            dumps[projection] = value
+            self._entries[key] = dumps
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _bump(self):
+        "Advance the generation, counting the advances made by this thread."
+        self.generation += 1
+        self._pending.bumps = getattr(self._pending, "bumps", 0) + 1
+
+    def invalidate(self, key):
+        """
+        Forget the dump of one object.
+
+        The key is forgotten again when the transaction commits, in case another thread
+        cached the old state in between.
+        """
+        with self._lock:
+            self._bump()
+            self.invalidations += 1
+            self._entries.pop(key, None)
+        if self.enabled:
+            pending = self._pending.__dict__
+            pending.setdefault("keys", set()).add(key)
+            pending["written"] = True
+            for entry in [e for e in pending.get("local", {}) if e[0] == key]:
+                del pending["local"][entry]
+
+    def clear(self):
+        "Forget every dump."
+        with self._lock:
+            self._bump()
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Report the cache counters.
+
+        :returns: a Dict of hits, misses, evictions, invalidations and size
+        """
+        return({
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "size": len(self._entries),
+        })
+
+    def dump(self, obj, build, projection=None):
+        """
+        Return the dump of an object, building and storing it on a miss.
+
+        :param obj: a persistent model object
+        :param build: a callable producing the dump
+        :param projection: a hashable description of the fields the dump is limited to, or None
+        """
+        if not self.enabled:
+            return(build())
+        state = inspect(obj)
+        if state.identity is None or state.modified:
+            return(build())
+        session = state.session
+        if session is not None and (session.new or session.dirty or session.deleted):
+            return(build())
+        key = (obj.__table__.name, tuple(state.identity))
+        pending = self._pending.__dict__
+        if pending.get("written"):
+            local = pending.setdefault("local", {})
+            entry = local.get((key, projection))
+            if entry is None:
+                with self._lock:
+                    built = (self.generation, pending.get("bumps", 0))
+                entry = local[(key, projection)] = (build(),) + built
+            return(entry[0])
+        value = self.get(key, projection)
+        if value is None:
+            generation = self.generation
+            value = build()
+            self.put(key, value, generation, projection)
+        return(value)
+
+    def _invalidate_links(self, table, row):
+        "Evict the owners whose nested id lists include a row of a table."
+        for owner, _, name, owner_columns, _ in serialize.LINKS:
+            if name != table:
+                continue
+            if not all(c in row for c in owner_columns):
+                self.clear()
+                return
+            self.invalidate((serialize.section(owner)[1], tuple(row[c] for c in owner_columns)))
+
+    def _model_listeners(self, model):
+        "Create the mapper listeners evicting a model's dumps."
+        table = model.__table__.name
+        columns = set(c for _, _, name, owner_columns, _ in serialize.LINKS
+            if name == table for c in owner_columns)
+
+        def changed(mapper, connection, target):
+            self.invalidate((table, tuple(mapper.primary_key_from_instance(target))))
+            state = inspect(target)
+            current = dict((c, getattr(target, c)) for c in columns)
+            self._invalidate_links(table, current)
+            previous = dict(current)
+            for c in columns:
+                deleted = state.attrs[c].history.deleted
+                if deleted:
+                    previous[c] = deleted[0]
+            if previous != current:
+                self._invalidate_links(table, previous)
+
+        return([(model, name, changed) for name in ("after_insert", "after_update", "after_delete")])
+
+    def _after_execute(self, conn, clauseelement, multiparams, params, *args):
+        "Evict dumps fed by association rows written outside the mapper."
+        if not isinstance(clauseelement, (Insert, Update, Delete)):
+            return
+        name = clauseelement.table.name
+        if name not in self._association_tables:
+            return
+        rows = statement_rows(multiparams, params)
+        if not rows:
+            self.clear()
+        for row in rows:
+            self._invalidate_links(name, row)
+
+    def _after_flush(self, session, flush_context):
+        self._pending.written = True
+
+    def _after_commit(self, session):
+        pending = self._pending.__dict__
+        keys = pending.pop("keys", ())
+        local = pending.pop("local", {})
+        pending.pop("written", None)
+        with self._lock:
+            if keys:
+                self._bump()
+            for key in keys:
+                self._entries.pop(key, None)
+            bumps = pending.get("bumps", 0)
+            for (key, projection), (value, generation, built_bumps) in local.items():
+                # publish only when no other thread invalidated anything since the build
+                if self.generation - generation == bumps - built_bumps:
+                    dumps = self._entries.pop(key, {})
+                    dumps[projection] = value
+                    self._entries[key] = dumps
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _after_rollback(self, session, previous_transaction):
+        for name in ("keys", "local", "written"):
+            self._pending.__dict__.pop(name, None)
+        self.clear()
+
+    def enable(self, maxsize=None):
+        """
+        Start caching dumps.
+
+        :param int maxsize: the largest number of dumps kept; unchanged if None
+        """
+        from . import Acquaintance, Event, Excerpt, Group, Item, Person, Place, Resource
+        if maxsize is not None:
+            self.maxsize = maxsize
+        if self.enabled:
+            return
+        entities = set(entry[1] for entry in serialize.SECTIONS)
+        self._association_tables = set(entry[2] for entry in serialize.LINKS) - entities
+        self._listeners = [(Engine, "after_execute", self._after_execute),
+            (Session, "after_flush", self._after_flush),
+            (Session, "after_commit", self._after_commit),
+            (Session, "after_soft_rollback", self._after_rollback)]
+        for model in (Acquaintance, Event, Excerpt, Group, Item, Person, Place, Resource):
+            self._listeners.extend(self._model_listeners(model))
+        for target, name, listener in self._listeners:
+            event.listen(target, name, listener)
+        self.clear()
+        self.enabled = True
+
+    def disable(self):
+        "Stop caching dumps and forget every cached dump."
+        while self._listeners:
+            event.remove(*self._listeners.pop())
+        self.enabled = False
+        self.clear()
+
+
+"The cache used by ``Model.dump()``."
+dump_cache = DumpCache()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+# situation (c) Ian Dennis Miller
+
+"""
+Generation of the ``unique`` codes carried by every model.
+
+A :class:`CodeGenerator` draws codes in batches from ``os.urandom`` and remembers
+every code it has issued, or has been told about, so that it never hands out a
+duplicate.  In monotonic mode each code starts with the current time, which keeps
+inserts into the ``unique`` index close to its right-hand edge; codes with an
+earlier time can no longer be drawn, so only those of the current millisecond
+are remembered.
+"""
+
+import os
+import string
+import time
+
+ALPHABET = string.digits + string.ascii_uppercase + string.ascii_lowercase
+
+
+def _base62(number, size):
+    "Encode a non-negative integer as a fixed-width base 62 string."
+    digits = []
+    for _ in range(size):
+        number, remainder = divmod(number, 62)
+        digits.append(ALPHABET[remainder])
+    return ''.join(reversed(digits))
+
+
+def random_codes(count, size=8):
+    """
+    Create random alpha-numeric codes in bulk.
+
+    Random bytes are read in large buffers and mapped onto the 62 letters and digits,
+    discarding the bytes that would bias the distribution.
+
+    :param int count: the number of codes to create
+    :param int size: the length of each code
+    :returns: a list of strings
+    """
+    needed = count * size
+    chars = []
+    while len(chars) < needed:
+        buf = bytearray(os.urandom(needed - len(chars) + 64))
+        chars.extend(ALPHABET[b % 62] for b in buf if b < 248)
+    chars = ''.join(chars[:needed])
+    return [chars[i:i + size] for i in range(0, needed, size)]
+
+
+class CodeGenerator(object):
+    """
+    Issue collision-free ``unique`` codes.
+
+    Calling the generator returns one code; codes are created in batches behind the
+    scenes.  Every issued code is remembered, and codes already stored in the database
+    can be registered with :meth:`reserve` or :meth:`load_existing`.  Nothing is read
+    from the database implicitly.  Only codes of the generator's length can collide, so
+    codes of other lengths are not remembered.
+
+    :param int size: the length of each code
+    :param bool monotonic: prefix each code with the time in milliseconds, so that codes sort by creation time
+    :param int batch_size: the number of codes created at once
+    """
+
+    def __init__(self, size=8, monotonic=False, batch_size=1024):
+        if monotonic and size < 10:
+            raise ValueError("monotonic codes need at least 10 characters")
+        self.size = size
+        self.monotonic = monotonic
+        self.batch_size = batch_size
+        self.seen = set()
+        self._buffer = []
+        self._prefix = ""
+
+    def reserve(self, codes):
+        """
+        Register codes that must not be issued.
+
+        :param codes: an iterable of strings
+        """
+        self.seen.update(code for code in codes
+            if len(code) == self.size and code[:7] >= self._prefix)
+
+    def _advance(self):
+        "Move to the current millisecond, forgetting the codes of earlier ones."
+        prefix = max(_base62(int(time.time() * 1000), 7), self._prefix)
+        if prefix != self._prefix:
+            self._prefix = prefix
+            self.seen = set(code for code in self.seen if code[:7] >= prefix)
+        return(prefix)
+
+    def load_existing(self):
+        """
+        Register every ``unique`` code currently stored in the database.
+
+        This reads every ``unique`` column, so call it once, outside a flush, and only when
+        codes written by other processes must be excluded exactly, such as with short codes.
+        At the default length a random collision is vanishingly unlikely, and the unique
+        index rejects one anyway.
+        """
+        from . import db
+        for table in db.metadata.sorted_tables:
+            if "unique" in table.c:
+                column = table.c["unique"]
+                self.reserve(row[0] for row in db.session.execute(
+                    db.select([column]).where(column.isnot(None))))
+
+    def batch(self, count):
+        """
+        Issue many codes at once.
+
+        :param int count: the number of codes to issue
+        :returns: a list of distinct strings that have not been issued before
+        """
+        result = []
+        while len(result) < count:
+            if self.monotonic:
+                prefix = self._advance()
+                candidates = [prefix + c for c in random_codes(count - len(result), self.size - 7)]
+            else:
+                candidates = random_codes(count - len(result), self.size)
+            for code in candidates:
+                if code not in self.seen:
+                    self.seen.add(code)
+                    result.append(code)
+        return result
+
+    def __call__(self):
+        if self.monotonic:
+            return self.batch(1)[0]
+        if not self._buffer:
+            self._buffer = self.batch(self.batch_size)
+        return self._buffer.pop()
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+# situation (c) Ian Dennis Miller
+
+"""
+Column-oriented export of a Situation for analytics.
+
+Each entity table and each association table is written as its own file, or
+directory of files, inside an output directory, together with a
+``manifest.json`` describing the tables, their columns and row counts.  Rows are
+fetched in batches, so memory use does not grow with the Situation.
+
+Three formats are available:
+
+- ``"arrow"``: one Arrow IPC file per table (requires pyarrow)
+- ``"parquet"``: one Parquet file per table (requires pyarrow)
+- ``"npy"``: one directory per table holding a ``.npy`` array and a ``.mask.npy``
+  null mask per column; string columns are stored as a ``.bytes`` file of UTF-8
+  text with a ``.offsets.npy`` array, and timestamps as seconds since the epoch
+  (requires numpy)
+
+:func:`read` opens any of these with memory mapping.
+"""
+
+import json
+import os
+from datetime import datetime
+from sqlalchemy import Boolean, DateTime, Float, Integer, func, select
+
+from . import serialize
+
+FORMATS = ("arrow", "parquet", "npy")
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def layout():
+    """
+    List the tables and columns that are exported.
+
+    :returns: a list of (table name, column names) pairs
+    """
+    result = []
+    seen = set()
+    for key, name, _, _ in serialize.SECTIONS:
+        result.append((name, serialize.column_names(key)))
+        seen.add(name)
+    for _, _, name, owner_columns, target in serialize.LINKS:
+        if name not in seen:
+            result.append((name, list(owner_columns) + [target]))
+            seen.add(name)
+    return(result)
+
+
+def _kind(column):
+    "Classify a column by the array type it is stored as."
+    if isinstance(column.type, Boolean):
+        return("bool")
+    if isinstance(column.type, Integer):
+        return("int")
+    if isinstance(column.type, Float):
+        return("float")
+    if isinstance(column.type, DateTime):
+        return("datetime")
+    return("string")
+
+
+def _batches(conn, table, names, batch_size):
+    "Fetch a table in primary key order, a batch of rows at a time."
+    query = select([table.c[n] for n in names]).order_by(*table.primary_key.columns)
+    result = conn.execute(query)
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            return
+        if serialize.row_hooks:
+            rows = [dict(zip(names, row)) for row in rows]
+            serialize.apply_row_hooks(conn, {table.name: table}, table.name, rows)
+            rows = [[row[n] for n in names] for row in rows]
+        yield [tuple(row) for row in rows]
+
+
+def _write_arrow(conn, table, names, path, fmt, batch_size):
+    import pyarrow as pa
+    types = {"bool": pa.bool_(), "int": pa.int64(), "float": pa.float64(),
+        "datetime": pa.timestamp("s"), "string": pa.string()}
+    schema = pa.schema([(n, types[_kind(table.c[n])]) for n in names])
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(path + ".parquet", schema)
+        write = lambda batch: writer.write_table(pa.Table.from_batches([batch]))
+    else:
+        sink = pa.OSFile(path + ".arrow", "wb")
+        writer = pa.ipc.new_file(sink, schema)
+        write = writer.write_batch
+    count = 0
+    try:
+        for rows in _batches(conn, table, names, batch_size):
+            columns = list(zip(*rows))
+            write(pa.RecordBatch.from_arrays(
+                [pa.array(list(values), type=field.type) for values, field in zip(columns, schema)],
+                schema=schema))
+            count += len(rows)
+    finally:
+        writer.close()
+        if fmt != "parquet":
+            sink.close()
+    return(count)
+
+
+def _write_npy(conn, table, names, path, batch_size):
+    import numpy as np
+    from numpy.lib.format import open_memmap
+    dtypes = {"bool": np.bool_, "int": np.int64, "float": np.float64, "datetime": np.int64}
+    count = conn.execute(select([func.count()]).select_from(table)).scalar()
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    kinds = dict((n, _kind(table.c[n])) for n in names)
+    arrays, masks, blobs = {}, {}, {}
+    for n in names:
+        base = os.path.join(path, n)
+        masks[n] = open_memmap(base + ".mask.npy", mode="w+", dtype=np.bool_, shape=(count,))
+        if kinds[n] == "string":
+            arrays[n] = open_memmap(base + ".offsets.npy", mode="w+", dtype=np.int64,
+                shape=(count + 1,))
+            arrays[n][0] = 0
+            blobs[n] = open(base + ".bytes", "wb")
+        else:
+            arrays[n] = open_memmap(base + ".npy", mode="w+", dtype=dtypes[kinds[n]],
+                shape=(count,))
+    start = 0
+    try:
+        for rows in _batches(conn, table, names, batch_size):
+            rows = rows[:count - start]
+            if not rows:
+                break
+            end = start + len(rows)
+            for index, n in enumerate(names):
+                values = [row[index] for row in rows]
+                masks[n][start:end] = [v is None for v in values]
+                if kinds[n] == "string":
+                    encoded = [(v or u"").encode("utf-8") for v in values]
+                    sizes = np.cumsum([len(e) for e in encoded], dtype=np.int64)
+                    arrays[n][start + 1:end + 1] = arrays[n][start] + sizes
+                    blobs[n].write(b"".join(encoded))
+                elif kinds[n] == "datetime":
+                    arrays[n][start:end] = [0 if v is None else int((v - EPOCH).total_seconds())
+                        for v in values]
+                else:
+                    arrays[n][start:end] = [0 if v is None else v for v in values]
+            start = end
+    finally:
+        for blob in blobs.values():
+            blob.close()
+        for array in list(arrays.values()) + list(masks.values()):
+            array.flush()
+    return(start)
+
+
+def write(conn, tables, directory, fmt, batch_size=10000):
+    """
+    Write every table of a Situation in a columnar format.
+
+    :param conn: a session or connection
+    :param dict tables: table objects by name
+    :param str directory: the output directory, created if needed
+    :param str fmt: one of :data:`FORMATS`
+    :param int batch_size: the number of rows fetched per query
+    :returns: the manifest, a Dict describing the files written
+    """
+    if fmt not in FORMATS:
+        raise ValueError("unknown format %r; expected one of %s" % (fmt, ", ".join(FORMATS)))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    manifest = {"format": fmt, "tables": {}}
+    for name, names in layout():
+        table = tables[name]
+        path = os.path.join(directory, name)
+        if fmt == "npy":
+            count = _write_npy(conn, table, names, path, batch_size)
+        else:
+            count = _write_arrow(conn, table, names, path, fmt, batch_size)
+        manifest["tables"][name] = {
+            "rows": count,
+            "columns": [[n, _kind(table.c[n])] for n in names],
+        }
+    with open(os.path.join(directory, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=True, sort_keys=True)
+    return(manifest)
+
+
+class StringColumn(object):
+    """
+    A memory-mapped column of strings written in the ``"npy"`` format.
+
+    :param offsets: an array of n + 1 byte offsets
+    :param data: a uint8 array of UTF-8 text
+    :param mask: a boolean array marking nulls
+    """
+
+    def __init__(self, offsets, data, mask):
+        self.offsets = offsets
+        self.data = data
+        self.mask = mask
+
+    def __len__(self):
+        return(len(self.mask))
+
+    def __getitem__(self, index):
+        if self.mask[index]:
+            return(None)
+        return(self.data[self.offsets[index]:self.offsets[index + 1]].tobytes().decode("utf-8"))
+
+
+def read(directory):
+    """
+    Open a Situation written by :func:`write`.
+
+    Columns are memory-mapped, so only the parts that are used are read from disk.
+
+    :param str directory: the directory holding the manifest
+    :returns: a Dict mapping table names to Dicts of column names to arrays; pyarrow tables for the Arrow and Parquet formats
+    """
+    with open(os.path.join(directory, "manifest.json")) as f:
+        manifest = json.load(f)
+    fmt = manifest["format"]
+    result = {}
+    for name, info in manifest["tables"].items():
+        path = os.path.join(directory, name)
+        if fmt == "arrow":
+            import pyarrow as pa
+            result[name] = pa.ipc.open_file(pa.memory_map(path + ".arrow")).read_all()
+        elif fmt == "parquet":
+            import pyarrow.parquet as pq
+            result[name] = pq.read_table(path + ".parquet", memory_map=True)
+        else:
+            import numpy as np
+            columns = {}
+            for column, kind in info["columns"]:
+                base = os.path.join(path, column)
+                mask = np.load(base + ".mask.npy", mmap_mode="r")
+                if kind == "string":
+                    data = np.memmap(base + ".bytes", dtype=np.uint8, mode="r") \
+                        if os.path.getsize(base + ".bytes") else np.zeros(0, dtype=np.uint8)
+                    columns[column] = StringColumn(
+                        np.load(base + ".offsets.npy", mmap_mode="r"), data, mask)
+                else:
+                    columns[column] = np.ma.MaskedArray(
+                        np.load(base + ".npy", mmap_mode="r"), mask=mask)
+            result[name] = columns
+    return(result)
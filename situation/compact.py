@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+# situation (c) Ian Dennis Miller
+
+"""
+A compact, read-only snapshot of a whole Situation.
+
+Each collection is stored column by column in typed arrays, ordered like
+:func:`situation.dump`.  Strings such as names and slugs are interned in one
+table shared by every collection, and every nested id list is a pair of
+compressed sparse row (CSR) arrays, so an object costs a few machine words
+instead of a dictionary of dictionaries.
+
+::
+
+    snap = situation.snapshot()
+    rob = snap["persons"].get(1)
+    print(rob.name, rob.groups)
+    snap.save("situation.snap")
+    snap = Snapshot.open("situation.snap")
+
+Lookups by id take constant time when ids are dense and a binary search
+otherwise; lookups by ``unique`` code build a dictionary on first use.
+:meth:`Snapshot.open` memory-maps a saved snapshot, so opening it takes
+constant time and pages are read only when used.  Snapshots can also be pickled.
+"""
+
+import json
+import mmap
+import struct
+import sys
+from array import array
+from datetime import datetime, timedelta
+from sqlalchemy import select
+
+from . import serialize
+from .columnar import _kind
+from .graph import _csr
+
+MAGIC = b"SITSNAP1"
+
+EPOCH = datetime(1970, 1, 1)
+
+"The value stored for a missing integer."
+NULL = -sys.maxsize - 1
+
+"The array type code used for each kind of column."
+TYPECODES = {"bool": "b", "int": "l", "float": "d", "datetime": "d", "string": "l"}
+
+
+def _view(buffer, typecode, offset, count):
+    "Map part of a buffer as an array of a type, without copying where possible."
+    size = array(typecode).itemsize
+    data = memoryview(buffer)[offset:offset + size * count]
+    try:
+        return(data.cast(typecode))
+    except AttributeError:  # pragma: no cover
+        return(array(typecode, data.tobytes()))
+
+
+def _tobytes(values):
+    "Copy the contents of an array or view."
+    if hasattr(values, "tobytes"):
+        return(values.tobytes())
+    return(values.tostring())  # pragma: no cover
+
+
+def _copy(values):
+    "Turn a mapped view back into an array, as pickle requires."
+    if isinstance(values, array):
+        return(values)
+    return(array(values.format, _tobytes(values)))
+
+
+class StringTable(object):
+    """
+    Distinct strings stored once, as UTF-8 text and offsets.
+
+    :param offsets: n + 1 byte offsets
+    :param data: the concatenated text
+    """
+
+    __slots__ = ("offsets", "data")
+
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self):
+        return(len(self.offsets) - 1)
+
+    def __getitem__(self, index):
+        return(_tobytes(self.data[self.offsets[index]:self.offsets[index + 1]]).decode("utf-8"))
+
+    def __getstate__(self):
+        return(_copy(self.offsets), _copy(self.data))
+
+    def __setstate__(self, state):
+        self.offsets, self.data = state
+
+
+class _StringBuilder(object):
+    "Interns strings while a snapshot is built."
+
+    def __init__(self):
+        self.index = {}
+        self.offsets = array('l', [0])
+        self.data = array('B')
+
+    def add(self, value):
+        if value is None:
+            return(-1)
+        found = self.index.get(value)
+        if found is None:
+            found = self.index[value] = len(self.offsets) - 1
+            encoded = value.encode("utf-8")
+            self.data.extend(bytearray(encoded))
+            self.offsets.append(self.offsets[-1] + len(encoded))
+        return(found)
+
+    def table(self):
+        return(StringTable(self.offsets, self.data))
+
+
+def _encode(kind, value, strings):
+    if kind == "string":
+        return(strings.add(value))
+    if value is None:
+        return({"bool": -1, "int": NULL}.get(kind, float("nan")))
+    if kind == "datetime":
+        return((value - EPOCH).total_seconds())
+    return(value)
+
+
+def _decode(kind, value, strings):
+    if kind == "string":
+        return(None if value < 0 else strings[value])
+    if kind == "int":
+        return(None if value == NULL else value)
+    if kind == "bool":
+        return(None if value < 0 else bool(value))
+    if value != value:
+        return(None)
+    if kind == "datetime":
+        return(EPOCH + timedelta(seconds=value))
+    return(value)
+
+
+class Record(object):
+    """
+    A read-only view of one object in a snapshot.
+
+    Columns and nested id lists are read as attributes, e.g. ``person.name`` or ``person.groups``.
+    """
+
+    __slots__ = ("collection", "position")
+
+    def __init__(self, collection, position):
+        self.collection = collection
+        self.position = position
+
+    def __getattr__(self, name):
+        collection = self.collection
+        if name in collection.columns:
+            return(collection.value(self.position, name))
+        if name in collection.links:
+            return(collection.linked(self.position, name))
+        raise AttributeError(name)
+
+    def __eq__(self, other):
+        return(isinstance(other, Record) and other.collection is self.collection and
+            other.position == self.position)
+
+    def __ne__(self, other):
+        return(not self == other)
+
+    def __hash__(self):
+        return(hash((id(self.collection), self.position)))
+
+    def as_dict(self):
+        """
+        Copy the object.
+
+        :returns: a Dict of column values and lists of linked ids
+        """
+        result = dict((name, self.collection.value(self.position, name))
+            for name in self.collection.columns)
+        for field in self.collection.links:
+            result[field] = self.collection.linked(self.position, field)
+        return(result)
+
+
+class Collection(object):
+    """
+    The objects of one collection, stored column by column.
+
+    :param str key: the name of the collection, e.g. "persons"
+    :param tuple keys: the ordering columns, which identify an object
+    :param dict kinds: the kind of each column: "bool", "int", "float", "datetime" or "string"
+    :param dict columns: an array of values for each column
+    :param dict links: a CSR (offsets, ids) pair of arrays for each nested id list
+    :param StringTable strings: the strings referred to by string columns
+    """
+
+    __slots__ = ("key", "keys", "kinds", "columns", "links", "strings", "_unique")
+
+    def __init__(self, key, keys, kinds, columns, links, strings):
+        self.key = key
+        self.keys = tuple(keys)
+        self.kinds = kinds
+        self.columns = columns
+        self.links = links
+        self.strings = strings
+        self._unique = None
+
+    def __getstate__(self):
+        return(self.key, self.keys, self.kinds,
+            dict((name, _copy(values)) for name, values in self.columns.items()),
+            dict((field, (_copy(o), _copy(t))) for field, (o, t) in self.links.items()),
+            self.strings)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __len__(self):
+        return(len(self.columns[self.keys[0]]))
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield Record(self, position)
+
+    def position(self, *key):
+        """
+        Find the position of an object.
+
+        :param key: the values of the ordering columns, e.g. the id
+        :returns: an int, or None when there is no such object
+        """
+        columns = [self.columns[name] for name in self.keys]
+        count = len(columns[0])
+        if len(columns) == 1 and count:
+            guess = key[0] - columns[0][0]
+            if 0 <= guess < count and columns[0][guess] == key[0]:
+                return(guess)
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if tuple(c[middle] for c in columns) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < count and tuple(c[low] for c in columns) == key:
+            return(low)
+        return(None)
+
+    def get(self, *key):
+        """
+        Look up an object.
+
+        :param key: the values of the ordering columns, e.g. the id
+        :returns: a :class:`Record`, or None
+        """
+        position = self.position(*key)
+        return(None if position is None else Record(self, position))
+
+    def by_unique(self, code):
+        """
+        Look up an object by its ``unique`` code.
+
+        :param str code: the code
+        :returns: a :class:`Record`, or None
+        """
+        if self._unique is None:
+            values = self.columns["unique"]
+            self._unique = dict((self.strings[values[p]], p)
+                for p in range(len(values)) if values[p] >= 0)
+        position = self._unique.get(code)
+        return(None if position is None else Record(self, position))
+
+    def value(self, position, name):
+        "Read one column of the object at a position."
+        return(_decode(self.kinds[name], self.columns[name][position], self.strings))
+
+    def linked(self, position, field):
+        "List the ids in one nested id list of the object at a position."
+        offsets, ids = self.links[field]
+        return(list(ids[offsets[position]:offsets[position + 1]]))
+
+
+class Snapshot(object):
+    """
+    Every collection of a Situation.
+
+    :param dict collections: a :class:`Collection` for each key of :data:`situation.serialize.SECTIONS`
+    :param StringTable strings: the strings shared by the collections
+    """
+
+    __slots__ = ("collections", "strings", "_buffer")
+
+    def __init__(self, collections, strings, buffer=None):
+        self.collections = collections
+        self.strings = strings
+        self._buffer = buffer
+
+    def __getstate__(self):
+        return(self.collections, self.strings)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __getitem__(self, key):
+        return(self.collections[key])
+
+    def __contains__(self, key):
+        return(key in self.collections)
+
+    @classmethod
+    def build(cls, conn, tables, batch_size=10000):
+        """
+        Read a Situation into a snapshot.
+
+        :param conn: a session or connection
+        :param dict tables: table objects by name
+        :param int batch_size: the number of rows fetched per query
+        :returns: a Snapshot
+        """
+        strings = _StringBuilder()
+        collections = {}
+        for key, name, ordering, _ in serialize.SECTIONS:
+            table = tables[name]
+            names = serialize.column_names(key)
+            kinds = dict((n, _kind(table.c[n])) for n in names)
+            columns = dict((n, array(TYPECODES[kinds[n]])) for n in names)
+            for rows in serialize.iter_rows(conn, tables, key, batch_size):
+                for n in names:
+                    kind, values = kinds[n], columns[n]
+                    values.extend(_encode(kind, row[n], strings) for row in rows)
+            collections[key] = Collection(key, ordering, kinds, columns, {}, None)
+
+        for owner, field, name, owner_columns, target in serialize.LINKS:
+            collection = collections[owner]
+            table = tables[name]
+            query = select([table.c[c] for c in owner_columns] + [table.c[target]])
+            sources, targets = array('l'), array('l')
+            for row in conn.execute(query.order_by(*table.primary_key.columns)):
+                row = tuple(row)
+                if None in row:
+                    continue
+                position = collection.position(*row[:-1])
+                if position is not None:
+                    sources.append(position)
+                    targets.append(row[-1])
+            collection.links[field] = _csr(len(collection), sources, targets)
+
+        table = strings.table()
+        for collection in collections.values():
+            collection.strings = table
+        return(cls(collections, table))
+
+    def _arrays(self):
+        "List every array with a name describing where it belongs."
+        yield ("strings", "offsets"), self.strings.offsets
+        yield ("strings", "data"), self.strings.data
+        for key in sorted(self.collections):
+            collection = self.collections[key]
+            for name in sorted(collection.columns):
+                yield (key, "column", name), collection.columns[name]
+            for field in sorted(collection.links):
+                offsets, ids = collection.links[field]
+                yield (key, "offsets", field), offsets
+                yield (key, "ids", field), ids
+
+    def save(self, filename):
+        """
+        Write the snapshot to a file that :meth:`open` can memory-map.
+
+        :param str filename: the name of the file to write
+        """
+        layout = []
+        offset = 0
+        for path, values in self._arrays():
+            values = _copy(values)
+            layout.append([list(path), values.typecode, offset, len(values)])
+            offset += (values.itemsize * len(values) + 7) // 8 * 8
+        header = json.dumps({
+            "arrays": layout,
+            "collections": dict((key, {"keys": list(c.keys), "kinds": c.kinds})
+                for key, c in self.collections.items()),
+        }).encode("utf-8")
+        start = (len(MAGIC) + 8 + len(header) + 7) // 8 * 8
+        with open(filename, "wb") as f:
+            f.write(MAGIC + struct.pack("<Q", len(header)) + header)
+            f.write(b"\0" * (start - f.tell()))
+            for path, values in self._arrays():
+                data = _tobytes(values)
+                f.write(data + b"\0" * ((8 - len(data) % 8) % 8))
+
+    @classmethod
+    def open(cls, filename):
+        """
+        Memory-map a snapshot written by :meth:`save`.
+
+        :param str filename: the name of the file
+        :returns: a Snapshot
+        """
+        with open(filename, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if buffer[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not a situation snapshot" % filename)
+        size = struct.unpack("<Q", buffer[len(MAGIC):len(MAGIC) + 8])[0]
+        header = json.loads(buffer[len(MAGIC) + 8:len(MAGIC) + 8 + size].decode("utf-8"))
+        start = (len(MAGIC) + 8 + size + 7) // 8 * 8
+        arrays = dict((tuple(path), _view(buffer, typecode, start + offset, count))
+            for path, typecode, offset, count in header["arrays"])
+        strings = StringTable(arrays[("strings", "offsets")], arrays[("strings", "data")])
+        collections = {}
+        for key, info in header["collections"].items():
+            columns = dict((path[2], values) for path, values in arrays.items()
+                if path[0] == key and path[1] == "column")
+            links = dict((path[2], (values, arrays[(key, "ids", path[2])]))
+                for path, values in arrays.items() if path[0] == key and path[1] == "offsets")
+            collections[key] = Collection(key, info["keys"], info["kinds"], columns, links,
+                strings)
+        return(cls(collections, strings, buffer))
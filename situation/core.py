@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+# situation (c) Ian Dennis Miller
+
+"""
+Read a Situation without Flask.
+
+The tables are reflected from the database and objects are serialized by
+:mod:`situation.serialize` with SQLAlchemy Core, so neither Flask-Diamond nor
+marshmallow is imported.  The output is identical to :func:`situation.dump`
+and :func:`situation.save`.
+
+::
+
+    from situation.core import Situation
+    situation = Situation("sqlite:////tmp/dev.db")
+    names = situation.dump(fields={"persons": ["id", "name"]})["persons"]
+
+For writes, :meth:`Situation.session` returns a plain SQLAlchemy session over
+the reflected tables; the models in :mod:`situation.models` still need a Flask
+application, as set up by :mod:`situation.debug_app`.  Text kept by
+:mod:`situation.textstore` is resolved as it is read, as :func:`situation.dump`
+does; writes through the session store it in full.
+"""
+
+import json
+from sqlalchemy import MetaData, create_engine, func, select
+from sqlalchemy.orm import sessionmaker
+
+from . import serialize
+from . import textstore  # noqa: F401 resolves stored text in the rows read
+
+
+class Situation(object):
+    """
+    A database holding a Situation.
+
+    :param bind: a database URL or an engine
+    :param engine_options: keyword arguments for ``create_engine()`` when ``bind`` is a URL
+    """
+
+    def __init__(self, bind, **engine_options):
+        if not hasattr(bind, "connect"):
+            bind = create_engine(bind, **engine_options)
+        self.engine = bind
+        self.metadata = MetaData()
+        self.metadata.reflect(bind=self.engine)
+        self.tables = self.metadata.tables
+        self._sessionmaker = sessionmaker(bind=self.engine)
+
+    def session(self):
+        "Create a SQLAlchemy session bound to the database."
+        return(self._sessionmaker())
+
+    def revision(self):
+        """
+        Find the latest revision of the Situation.
+
+        :returns: an int, 0 if nothing has been recorded
+        """
+        with self.engine.connect() as conn:
+            return(serialize.latest_revision(conn, self.tables))
+
+    def count(self, key):
+        """
+        Count the objects of a collection.
+
+        :param str key: the name of the collection, e.g. "persons"
+        :returns: an int
+        """
+        table = self.tables[serialize.section(key)[1]]
+        with self.engine.connect() as conn:
+            return(conn.execute(select([func.count()]).select_from(table)).scalar())
+
+    def get(self, key, ident, fields=None):
+        """
+        Serialize one object.
+
+        :param str key: the name of the collection, e.g. "persons"
+        :param ident: the id, or a tuple of the ordering columns for acquaintances
+        :param list fields: the fields to include, or None for all of them
+        :returns: a Dict, or None when there is no such object
+        """
+        ident = tuple(ident) if isinstance(ident, (list, tuple)) else (ident,)
+        ordering = serialize.section(key)[2]
+        fields = serialize.select_fields(serialize.field_names(key), fields)
+        with self.engine.connect() as conn:
+            for rows in serialize.iter_rows(conn, self.tables, key, None, first=ident[0],
+                    last=ident[0] + 1, fields=fields):
+                rows = [row for row in rows if tuple(row[c] for c in ordering) == ident]
+                if rows:
+                    return(serialize.serialize_page(conn, self.tables, key, rows, fields)[0])
+        return(None)
+
+    def iter_pages(self, key, batch_size=1000, since=None, fields=None):
+        """
+        Iterate over the serialized objects of a collection, a page at a time.
+
+        :param str key: the name of the collection, e.g. "persons"
+        :param int batch_size: the number of objects per page, or None for a single page
+        :param int since: only include objects changed after this revision
+        :param list fields: the fields to include, or None for all of them
+        :returns: a generator of lists of dictionaries
+        """
+        fields = serialize.select_fields(serialize.field_names(key), fields)
+        with self.engine.connect() as conn:
+            for page in serialize.iter_pages(conn, self.tables, key, batch_size, since=since,
+                    fields=fields):
+                yield page
+
+    def dump(self, batch_size=None, since=None, fields=None):
+        """
+        Build a dictionary containing the entire Situation; see :func:`situation.dump`.
+
+        :param int batch_size: the number of objects fetched per query, or None for a single query
+        :param int since: a revision, or None for everything
+        :param dict fields: lists of field names by collection, or None for every field
+        :returns: a Dict with the situation as nested Dictionaries.
+        """
+        fields = fields or {}
+        projections = dict((key, serialize.select_fields(serialize.field_names(key), only))
+            for key, only in fields.items())
+        result = {}
+        with self.engine.connect() as conn:
+            with conn.begin():
+                if since is not None:
+                    result["revision"] = serialize.latest_revision(conn, self.tables)
+                    result["tombstones"] = serialize.tombstones_since(conn, self.tables, since)
+                for key, _, _, _ in serialize.SECTIONS:
+                    result[key] = []
+                    for page in serialize.iter_pages(conn, self.tables, key, batch_size,
+                            since=since, fields=projections.get(key)):
+                        result[key].extend(page)
+        return(result)
+
+    def iter_dump(self, batch_size=1000):
+        """
+        Encode the entire Situation as JSON, one piece at a time; see :func:`situation.iter_dump`.
+
+        :param int batch_size: the number of objects fetched per query
+        :returns: a generator of JSON strings
+        """
+        with self.engine.connect() as conn:
+            with conn.begin():
+
+                def encoded(key):
+                    for page in serialize.iter_pages(conn, self.tables, key, batch_size):
+                        for obj in page:
+                            yield serialize.encode(obj, 2)
+
+                for chunk in serialize.iter_json((key, encoded(key))
+                        for key, _, _, _ in serialize.SECTIONS):
+                    yield chunk
+
+    def save(self, filename, stream=False, batch_size=1000):
+        """
+        Write the Situation to a JSON file; see :func:`situation.save`.
+
+        :param str filename: the name of the file to output to.
+        :param bool stream: write the file incrementally using :meth:`iter_dump`
+        :param int batch_size: the number of objects fetched per query when streaming
+        """
+        with open(filename, "w") as f:
+            if stream:
+                for chunk in self.iter_dump(batch_size):
+                    f.write(chunk)
+            else:
+                json.dump(self.dump(), f, indent=True, sort_keys=True)
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+# situation (c) Ian Dennis Miller
+
+"""
+Maintained aggregate columns.
+
+Persons, groups, events and places store the number of rows that refer to them
+in a few tables, such as ``group.member_count`` for ``groups_members``, so that
+"largest groups" is an indexed read rather than a grouped scan.
+
+Counts are adjusted in the same transaction as the rows they count: an event
+on the engine of every session sees each insert into and delete from the
+counted tables, and mapper events follow ``Event.place_id``.  A statement
+whose rows are not known, such as a delete with an arbitrary ``WHERE`` clause
+or an update that moves rows to other owners, recounts the affected column.
+Bulk loads can suspend the bookkeeping with :func:`suppressed` and call
+:func:`refresh` afterwards.
+
+``person.acquaintance_count`` counts the acquaintances a person has, the rows
+of ``acquaintance`` whose ``person_id`` is the person, as
+``Person.acquaintances`` lists them; being someone else's acquaintance is not
+counted.
+"""
+
+import threading
+import weakref
+from contextlib import contextmanager
+from sqlalchemy import bindparam, event, func, inspect, select
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.sql.expression import Delete, Insert, Update
+
+from .cache import statement_rows
+
+"Maintained counts: (table, count column, counted table, referring column)."
+COUNTERS = (
+    ("event", "actor_count", "events_actors", "event_id"),
+    ("event", "excerpt_count", "events_excerpts", "event_id"),
+    ("group", "excerpt_count", "groups_excerpts", "group_id"),
+    ("group", "member_count", "groups_members", "group_id"),
+    ("person", "acquaintance_count", "acquaintance", "person_id"),
+    ("person", "event_count", "events_actors", "actor_id"),
+    ("person", "excerpt_count", "persons_excerpts", "person_id"),
+    ("place", "event_count", "event", "place_id"),
+    ("place", "excerpt_count", "places_excerpts", "place_id"),
+)
+
+"Counted tables whose rows are mapped objects followed with mapper events instead."
+MAPPED = ("event",)
+
+_state = threading.local()
+_tables = {}
+_models = {}
+_engines = weakref.WeakSet()
+
+
+@contextmanager
+def suppressed():
+    """
+    Suspend the bookkeeping on this thread, for instance while bulk loading.
+
+    Call :func:`refresh` afterwards so that the counts are correct.
+    """
+    previous = getattr(_state, "suppressed", False)
+    _state.suppressed = True
+    try:
+        yield
+    finally:
+        _state.suppressed = previous
+
+
+def refresh(conn, tables, counters=COUNTERS):
+    """
+    Recount every maintained column with one ``UPDATE`` each.
+
+    :param conn: a session or connection
+    :param dict tables: table objects by name
+    :param counters: entries of :data:`COUNTERS` to recount
+    """
+    for name, column, source, referring in counters:
+        table, counted = tables[name], tables[source]
+        count = select([func.count()]).where(counted.c[referring] == table.c.id).as_scalar()
+        conn.execute(table.update().values({column: count}))
+
+
+def adjust(conn, name, column, deltas):
+    """
+    Add to the counts of some rows.
+
+    :param conn: a connection
+    :param str name: the table holding the count
+    :param str column: the count column
+    :param dict deltas: the change for each row id
+    """
+    deltas = dict((ident, delta) for ident, delta in deltas.items()
+        if ident is not None and delta)
+    if not deltas:
+        return
+    table = _tables[name]
+    conn.execute(table.update().where(table.c.id == bindparam("counted_id"))
+        .values({column: table.c[column] + bindparam("counted_delta")}),
+        [{"counted_id": ident, "counted_delta": delta} for ident, delta in deltas.items()])
+    touched = _state.__dict__.setdefault("touched", {})
+    touched.setdefault((name, column), set()).update(deltas)
+
+
+def _updated_columns(clauseelement, rows):
+    "Find the names of the columns an update may set."
+    names = set(getattr(key, "key", key) for key in (clauseelement.parameters or {}))
+    for row in rows:
+        names.update(row)
+    return(names)
+
+
+def _after_execute(conn, clauseelement, multiparams, params, *args):
+    "Adjust the counts fed by rows inserted into, deleted from or moved within a counted table."
+    if getattr(_state, "suppressed", False):
+        return
+    if not isinstance(clauseelement, (Insert, Update, Delete)):
+        return
+    source = clauseelement.table.name
+    if source in MAPPED:
+        return
+    rows = statement_rows(multiparams, params)
+    if isinstance(clauseelement, Update):
+        updated = _updated_columns(clauseelement, rows)
+        refresh(conn, _tables, [counter for counter in COUNTERS
+            if counter[2] == source and counter[3] in updated])
+        return
+    sign = 1 if isinstance(clauseelement, Insert) else -1
+    for name, column, counted, referring in COUNTERS:
+        if counted != source:
+            continue
+        if not rows or not all(referring in row for row in rows):
+            refresh(conn, _tables, [(name, column, counted, referring)])
+            continue
+        deltas = {}
+        for row in rows:
+            deltas[row[referring]] = deltas.get(row[referring], 0) + sign
+        adjust(conn, name, column, deltas)
+
+
+def _mapped_listeners(model):
+    "Create the mapper listeners adjusting the counts fed by a model's foreign keys."
+    source = model.__table__.name
+    counters = [(name, column, referring) for name, column, counted, referring in COUNTERS
+        if counted == source]
+
+    def after_insert(mapper, connection, target):
+        if not getattr(_state, "suppressed", False):
+            for name, column, referring in counters:
+                adjust(connection, name, column, {getattr(target, referring): 1})
+
+    def after_update(mapper, connection, target):
+        if getattr(_state, "suppressed", False):
+            return
+        state = inspect(target)
+        for name, column, referring in counters:
+            history = state.attrs[referring].history
+            if history.has_changes():
+                deltas = {}
+                for ident in history.deleted or ():
+                    deltas[ident] = deltas.get(ident, 0) - 1
+                for ident in history.added or ():
+                    deltas[ident] = deltas.get(ident, 0) + 1
+                adjust(connection, name, column, deltas)
+
+    def after_delete(mapper, connection, target):
+        if not getattr(_state, "suppressed", False):
+            for name, column, referring in counters:
+                adjust(connection, name, column, {getattr(target, referring): -1})
+
+    return([(model, "after_insert", after_insert), (model, "after_update", after_update),
+        (model, "after_delete", after_delete)])
+
+
+def _after_flush_postexec(session, flush_context):
+    "Expire counts adjusted during the flush so that loaded objects read the new values."
+    touched = _state.__dict__.pop("touched", None)
+    if not touched:
+        return
+    for (name, column), idents in touched.items():
+        model = _models.get(name)
+        for ident in idents:
+            obj = session.identity_map.get(identity_key(model, ident))
+            if obj is not None:
+                session.expire(obj, [column])
+
+
+def watch(engine):
+    """
+    Maintain the counts for the statements executed on an engine.
+
+    A session calls it for its engine when it begins a transaction; call it for an engine
+    written to without a session.
+
+    :param engine: a SQLAlchemy engine
+    """
+    if engine not in _engines:
+        _engines.add(engine)
+        event.listen(engine, "after_execute", _after_execute)
+
+
+def _after_begin(session, transaction, connection):
+    watch(connection.engine)
+
+
+def install(models):
+    """
+    Start maintaining the counts.
+
+    :param list models: the model classes of the tables in :data:`COUNTERS`
+    """
+    for model in models:
+        _models[model.__table__.name] = model
+        _tables.update(model.metadata.tables)
+        if model.__table__.name in MAPPED:
+            for target, name, listener in _mapped_listeners(model):
+                event.listen(target, name, listener)
+    event.listen(Session, "after_begin", _after_begin)
+    event.listen(Session, "after_flush_postexec", _after_flush_postexec)
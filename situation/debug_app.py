@@ -2,32 +2,172 @@
 # situation (c) Ian Dennis Miller
 
 from flask_diamond import Diamond, db
+from contextlib import contextmanager
+from sqlalchemy.schema import CreateIndex, CreateTable
+import hashlib
 import os
 import json
+import shutil
+import sqlite3
+import tempfile
+from . import counts
+from . import instrument
+from . import models  # noqa: F401 registers the models with db
+from . import storage
+from . import textstore
+from .cache import dump_cache
+
+"Template databases by database URL and fixture."
+_templates = {}
 
 
 class DebugApp(Diamond):
     pass
 
 
-def create_app():
+def create_app(profile=None):
+    """
+    Create the application.
+
+    :param str profile: a storage profile from :data:`situation.storage.PROFILES`, such as "fast"; None keeps the defaults
+    :returns: a Flask application
+    """
     application = DebugApp()
     application.facet("configuration")
+    app = application.app
+    if profile is not None:
+        options = dict(app.config.get("SQLALCHEMY_ENGINE_OPTIONS") or {})
+        options.update(storage.engine_options(app.config["SQLALCHEMY_DATABASE_URI"], profile))
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
     application.facet("logs")
     application.facet("database")
     application.facet("marshalling")
-    return(application.app)
+    with app.app_context():
+        if profile is not None:
+            storage.apply(db.engine, profile)
+        counts.watch(db.engine)
+        textstore.attach(db.engine)
+    return(app)
 
 
 def reset_db():
+    textstore.metadata.drop_all(bind=db.engine)
     db.drop_all()
     db.create_all()
 
 
-def quick():
+def _schema_key():
+    "Hash the DDL of every table and index, so that a stored template matches the models."
+    dialect = db.engine.dialect
+    ddl = []
+    for table in db.metadata.sorted_tables:
+        ddl.append(str(CreateTable(table).compile(dialect=dialect)))
+        ddl.extend(str(CreateIndex(index).compile(dialect=dialect))
+            for index in sorted(table.indexes, key=lambda index: index.name))
+    return(hashlib.sha1("\n".join(ddl).encode("utf-8")).hexdigest())
+
+
+def _sqlite_file(engine):
+    "Find the file of a SQLite database, or None when it is in memory or not SQLite."
+    url = engine.url
+    if url.get_backend_name() != "sqlite" or url.database in (None, "", ":memory:"):
+        return(None)
+    return(url.database)
+
+
+def _copy(engine, filename, into_engine):
+    """
+    Copy a SQLite database between an engine and a file with the backup API.
+
+    :param engine: the engine of the database
+    :param str filename: the other database
+    :param bool into_engine: copy the file into the engine's database, rather than the reverse
+    :returns: True, or False when this Python lacks the backup API and the engine's database is not a file
+    """
+    if not hasattr(sqlite3.Connection, "backup"):
+        database = _sqlite_file(engine)
+        if database is None:
+            return(False)
+        engine.dispose()
+        source, target = (filename, database) if into_engine else (database, filename)
+        shutil.copyfile(source, target)
+        return(True)
+    raw = engine.raw_connection()
+    try:
+        connection = getattr(raw, "dbapi_connection", None) or raw.connection
+        other = sqlite3.connect(filename)
+        try:
+            if into_engine:
+                other.backup(connection)
+            else:
+                connection.backup(other)
+        finally:
+            other.close()
+    finally:
+        raw.close()
+    return(True)
+
+
+def template_db(fixture=None):
+    """
+    Build the template database that :func:`clone_db` copies, unless it already exists.
+
+    The empty template is stored in the temporary directory under a hash of the schema, so
+    later processes reuse it until the models change.  A template populated by a fixture is
+    kept for the life of the process.
+
+    :param fixture: a callable populating the database, such as ``simple_situation``; None for an empty database
+    :returns: the filename of the template, or None when the database is not SQLite
+    """
+    if db.engine.url.get_backend_name() != "sqlite":
+        return(None)
+    key = (str(db.engine.url), fixture)
+    filename = _templates.get(key)
+    if filename is not None and os.path.exists(filename):
+        return(filename)
+    if fixture is None:
+        filename = os.path.join(tempfile.gettempdir(), "situation-%s.db" % _schema_key())
+    else:
+        filename = os.path.join(tempfile.mkdtemp(), "situation-template.db")
+    if fixture is not None or not os.path.exists(filename):
+        db.session.remove()
+        reset_db()
+        if fixture is not None:
+            fixture()
+            db.session.commit()
+            db.session.remove()
+        building = "%s.%d" % (filename, os.getpid())
+        if not _copy(db.engine, building, into_engine=False):
+            return(None)
+        os.rename(building, filename)
+    _templates[key] = filename
+    return(filename)
+
+
+def clone_db(fixture=None):
+    """
+    Replace the database with a copy of a template, much faster than :func:`reset_db`.
+
+    SQLite databases are copied with the backup API; other databases are reset and the
+    fixture is run again.
+
+    :param fixture: a callable populating the database, or None for an empty database
+    """
+    filename = template_db(fixture)
+    db.session.remove()
+    if filename is None or not _copy(db.engine, filename, into_engine=True):
+        reset_db()
+        if fixture is not None:
+            fixture()
+            db.session.commit()
+    dump_cache.clear()
+
+
+def quick(profile=None):
     tmp_settings()
-    app = create_app()
-    reset_db()
+    app = create_app(profile=profile)
+    with app.app_context():
+        clone_db()
     return(app)
 
 
@@ -36,3 +176,25 @@ def tmp_settings():
         'LOG': '/tmp/out.log',
         'SQLALCHEMY_DATABASE_URI': 'sqlite:////tmp/dev.db'
     })
+
+
+@contextmanager
+def instrumented(limit=20):
+    """
+    Record statements, rows and time within a block and print the busiest scopes.
+
+    ::
+
+        with quick().app_context():
+            with instrumented():
+                dump()
+
+    :param int limit: the number of scopes to print
+    :returns: a context manager yielding :data:`situation.instrument.stats`
+    """
+    instrument.enable()
+    try:
+        yield instrument.stats
+    finally:
+        instrument.disable()
+        print(instrument.stats.summary(limit))
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# situation (c) Ian Dennis Miller
+
+"""
+Geometry for Place queries.
+
+Radius queries first select the bounding box of the circle, which the
+``(lat, lon)`` index on Place answers with a range scan, and then discard the
+corners of the box using the great-circle distance.
+"""
+
+from math import asin, cos, degrees, radians, sin, sqrt
+
+"The mean radius of the Earth in kilometres."
+EARTH_RADIUS_KM = 6371.0088
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """
+    Compute the great-circle distance between two points.
+
+    :param float lat1: latitude of the first point in degrees
+    :param float lon1: longitude of the first point in degrees
+    :param float lat2: latitude of the second point in degrees
+    :param float lon2: longitude of the second point in degrees
+    :returns: the distance in kilometres
+    """
+    dlat = radians(lat2 - lat1)
+    dlon = radians(lon2 - lon1)
+    a = sin(dlat / 2) ** 2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon / 2) ** 2
+    return(2 * EARTH_RADIUS_KM * asin(min(1.0, sqrt(a))))
+
+
+def lon_ranges(west, east):
+    """
+    Split a longitude interval that may cross the antimeridian.
+
+    :param float west: the western edge in degrees
+    :param float east: the eastern edge in degrees
+    :returns: a list of (low, high) intervals within [-180, 180]
+    """
+    if west <= east:
+        return([(west, east)])
+    return([(west, 180.0), (-180.0, east)])
+
+
+def bounding_box(lat, lon, km):
+    """
+    Find the smallest latitude/longitude box containing a circle.
+
+    :param float lat: latitude of the centre in degrees
+    :param float lon: longitude of the centre in degrees
+    :param float km: the radius in kilometres
+    :returns: a (south, north, longitude intervals) tuple
+    """
+    angle = km / EARTH_RADIUS_KM
+    south = lat - degrees(angle)
+    north = lat + degrees(angle)
+    if south <= -90 or north >= 90:
+        return(max(south, -90.0), min(north, 90.0), [(-180.0, 180.0)])
+    dlon = degrees(asin(sin(angle) / cos(radians(lat))))
+    west = lon - dlon
+    east = lon + dlon
+    if west < -180:
+        west += 360
+    if east > 180:
+        east -= 360
+    return(south, north, lon_ranges(west, east))
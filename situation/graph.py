@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+# situation (c) Ian Dennis Miller
+
+"""
+Social network queries over a Situation.
+
+Two persons are adjacent when one is an Acquaintance of the other, or when they
+share a Group, an Event, a Place or an Item.  :class:`Graph` loads these edges
+once into compressed sparse row (CSR) arrays and answers traversal queries in
+memory.  Shared memberships are kept as person-to-entity arrays rather than
+expanded into person pairs, so a large Group costs one edge per member instead
+of one per pair of members.
+
+When the graph does not fit in memory, :func:`within_sql` answers the k-hop
+question with a recursive common table expression inside the database.
+"""
+
+from array import array
+from bisect import bisect_left
+from collections import deque
+from sqlalchemy import select, text
+
+"Shared memberships: (kind, association table, person column, entity column)."
+MEMBERSHIPS = (
+    ("groups", "groups_members", "member_id", "group_id"),
+    ("events", "events_actors", "actor_id", "event_id"),
+    ("places", "places_owners", "owner_id", "place_id"),
+    ("items", "items_owners", "owner_id", "item_id"),
+)
+
+"Every kind of edge."
+KINDS = ("acquaintances",) + tuple(m[0] for m in MEMBERSHIPS)
+
+
+def _csr(count, sources, targets):
+    """
+    Build compressed sparse row arrays from an edge list.
+
+    :param int count: the number of source rows
+    :param array sources: the source row of each edge
+    :param array targets: the target row of each edge
+    :returns: an (offsets, targets) pair of arrays; the targets of row r are ``targets[offsets[r]:offsets[r + 1]]``
+    """
+    offsets = array('l', [0]) * (count + 1)
+    for source in sources:
+        offsets[source + 1] += 1
+    for row in range(count):
+        offsets[row + 1] += offsets[row]
+    cursor = offsets[:count]
+    result = array('l', [0]) * len(targets)
+    for source, target in zip(sources, targets):
+        result[cursor[source]] = target
+        cursor[source] += 1
+    return(offsets, result)
+
+
+class Graph(object):
+    """
+    An in-memory adjacency structure over the persons of a Situation.
+
+    Use :meth:`load` to build one from the database.  Queries take and return person ids.
+
+    :param array ids: the sorted person ids; a person's row is its position in this array
+    :param tuple acquaintances: CSR (offsets, targets) arrays from person rows to person rows
+    :param dict memberships: for each kind, a (person CSR, entity CSR, entity count) tuple
+    """
+
+    def __init__(self, ids, acquaintances, memberships):
+        self.ids = ids
+        self.acquaintances = acquaintances
+        self.memberships = memberships
+
+    @classmethod
+    def load(cls, kinds=KINDS, directed=False, conn=None, tables=None):
+        """
+        Read the edges of a Situation into memory.
+
+        :param tuple kinds: the kinds of edge to include, from :data:`KINDS`
+        :param bool directed: follow Acquaintances only from person to acquainted
+        :param conn: a session or connection; defaults to the database session
+        :param dict tables: table objects by name; defaults to the model tables
+        :returns: a Graph
+        """
+        if conn is None:
+            from . import db
+            conn = db.session
+            tables = db.metadata.tables
+
+        person = tables["person"]
+        ids = array('l', (row[0] for row in conn.execute(
+            select([person.c.id]).order_by(person.c.id))))
+        rows = dict((pid, row) for row, pid in enumerate(ids))
+
+        sources, targets = array('l'), array('l')
+        if "acquaintances" in kinds:
+            acquaintance = tables["acquaintance"]
+            for a, b in conn.execute(select([acquaintance.c.person_id,
+                    acquaintance.c.acquainted_id])):
+                if a not in rows or b not in rows:
+                    continue
+                sources.append(rows[a])
+                targets.append(rows[b])
+                if not directed:
+                    sources.append(rows[b])
+                    targets.append(rows[a])
+        acquaintances = _csr(len(ids), sources, targets)
+
+        memberships = {}
+        for kind, name, person_column, entity_column in MEMBERSHIPS:
+            if kind not in kinds:
+                continue
+            table = tables[name]
+            entities = {}
+            sources, targets = array('l'), array('l')
+            for pid, eid in conn.execute(select([table.c[person_column],
+                    table.c[entity_column]])):
+                if pid not in rows or eid is None:
+                    continue
+                sources.append(rows[pid])
+                targets.append(entities.setdefault(eid, len(entities)))
+            memberships[kind] = (
+                _csr(len(ids), sources, targets),
+                _csr(len(entities), targets, sources),
+                len(entities),
+            )
+        return(cls(ids, acquaintances, memberships))
+
+    def _row(self, person_id):
+        row = bisect_left(self.ids, person_id)
+        if row == len(self.ids) or self.ids[row] != person_id:
+            raise KeyError(person_id)
+        return(row)
+
+    def _adjacent(self, row, seen):
+        """
+        Iterate over the rows adjacent to a person row.
+
+        :param int row: the person row
+        :param dict seen: for each kind, a bytearray marking entities already expanded
+        """
+        offsets, targets = self.acquaintances
+        for index in range(offsets[row], offsets[row + 1]):
+            yield targets[index]
+        for kind, ((offsets, entities), (members_offsets, members), _) in \
+                self.memberships.items():
+            marks = seen[kind]
+            for index in range(offsets[row], offsets[row + 1]):
+                entity = entities[index]
+                if marks[entity]:
+                    continue
+                marks[entity] = 1
+                for member in range(members_offsets[entity], members_offsets[entity + 1]):
+                    yield members[member]
+
+    def _bfs(self, source, hops=None, target=None, distance=None):
+        """
+        Run a breadth-first search from a person row.
+
+        :param int source: the starting row
+        :param int hops: stop after this many hops, or None for no limit
+        :param int target: stop once this row is reached, or None to search everything
+        :param array distance: a shared distance array, -1 for unvisited rows
+        :returns: a (distance, parent, visited rows) tuple
+        """
+        if distance is None:
+            distance = array('l', [-1]) * len(self.ids)
+        parent = {source: None}
+        seen = dict((kind, bytearray(count)) for kind, (_, _, count) in self.memberships.items())
+        distance[source] = 0
+        visited = [source]
+        queue = deque([source])
+        while queue:
+            row = queue.popleft()
+            if row == target or (hops is not None and distance[row] >= hops):
+                continue
+            for other in self._adjacent(row, seen):
+                if distance[other] == -1:
+                    distance[other] = distance[row] + 1
+                    parent[other] = row
+                    visited.append(other)
+                    if other == target:
+                        return(distance, parent, visited)
+                    queue.append(other)
+        return(distance, parent, visited)
+
+    def neighbors(self, person_id):
+        """
+        Find the persons one hop from a person.
+
+        :param int person_id: the id of the person
+        :returns: a sorted list of person ids
+        """
+        return(sorted(pid for pid, hops in self.within(person_id, 1).items() if hops == 1))
+
+    def within(self, person_id, hops):
+        """
+        Find every person within a number of hops of a person.
+
+        :param int person_id: the id of the person
+        :param int hops: the largest number of hops
+        :returns: a Dict mapping person ids to their distance, including the person itself at 0
+        """
+        distance, _, visited = self._bfs(self._row(person_id), hops=hops)
+        return(dict((self.ids[row], distance[row]) for row in visited))
+
+    def shortest_path(self, source_id, target_id):
+        """
+        Find a shortest chain of persons connecting two persons.
+
+        :param int source_id: the id of the first person
+        :param int target_id: the id of the second person
+        :returns: a list of person ids from source to target, or None if they are not connected
+        """
+        target = self._row(target_id)
+        _, parent, _ = self._bfs(self._row(source_id), target=target)
+        if target not in parent:
+            return(None)
+        path = []
+        row = target
+        while row is not None:
+            path.append(self.ids[row])
+            row = parent[row]
+        return(list(reversed(path)))
+
+    def components(self):
+        """
+        Partition the persons into connected components.
+
+        :returns: a list of sorted lists of person ids, largest first
+        """
+        distance = array('l', [-1]) * len(self.ids)
+        result = []
+        for row in range(len(self.ids)):
+            if distance[row] == -1:
+                _, _, visited = self._bfs(row, distance=distance)
+                result.append(sorted(self.ids[r] for r in visited))
+        result.sort(key=len, reverse=True)
+        return(result)
+
+
+def within_sql(person_id, hops, kinds=KINDS, conn=None):
+    """
+    Find every person within a number of hops of a person, inside the database.
+
+    This uses a recursive common table expression, so nothing is loaded into memory
+    beyond the result.  Rows carry their depth and are combined with ``UNION``, so a
+    person reached again at a depth already seen is dropped rather than expanded: the
+    expression holds at most one row per person and depth, however many paths or
+    cycles connect them.
+
+    :param int person_id: the id of the person
+    :param int hops: the largest number of hops
+    :param tuple kinds: the kinds of edge to include, from :data:`KINDS`
+    :param conn: a session or connection; defaults to the database session
+    :returns: a Dict mapping person ids to their distance, including the person itself at 0
+    """
+    if conn is None:
+        from . import db
+        conn = db.session
+    edges = []
+    if "acquaintances" in kinds:
+        edges.append("SELECT person_id AS a, acquainted_id AS b FROM acquaintance")
+        edges.append("SELECT acquainted_id AS a, person_id AS b FROM acquaintance")
+    for kind, name, person_column, entity_column in MEMBERSHIPS:
+        if kind in kinds:
+            edges.append(
+                "SELECT x.{p} AS a, y.{p} AS b FROM {t} x JOIN {t} y "
+                "ON x.{e} = y.{e} AND x.{p} != y.{p}".format(
+                    t=name, p=person_column, e=entity_column))
+    if not edges:
+        return({person_id: 0})
+    query = text(
+        "WITH RECURSIVE edges(a, b) AS ({edges}), "
+        "reach(id, depth) AS ("
+        "SELECT :person_id, 0 "
+        "UNION SELECT edges.b, reach.depth + 1 FROM reach JOIN edges ON edges.a = reach.id "
+        "WHERE reach.depth < :hops) "
+        "SELECT id, MIN(depth) FROM reach GROUP BY id".format(edges=" UNION ".join(edges)))
+    rows = conn.execute(query, {"person_id": person_id, "hops": hops})
+    return(dict((row[0], row[1]) for row in rows))
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+# situation (c) Ian Dennis Miller
+
+"""
+Opt-in accounting of where dumps spend their time.
+
+While instrumentation is enabled, every SQL statement, every row fetched and the
+time spent are charged to the innermost open scope.  ``Model.dump()`` opens a
+scope named after the model, such as ``Person``, and every nested field of a
+schema opens one named after the model and field, such as ``Person.groups``,
+so a relationship that issues a query per object stands out.  The bulk
+:func:`situation.dump` opens one scope per collection, such as ``dump.persons``.
+
+::
+
+    from situation import instrument
+    instrument.enable()
+    person.dump()
+    print(instrument.stats.summary())
+    instrument.disable()
+
+Figures are exclusive: time spent in a nested scope is not charged to its parent.
+"""
+
+import threading
+from timeit import default_timer
+from marshmallow import fields
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Mapper
+
+"The scope charged for work done outside any scope."
+OTHER = "(other)"
+
+
+class Stats(object):
+    "Counters of statements, rows and time, by scope."
+
+    def __init__(self):
+        self._scopes = {}
+        self._lock = threading.Lock()
+
+    def record(self, scope, calls=0, statements=0, rows=0, seconds=0.0, sql_seconds=0.0):
+        """
+        Add to the counters of a scope.
+
+        :param str scope: the name of the scope
+        :param int calls: the number of times the scope was entered
+        :param int statements: the number of SQL statements executed
+        :param int rows: the number of rows fetched
+        :param float seconds: the time spent
+        :param float sql_seconds: the time spent executing statements
+        """
+        with self._lock:
+            counters = self._scopes.get(scope)
+            if counters is None:
+                counters = self._scopes[scope] = {"calls": 0, "statements": 0, "rows": 0,
+                    "seconds": 0.0, "sql_seconds": 0.0}
+            counters["calls"] += calls
+            counters["statements"] += statements
+            counters["rows"] += rows
+            counters["seconds"] += seconds
+            counters["sql_seconds"] += sql_seconds
+
+    def reset(self):
+        "Forget every counter."
+        with self._lock:
+            self._scopes.clear()
+
+    def as_dict(self):
+        """
+        Copy the counters.
+
+        :returns: a Dict mapping scope names to Dicts of ``calls``, ``statements``, ``rows``, ``seconds`` and ``sql_seconds``
+        """
+        with self._lock:
+            return(dict((scope, dict(counters)) for scope, counters in self._scopes.items()))
+
+    def top(self, limit=10, key="seconds"):
+        """
+        Rank the scopes by one counter.
+
+        :param int limit: the number of scopes to return
+        :param str key: the counter to rank by
+        :returns: a list of (scope, counters) pairs, largest first
+        """
+        ranked = sorted(self.as_dict().items(), key=lambda pair: (-pair[1][key], pair[0]))
+        return(ranked[:limit])
+
+    def summary(self, limit=20, key="seconds"):
+        """
+        Format the busiest scopes as a table.
+
+        :param int limit: the number of scopes to show
+        :param str key: the counter to rank by
+        :returns: a string
+        """
+        lines = ["%-32s %8s %10s %10s %10s %10s" % (
+            "scope", "calls", "statements", "rows", "seconds", "sql")]
+        for scope, c in self.top(limit, key):
+            lines.append("%-32s %8d %10d %10d %10.4f %10.4f" % (scope, c["calls"],
+                c["statements"], c["rows"], c["seconds"], c["sql_seconds"]))
+        return("\n".join(lines))
+
+
+"The counters filled while instrumentation is enabled."
+stats = Stats()
+
+enabled = False
+
+_stack = threading.local()
+_listeners = []
+
+
+def _current():
+    frames = getattr(_stack, "frames", None)
+    return(frames[-1][0] if frames else OTHER)
+
+
+class _Scope(object):
+    "Charges the time spent in a block to a scope."
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        frames = _stack.__dict__.setdefault("frames", [])
+        frames.append([self.name, default_timer(), 0.0])
+        return(self)
+
+    def __exit__(self, *exc):
+        name, start, nested = _stack.frames.pop()
+        elapsed = default_timer() - start
+        if _stack.frames:
+            _stack.frames[-1][2] += elapsed
+        stats.record(name, calls=1, seconds=elapsed - nested)
+
+
+class _NullScope(object):
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *exc):
+        pass
+
+
+_null = _NullScope()
+
+
+def scope(name):
+    """
+    Open a scope; does nothing while instrumentation is disabled.
+
+    ::
+
+        with instrument.scope("import"):
+            load(filename)
+
+    :param str name: the name of the scope
+    :returns: a context manager
+    """
+    if not enabled:
+        return(_null)
+    return(_Scope(name))
+
+
+def fetched(rows):
+    """
+    Charge rows read outside the ORM to the current scope.
+
+    :param int rows: the number of rows
+    """
+    if enabled:
+        stats.record(_current(), rows=rows)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("instrument_start", []).append(default_timer())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get("instrument_start")
+    if not starts:
+        return
+    stats.record(_current(), statements=1, sql_seconds=default_timer() - starts.pop())
+
+
+def _load(target, context):
+    stats.record(_current(), rows=1)
+
+
+def enable(reset=True):
+    """
+    Start recording statements, rows and time.
+
+    :param bool reset: forget the counters recorded so far
+    """
+    global enabled
+    if reset:
+        stats.reset()
+    if enabled:
+        return
+    _listeners.extend([(Engine, "before_cursor_execute", _before_cursor_execute),
+        (Engine, "after_cursor_execute", _after_cursor_execute),
+        (Mapper, "load", _load)])
+    for target, name, listener in _listeners:
+        event.listen(target, name, listener)
+    enabled = True
+
+
+def disable():
+    "Stop recording; the counters are kept until the next :func:`enable`."
+    global enabled
+    while _listeners:
+        event.remove(*_listeners.pop())
+    enabled = False
+
+
+class Nested(fields.Nested):
+    "A nested field that opens a scope named after the model and field while it is serialized."
+
+    def serialize(self, attr, obj, accessor=None):
+        if not enabled:
+            return(super(Nested, self).serialize(attr, obj, accessor))
+        with _Scope("%s.%s" % (type(obj).__name__, attr)):
+            return(super(Nested, self).serialize(attr, obj, accessor))
+
+
+class Method(fields.Method):
+    "A method field that opens a scope named after the model and field while it is serialized."
+
+    def serialize(self, attr, obj, accessor=None):
+        if not enabled:
+            return(super(Method, self).serialize(attr, obj, accessor))
+        with _Scope("%s.%s" % (type(obj).__name__, attr)):
+            return(super(Method, self).serialize(attr, obj, accessor))
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+# situation (c) Ian Dennis Miller
+
+"""
+Upgrades for databases created by earlier versions.
+
+``db.create_all()`` only creates missing tables, so columns and indexes added
+to existing tables must be created separately.  :func:`upgrade` brings an
+older database up to date:
+
+1. :func:`create_tables` creates the missing tables, such as ``revisions``;
+2. :func:`add_columns` adds every column the models define and the database
+   lacks with ``ALTER TABLE ... ADD COLUMN``, such as ``revision``, ``slug``
+   and the maintained counts;
+3. :func:`create_indexes` creates every missing index.  Before a unique index
+   is created, duplicate rows are removed, keeping the oldest of each;
+4. :func:`backfill` fills in the new columns: existing rows are stamped with
+   the latest revision, slugs are assigned and counts are recomputed.
+
+::
+
+    from situation import migrate
+    with app.app_context():
+        print(migrate.upgrade(db.session.connection(), db.metadata.tables))
+        db.session.commit()
+"""
+
+from sqlalchemy import bindparam, func, inspect, select, text
+from sqlalchemy.schema import CreateColumn
+
+from . import counts, serialize
+
+"Association tables, each indexed in both directions."
+LINK_TABLES = ("acquaintance_excerpts", "events_actors", "events_excerpts", "events_items",
+    "groups_excerpts", "groups_members", "items_excerpts", "items_owners", "persons_excerpts",
+    "places_excerpts", "places_owners")
+
+
+def deduplicate(conn, table, columns):
+    """
+    Delete rows repeating the values of some columns, keeping the row with the lowest id.
+
+    :param conn: a connection
+    :param table: the table
+    :param list columns: the names of the columns that should be unique together
+    :returns: the number of rows deleted
+    """
+    keep = select([func.min(table.c.id)]).group_by(*[table.c[c] for c in columns])
+    return(conn.execute(table.delete().where(~table.c.id.in_(keep))).rowcount)
+
+
+def create_indexes(conn, tables):
+    """
+    Create the indexes defined on existing tables that the database lacks.
+
+    :param conn: a connection
+    :param dict tables: table objects by name
+    :returns: a list of the names of the indexes created
+    """
+    inspector = inspect(conn)
+    existing_tables = set(inspector.get_table_names())
+    created = []
+    for name in sorted(tables):
+        if name not in existing_tables:
+            continue
+        table = tables[name]
+        existing = set(index["name"] for index in inspector.get_indexes(name))
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name in existing:
+                continue
+            if index.unique and "id" in table.c:
+                deduplicate(conn, table, [column.name for column in index.columns])
+            index.create(conn)
+            created.append(index.name)
+    return(created)
+
+
+def create_tables(conn, tables):
+    """
+    Create the tables that the database lacks, such as ``revisions``.
+
+    :param conn: a connection
+    :param dict tables: table objects by name
+    :returns: a list of the names of the tables created
+    """
+    existing = set(inspect(conn).get_table_names())
+    metadata = next(iter(tables.values())).metadata
+    created = []
+    for table in metadata.sorted_tables:
+        if table.name in tables and table.name not in existing:
+            table.create(conn)
+            created.append(table.name)
+    return(created)
+
+
+def add_columns(conn, tables):
+    """
+    Add the columns defined on existing tables that the database lacks.
+
+    A column that the model declares unique gets a unique index instead of a constraint,
+    which ``ALTER TABLE`` cannot add on every database.
+
+    :param conn: a connection
+    :param dict tables: table objects by name
+    :returns: a list of the columns added, as "table.column"
+    """
+    inspector = inspect(conn)
+    existing_tables = set(inspector.get_table_names())
+    preparer = conn.dialect.identifier_preparer
+    added = []
+    for name in sorted(tables):
+        if name not in existing_tables:
+            continue
+        table = tables[name]
+        present = set(column["name"] for column in inspector.get_columns(name))
+        for column in table.columns:
+            if column.name in present:
+                continue
+            conn.execute(text("ALTER TABLE %s ADD COLUMN %s" % (preparer.format_table(table),
+                CreateColumn(column).compile(dialect=conn.dialect))))
+            if column.unique:
+                conn.execute(text("CREATE UNIQUE INDEX %s ON %s (%s)" % (
+                    preparer.quote("uq_%s_%s" % (name, column.name)),
+                    preparer.format_table(table), preparer.quote(column.name))))
+            added.append("%s.%s" % (name, column.name))
+    return(added)
+
+
+def backfill_slugs(conn, tables):
+    """
+    Assign a slug to every row of a slugged collection that lacks one.
+
+    :param conn: a session or connection
+    :param dict tables: table objects by name
+    """
+    for key in serialize.SLUGGED:
+        table = tables[serialize.section(key)[1]]
+        rows = conn.execute(select([table.c.id, table.c.name, table.c.slug])
+            .order_by(table.c.id)).fetchall()
+        taken = set(row[2] for row in rows if row[2] is not None)
+        updates = []
+        for row_id, name, slug in rows:
+            if slug is None and name is not None:
+                updates.append({"row_id": row_id, "new_slug": serialize.unique_slug(
+                    serialize.slugify(name) or table.name, taken)})
+        if updates:
+            conn.execute(table.update().where(table.c.id == bindparam("row_id"))
+                .values(slug=bindparam("new_slug")), updates)
+
+
+def backfill(conn, tables):
+    """
+    Fill in the columns added by :func:`add_columns`.
+
+    Rows without a revision are stamped with the latest revision, or 0 when none has been
+    recorded, so that they are treated as older than any later change.
+
+    :param conn: a connection
+    :param dict tables: table objects by name
+    """
+    revision = serialize.latest_revision(conn, tables)
+    for _, name, _, _ in serialize.SECTIONS:
+        table = tables[name]
+        conn.execute(table.update().where(table.c.revision.is_(None)).values(revision=revision))
+    backfill_slugs(conn, tables)
+    counts.refresh(conn, tables)
+
+
+def upgrade(conn, tables):
+    """
+    Bring a database created by an earlier version up to date.
+
+    :param conn: a connection
+    :param dict tables: table objects by name
+    :returns: a list of the names of the tables, columns and indexes created
+    """
+    changes = create_tables(conn, tables)
+    changes.extend(add_columns(conn, tables))
+    changes.extend(create_indexes(conn, tables))
+    backfill(conn, tables)
+    return(changes)
+
+
+def drop_link_indexes(conn, tables):
+    """
+    Drop the indexes of the association tables, for instance to compare join speed.
+
+    Restore them with :func:`create_indexes`.
+
+    :param conn: a connection
+    :param dict tables: table objects by name
+    """
+    for name in LINK_TABLES:
+        for index in tables[name].indexes:
+            index.drop(conn)
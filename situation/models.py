@@ -0,0 +1,1212 @@
+# -*- coding: utf-8 -*-
+# situation (c) Ian Dennis Miller
+
+"""
+The models of a Situation, built on Flask-Diamond and marshmallow.
+
+Every public name here is also available from :mod:`situation`, which imports this module
+the first time one of them is used.
+"""
+
+import json
+import string
+import random
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import chain
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, load_only
+from flask_diamond import db, ma
+from flask_diamond.mixins.crud import CRUDMixin
+from flask_diamond.mixins.marshmallow import MarshmallowMixin
+
+from slugify import slugify
+
+from . import columnar
+from . import compact
+from . import counts
+from . import geo
+from . import instrument
+from . import migrate
+from . import parallel
+from . import serialize
+from . import textstore
+from .cache import dump_cache
+from .codes import CodeGenerator
+from .timeline import Timeline
+
+
+# https://stackoverflow.com/questions/2257441/python-random-string-generation-with-upper-case-letters-and-digits
+def id_generator(size=8, chars=None):
+    """
+    Create a random sequence of letters and numbers.
+
+    :param int size: the desired length of the sequence
+    :param str chars: the eligible character set to draw from when picking random characters
+    :returns: a string with the random sequence
+    """
+    if chars is None:
+        chars = string.ascii_uppercase + string.ascii_lowercase + string.digits
+    return ''.join(random.choice(chars) for x in range(size))
+
+
+"The callable that creates each new ``unique`` code; see :func:`set_unique_generator`."
+_unique_generator = CodeGenerator()
+
+
+def set_unique_generator(generator):
+    """
+    Choose how ``unique`` codes are created for new objects.
+
+    :param generator: a callable returning a new code, such as :func:`id_generator` or a :class:`situation.codes.CodeGenerator`
+    :returns: the previous generator
+    """
+    global _unique_generator
+    previous = _unique_generator
+    _unique_generator = generator
+    return(previous)
+
+
+def generate_unique():
+    """
+    Create a ``unique`` code using the current generator.
+
+    :returns: a string
+    """
+    return(_unique_generator())
+
+
+def current_revision():
+    """
+    Find the latest revision of the Situation.
+
+    Every flush that changes an object records a new revision; pass the value returned
+    here to :func:`dump` or :func:`save_delta` later to export only what changed since.
+
+    :returns: an int, 0 if nothing has been recorded
+    """
+    db.session.flush()
+    return(serialize.latest_revision(db.session, db.metadata.tables))
+
+
+def _projection(key, only):
+    "Resolve the fields of a collection against the schema of its model, as ``Model.dump`` does."
+    name = serialize.section(key)[1]
+    for model in CachedMarshmallowMixin.__subclasses__():
+        if model.__table__.name == name:
+            return(model._fields(only))
+    raise KeyError(key)
+
+
+def dump(batch_size=None, since=None, fields=None):
+    """
+    Build a dictionary containing the entire Situation.
+
+    Each collection is read with one query, plus one query per association table feeding
+    its nested relationships, instead of one query per object per relationship.
+
+    ``fields`` limits collections to some of their fields, for instance
+    ``{"persons": ["id", "name"], "excerpts": ["id"]}``; only the columns and association
+    tables those fields need are read.  Collections not named are dumped whole.
+
+    When ``since`` is given, only objects changed after that revision are included, along
+    with a ``tombstones`` list of the objects deleted since then and the ``revision`` the
+    delta brings the reader up to.
+
+    :param int batch_size: the number of objects fetched per query, or None for a single query
+    :param int since: a revision from :func:`current_revision`, or None for everything
+    :param dict fields: lists of field names by collection, or None for every field
+    :returns: a Dict with the situation as nested Dictionaries.
+    """
+    "save all the people and everything else"
+    fields = fields or {}
+    projections = dict((key, _projection(key, only)) for key, only in fields.items())
+    db.session.flush()
+    result = {}
+    if since is not None:
+        result["revision"] = current_revision()
+        result["tombstones"] = serialize.tombstones_since(db.session, db.metadata.tables, since)
+    for key, _, _, _ in serialize.SECTIONS:
+        result[key] = []
+        with instrument.scope("dump." + key):
+            for page in serialize.iter_pages(db.session, db.metadata.tables, key, batch_size,
+                    since=since, fields=projections.get(key)):
+                instrument.fetched(len(page))
+                result[key].extend(page)
+    return(result)
+
+
+def iter_dump(batch_size=1000):
+    """
+    Encode the entire Situation as JSON, one piece at a time.
+
+    The concatenated pieces are identical to the output of :func:`save`, but each
+    collection is read in pages so that memory use stays flat as the Situation grows.
+
+    :param int batch_size: the number of objects fetched per query
+    :returns: a generator of JSON strings
+    """
+    db.session.flush()
+
+    def encoded(key):
+        for page in serialize.iter_pages(db.session, db.metadata.tables, key, batch_size):
+            instrument.fetched(len(page))
+            for obj in page:
+                yield serialize.encode(obj, 2)
+
+    return(serialize.iter_json((key, encoded(key)) for key, _, _, _ in serialize.SECTIONS))
+
+
+def save(filename, stream=False, batch_size=1000, format="json", workers=None):
+    """
+    Write the Situation to a JSON file.
+
+    With a ``format`` other than "json", ``filename`` names a directory that receives one
+    column-oriented file per table instead; see :mod:`situation.columnar`.
+
+    With ``workers``, the collections are serialized by a pool of processes, each with its
+    own connection to the database; see :mod:`situation.parallel`.  The session is committed
+    first so that the workers can see every change.
+
+    :param str filename: the name of the file to output to.
+    :param bool stream: write the file incrementally using :func:`iter_dump`
+    :param int batch_size: the number of objects fetched per query when streaming
+    :param str format: "json", or one of "arrow", "parquet" or "npy"
+    :param int workers: the number of processes writing a JSON file, or None for this process only
+    """
+    if workers:
+        if format != "json":
+            raise ValueError("workers are only supported for the json format")
+        db.session.commit()
+        parallel.save(filename, db.engine.url, db.metadata, workers, batch_size)
+        return
+    if format != "json":
+        db.session.flush()
+        columnar.write(db.session, db.metadata.tables, filename, format)
+        return
+    with open(filename, "w") as f:
+        if stream:
+            for chunk in iter_dump(batch_size):
+                f.write(chunk)
+        else:
+            json.dump(dump(), f, indent=True, sort_keys=True)
+
+
+def snapshot():
+    """
+    Read the entire Situation into a compact, read-only snapshot for analysis.
+
+    See :mod:`situation.compact`.
+
+    :returns: a :class:`situation.compact.Snapshot`
+    """
+    db.session.flush()
+    return(compact.Snapshot.build(db.session, db.metadata.tables))
+
+
+def save_delta(filename, since):
+    """
+    Write the changes made to the Situation since a revision to a JSON file.
+
+    :param str filename: the name of the file to output to.
+    :param int since: a revision from :func:`current_revision`
+    :returns: the revision the file brings a reader up to
+    """
+    delta = dump(since=since)
+    with open(filename, "w") as f:
+        json.dump(delta, f, indent=True, sort_keys=True)
+    return(delta["revision"])
+
+
+def update_slugs():
+    """
+    Assign a slug to every object that lacks one, such as rows written before slugs were stored.
+
+    A database created before slugs were stored gains the ``slug`` column first.
+    """
+    migrate.add_columns(db.session.connection(), db.metadata.tables)
+    migrate.backfill_slugs(db.session, db.metadata.tables)
+    db.session.commit()
+
+
+def create_indexes():
+    """
+    Upgrade a database created by an earlier version.
+
+    Missing tables and columns are added and filled in, duplicate links are removed, and
+    the missing indexes are created; see :func:`situation.migrate.upgrade`.
+
+    :returns: a list of the names of the tables, columns and indexes created
+    """
+    created = migrate.upgrade(db.session.connection(), db.metadata.tables)
+    db.session.commit()
+    return(created)
+
+
+def refresh_counts():
+    """
+    Recount every maintained count column, such as ``Group.member_count``.
+
+    Counts are kept up to date automatically; this repairs them after rows were written
+    by other means.
+    """
+    counts.refresh(db.session, db.metadata.tables)
+    db.session.commit()
+
+
+def load(filename):
+    """
+    Read a Situation from a JSON file written by :func:`save`.
+
+    Every collection and association table is restored with bulk inserts inside a single
+    transaction, preserving object ids.  The database should not already contain the objects.
+
+    :param str filename: the name of the file to read from.
+    """
+    with open(filename) as f:
+        situation = json.load(f)
+    try:
+        with counts.suppressed():
+            serialize.restore(db.session, db.metadata.tables, situation)
+        counts.refresh(db.session, db.metadata.tables)
+        revision = _new_revision(db.session)
+        for _, name, _, _ in serialize.SECTIONS:
+            db.session.execute(db.metadata.tables[name].update().values(revision=revision))
+        db.session.commit()
+        if isinstance(_unique_generator, CodeGenerator):
+            _unique_generator.reserve(obj["unique"] for key, _, _, _ in serialize.SECTIONS
+                for obj in situation.get(key, []) if obj.get("unique") is not None)
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def _link_indexes(name, first, second):
+    """
+    Index an association table in both directions.
+
+    The unique index on ``(first, second)`` also prevents duplicate links.
+
+    :param str name: the name of the table
+    :param str first: the column referring to the owner
+    :param str second: the column referring to the target
+    :returns: a list of two indexes
+    """
+    return([
+        db.Index('ix_%s_link' % name, first, second, unique=True),
+        db.Index('ix_%s_reverse' % name, second, first),
+    ])
+
+
+class _BatchState(threading.local):
+    "The batch in progress on this thread, if any."
+
+    depth = 0
+    pending = 0
+    chunk_size = 1000
+
+
+_batch = _BatchState()
+
+
+@contextmanager
+def batch(chunk_size=1000):
+    """
+    Build a Situation without committing each object.
+
+    Within the block, ``create()``, ``save()``, ``delete()`` and the methods built on them,
+    such as :meth:`Person.isa` and :meth:`Acquaintance.add_excerpt`, only add work to the
+    session.  Pending work is flushed every ``chunk_size`` objects and committed once when
+    the block exits, or rolled back if it raises.  Nested blocks join the outermost one.
+
+    ::
+
+        with batch():
+            bob = Person.create(name="Bob")
+            club = Group.create(name="Sports Club")
+            club.members.extend([bob])
+
+    :param int chunk_size: the number of objects to queue between flushes
+    """
+    outermost = _batch.depth == 0
+    if outermost:
+        _batch.chunk_size = chunk_size
+        _batch.pending = 0
+    _batch.depth += 1
+    try:
+        yield
+        if outermost:
+            db.session.commit()
+    except Exception:
+        if outermost:
+            db.session.rollback()
+        raise
+    finally:
+        _batch.depth -= 1
+
+
+class BatchCRUDMixin(CRUDMixin):
+    "CRUDMixin that defers commits while a :func:`batch` is in progress."
+
+    def _queue(self):
+        _batch.pending += 1
+        if _batch.pending >= _batch.chunk_size:
+            db.session.flush()
+            _batch.pending = 0
+
+    def save(self, _commit=True):
+        if not _batch.depth:
+            return super(BatchCRUDMixin, self).save(_commit)
+        db.session.add(self)
+        self._queue()
+        return self
+
+    def delete(self, _commit=True):
+        if not _batch.depth:
+            return super(BatchCRUDMixin, self).delete(_commit)
+        db.session.delete(self)
+        self._queue()
+
+
+class AsyncMixin(object):
+    "Awaitable lookups through :mod:`situation.aio`, which requires Python 3.5 or later."
+
+    @classmethod
+    def aget(cls, ident):
+        """
+        Look up an object without blocking the event loop; see :func:`situation.aio.get`.
+
+        :param ident: the primary key
+        :returns: an awaitable of the detached object, or None
+        """
+        from . import aio
+        return(aio.get(cls, ident))
+
+
+class CachedMarshmallowMixin(MarshmallowMixin):
+    """
+    MarshmallowMixin whose dumps are served from :data:`situation.cache.dump_cache` when it is enabled.
+
+    A dump can be limited to some fields; load the objects with :meth:`projected` so that
+    the columns those fields do not need are not read either::
+
+        [p.dump(only=["id", "name"]) for p in Person.projected(only=["id", "name"])]
+    """
+
+    @classmethod
+    def _fields(cls, only=None, exclude=None):
+        "Resolve a projection against the fields of the schema."
+        names = cls.__dict__.get("_schema_fields")
+        if names is None:
+            names = cls._schema_fields = tuple(cls.__schema__().fields)
+        return(serialize.select_fields(names, only, exclude))
+
+    @classmethod
+    def projected(cls, only=None, exclude=None):
+        """
+        Query objects, loading only the columns needed to dump some fields.
+
+        Other columns, such as long descriptions, are loaded when first accessed.
+
+        :param list only: the fields that will be dumped, or None for all of them
+        :param list exclude: fields that will not be dumped
+        :returns: a query
+        """
+        fields = cls._fields(only, exclude)
+        if fields is None:
+            return(cls.query)
+        mapper = inspect(cls)
+        names = set(column.key for column in mapper.primary_key)
+        for field in fields:
+            if field in mapper.column_attrs:
+                names.add(field)
+            elif field in mapper.relationships and not mapper.relationships[field].uselist:
+                names.update(column.key for column in mapper.relationships[field].local_columns)
+        if "slug" in fields:
+            names.update(["slug", "name"])
+        return(cls.query.options(load_only(*sorted(n for n in names if n in mapper.column_attrs))))
+
+    def dump(self, only=None, exclude=None):
+        """
+        Serialize this object.
+
+        Relationships are only queried for the fields that are dumped.
+
+        :param list only: the fields to include, or None for all of them
+        :param list exclude: fields to leave out
+        :returns: a Dict
+        """
+        if only is None and not exclude:
+            with instrument.scope(type(self).__name__):
+                return dump_cache.dump(self, super(CachedMarshmallowMixin, self).dump)
+        fields = self._fields(only, exclude)
+        if fields is None:
+            return(self.dump())
+
+        def build():
+            return(self.__schema__(only=sorted(fields)).dump(self).data)
+
+        with instrument.scope(type(self).__name__):
+            return dump_cache.dump(self, build, fields)
+
+
+class RevisionMixin(object):
+    "Records the revision in which an object last changed."
+
+    revision = db.Column(db.Integer, index=True)
+
+
+class CountMixin(object):
+    "Ranks objects by the counts maintained in :mod:`situation.counts`."
+
+    @classmethod
+    def top(cls, column, k=10):
+        """
+        Find the objects with the largest count.
+
+        ::
+
+            Group.top("member_count", k=5)
+
+        :param str column: the name of a count column, such as "member_count"
+        :param int k: the number of objects to return
+        :returns: a list of objects, largest count first
+        """
+        count = getattr(cls, column)
+        return(cls.query.order_by(count.desc(), cls.id).limit(k).all())
+
+
+def _count_column():
+    "Create a maintained count column."
+    return(db.Column(db.Integer, nullable=False, default=0, server_default="0", index=True))
+
+
+class SlugMixin(object):
+    """
+    Stores a URL-friendly identifier derived from the name.
+
+    The slug is assigned when the object is flushed and whenever its name changes.  When
+    another object of the same kind already has the slug, a numeric suffix is added.
+    """
+
+    slug = db.Column(db.String(serialize.SLUG_LENGTH), unique=True)
+
+    @classmethod
+    def find_by_slug(cls, slug):
+        """
+        Look up an object by its slug.
+
+        :param str slug: the slug
+        :returns: the object, or None
+        """
+        return(cls.query.filter_by(slug=slug).first())
+
+
+class ResourceSchema(ma.Schema):
+    "Description"
+
+    class Meta:
+        additional = ("id", "unique", "name", "url", "publisher", "author", "description")
+
+
+class Resource(db.Model, BatchCRUDMixin, CachedMarshmallowMixin, RevisionMixin, AsyncMixin):
+    """
+    A Resource is an authoritative information source from which evidence is drawn.
+
+    Usually, a Resource is an artifact like a newspaper article, a report, or another
+    document.  These documents usually have an associated URL.
+
+    Any time an Excerpt is used, that Excerpt must be directly quotable from a Resource.
+
+    :param int id: the database object identifier
+    :param str unique: alpha-numeric code for shorthand identifier
+    :param str name: what the resource is called
+    :param str url: the canonical URL for the resource
+    :param str publisher: the name of the institution reputationally backing this resource
+    :param str author: the name of the author(s)
+    :param str description: a short summary of this resource
+    """
+
+    __schema__ = ResourceSchema
+    id = db.Column(db.Integer, primary_key=True)
+    unique = db.Column(db.String(255), unique=True, default=generate_unique)
+    name = db.Column(db.String(4096))
+    url = db.Column(db.String(4096))
+    publisher = db.Column(db.String(4096))
+    author = db.Column(db.String(4096))
+    description = db.Column(db.String(8**7))
+
+    def __str__(self):
+        return(self.url)
+
+
+class ExcerptSchema(ma.Schema):
+    "Description"
+
+    class Meta:
+        additional = ("id", "unique", "content", "resource_id", "xpath")
+
+
+class Excerpt(db.Model, BatchCRUDMixin, CachedMarshmallowMixin, RevisionMixin, AsyncMixin):
+    """
+    Description.
+
+    :param int id: the database object identifier
+    :param str unique: alpha-numeric code for shorthand identifier
+    :param str content: the actual quoted material of the excerpt
+    :param Resource resource: the Resource from which this excerpt comes
+    :param str xpath: the xpath leading to this excerpt within the Resource
+    """
+
+    __schema__ = ExcerptSchema
+    id = db.Column(db.Integer, primary_key=True)
+    unique = db.Column(db.String(255), unique=True, default=generate_unique)
+    content = db.Column(db.String(8**7))
+    resource = db.relationship('Resource', backref='excerpts')
+    resource_id = db.Column(db.Integer, db.ForeignKey('resource.id'), nullable=False, index=True)
+    xpath = db.Column(db.String(4096))
+
+    def __str__(self):
+        return(self.content)
+
+
+class AcquaintanceExcerpt(db.Model, BatchCRUDMixin):
+    "Excerpts."
+
+    __tablename__ = 'acquaintance_excerpts'
+    __table_args__ = (
+        db.ForeignKeyConstraint(
+            ['person_id', 'acquainted_id'],
+            ['acquaintance.person_id', 'acquaintance.acquainted_id']
+        ),
+        db.Index('ix_acquaintance_excerpts_link', 'person_id', 'acquainted_id', 'excerpt_id',
+            unique=True),
+        db.Index('ix_acquaintance_excerpts_reverse', 'excerpt_id', 'person_id', 'acquainted_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    excerpt_id = db.Column(db.Integer, db.ForeignKey('excerpt.id'), nullable=False)
+    person_id = db.Column(db.Integer, db.ForeignKey('person.id'), nullable=False)
+    acquainted_id = db.Column(db.Integer, db.ForeignKey('person.id'), nullable=False)
+
+"Excerpts."
+persons_excerpts = db.Table('persons_excerpts',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('person_id', db.Integer, db.ForeignKey('person.id')),
+    db.Column('excerpt_id', db.Integer, db.ForeignKey('excerpt.id')),
+    *_link_indexes('persons_excerpts', 'person_id', 'excerpt_id')
+)
+
+"Excerpts."
+places_excerpts = db.Table('places_excerpts',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('place_id', db.Integer, db.ForeignKey('place.id')),
+    db.Column('excerpt_id', db.Integer, db.ForeignKey('excerpt.id')),
+    *_link_indexes('places_excerpts', 'place_id', 'excerpt_id')
+)
+
+"Excerpts."
+items_excerpts = db.Table('items_excerpts',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('item_id', db.Integer, db.ForeignKey('item.id')),
+    db.Column('excerpt_id', db.Integer, db.ForeignKey('excerpt.id')),
+    *_link_indexes('items_excerpts', 'item_id', 'excerpt_id')
+)
+
+"Excerpts."
+events_excerpts = db.Table('events_excerpts',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('event_id', db.Integer, db.ForeignKey('event.id')),
+    db.Column('excerpt_id', db.Integer, db.ForeignKey('excerpt.id')),
+    *_link_indexes('events_excerpts', 'event_id', 'excerpt_id')
+)
+
+"Excerpts."
+groups_excerpts = db.Table('groups_excerpts',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('group_id', db.Integer, db.ForeignKey('group.id')),
+    db.Column('excerpt_id', db.Integer, db.ForeignKey('excerpt.id')),
+    *_link_indexes('groups_excerpts', 'group_id', 'excerpt_id')
+)
+
+
+class PersonSchema(ma.Schema):
+    "Description"
+
+    slug = instrument.Method("get_slugify")
+    excerpts = instrument.Nested('ExcerptSchema', allow_none=True, many=True, only=["id"])
+    events = instrument.Nested('EventSchema', allow_none=True, many=True, only=["id"])
+    places = instrument.Nested('PlaceSchema', allow_none=True, many=True, only=["id"])
+    possessions = instrument.Nested('ItemSchema', allow_none=True, many=True, only=["id"])
+    properties = instrument.Nested('PlaceSchema', allow_none=True, many=True, only=["id"])
+    groups = instrument.Nested('GroupSchema', allow_none=True, many=True, only=["id"])
+    acquaintances = instrument.Method("get_acquaintances")
+
+    # TODO: this is a nested query
+    # "encounters": [i.id for e in self.events for i in e.items],
+
+    def get_slugify(self, obj):
+        return(obj.slug if obj.slug is not None else slugify(obj.name))
+
+    def get_acquaintances(self, obj):
+        return([{"id": a.acquainted_id} for a in obj.acquaintances])
+
+    class Meta:
+        additional = ("id", "name", "alias", "unique")
+
+
+class Person(db.Model, BatchCRUDMixin, CachedMarshmallowMixin, RevisionMixin, SlugMixin,
+        CountMixin, AsyncMixin):
+    """
+    Description.
+
+    :param int id: the database object identifier
+    :param str unique: alpha-numeric code for shorthand identifier
+    :param str name: what the person is called
+    :param str alias: that *other* thing the person is called
+    :param str slug: a URL-friendly identifier
+    :param [Excerpt] excerpts: null
+    :param [Event] events: null
+    :param [Place] places: null
+    :param [Item] possessions: null
+    :param [Place] properties: null
+    :param [Group] groups: null
+    :param [Acquaintance] acquaintances: null
+    :param int acquaintance_count: the number of acquaintances the person has, as in ``acquaintances``
+    :param int event_count: the number of events the person took part in
+    :param int excerpt_count: the number of excerpts about the person
+    """
+
+    __schema__ = PersonSchema
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(255))
+    alias = db.Column(db.String(255))
+    unique = db.Column(db.String(255), unique=True, default=generate_unique)
+    excerpts = db.relationship('Excerpt', secondary="persons_excerpts", lazy='dynamic')
+    acquaintance_count = _count_column()
+    event_count = _count_column()
+    excerpt_count = _count_column()
+
+    def timeline(self):
+        """
+        List the events this person took part in.
+
+        :returns: a query ordered by timestamp
+        """
+        return(Event.query.join(events_actors, events_actors.c.event_id == Event.id)
+            .filter(events_actors.c.actor_id == self.id)
+            .order_by(Event.timestamp, Event.id))
+
+    def isa(self, isa_type, of=None):
+        e = Acquaintance(person=self, isa=isa_type, acquainted=of)
+        result = e.save()
+        return result
+
+    def __str__(self):
+        return(self.name)
+
+
+class AcquaintanceSchema(ma.Schema):
+    "Description"
+
+    excerpts = instrument.Nested('ExcerptSchema', allow_none=True, many=True, only=["id"])
+    person = instrument.Nested('PersonSchema', only=["id"])
+    acquainted = instrument.Nested('PersonSchema', only=["id"])
+
+    class Meta:
+        additional = ("isa",)
+
+
+class Acquaintance(db.Model, BatchCRUDMixin, CachedMarshmallowMixin, RevisionMixin, AsyncMixin):
+    """
+    Description.
+
+    :param int id: the database object identifier
+    :param int :
+    :param int :
+    :param int :
+    :param int :
+    :param int :
+    """
+
+    __schema__ = AcquaintanceSchema
+    isa = db.Column(db.String(64))
+    excerpts = db.relationship('Excerpt', secondary="acquaintance_excerpts", lazy='dynamic')
+    person_id = db.Column(db.Integer(), db.ForeignKey('person.id'), primary_key=True)
+    person = db.relationship(Person, primaryjoin=person_id == Person.id, backref='acquaintances')
+    acquainted_id = db.Column(db.Integer(), db.ForeignKey('person.id'), primary_key=True)
+    acquainted = db.relationship(Person, primaryjoin=acquainted_id == Person.id)
+
+    def add_excerpt(self, excerpt):
+        if excerpt.id is None or self.person_id is None or self.acquainted_id is None:
+            db.session.flush()
+        annotation = AcquaintanceExcerpt.create(
+            excerpt_id=excerpt.id,
+            person_id=self.person_id,
+            acquainted_id=self.acquainted_id
+            )
+        return annotation
+
+    def __str__(self):
+        return("%s isa %s of %s)" % (self.person, self.isa, self.acquainted))
+
+
+class PlaceSchema(ma.Schema):
+    "Description"
+
+    slug = instrument.Method("get_slugify")
+    excerpts = instrument.Nested('ExcerptSchema', allow_none=True, many=True, only=["id"])
+    events = instrument.Nested('EventSchema', allow_none=True, many=True, only=["id"])
+    owners = instrument.Nested('PersonSchema', allow_none=True, many=True, only=["id"])
+
+    def get_slugify(self, obj):
+        return(obj.slug if obj.slug is not None else slugify(obj.name))
+
+    class Meta:
+        additional = ("id", "unique", "name", "description", "address", "lat", "lon")
+
+
+class Place(db.Model, BatchCRUDMixin, CachedMarshmallowMixin, RevisionMixin, SlugMixin,
+        CountMixin, AsyncMixin):
+    """
+    Description.
+
+    :param int id: the database object identifier
+    :param str unique: alpha-numeric code for shorthand identifier
+    :param str name: what the place is called
+    :param int event_count: the number of events at the place
+    :param int excerpt_count: the number of excerpts about the place
+    :param int :
+    :param int :
+    :param int :
+    :param int :
+    :param int :
+    :param int :
+    """
+
+    __schema__ = PlaceSchema
+    id = db.Column(db.Integer, primary_key=True)
+    unique = db.Column(db.String(255), unique=True, default=generate_unique)
+    name = db.Column(db.String(255))
+    description = db.Column(db.String(8**7))
+    address = db.Column(db.String(4096))
+    lat = db.Column(db.Float())
+    lon = db.Column(db.Float())
+    owners = db.relationship('Person', secondary="places_owners", lazy='dynamic',
+        backref="properties")
+    excerpts = db.relationship('Excerpt', secondary="places_excerpts", lazy='dynamic')
+    event_count = _count_column()
+    excerpt_count = _count_column()
+
+    __table_args__ = (
+        db.Index('ix_place_lat_lon', 'lat', 'lon'),
+    )
+
+    def timeline(self):
+        """
+        List the events that happened at this place.
+
+        :returns: a query ordered by timestamp
+        """
+        return(Event.query.filter(Event.place_id == self.id).order_by(Event.timestamp, Event.id))
+
+    def distance_to(self, lat, lon):
+        """
+        Compute the distance from this place to a point.
+
+        :param float lat: latitude in degrees
+        :param float lon: longitude in degrees
+        :returns: the great-circle distance in kilometres
+        """
+        return(geo.distance_km(self.lat, self.lon, lat, lon))
+
+    @classmethod
+    def bbox_clause(cls, south, north, ranges):
+        """
+        Build a clause selecting places within a latitude/longitude box.
+
+        :param float south: the southern edge in degrees
+        :param float north: the northern edge in degrees
+        :param list ranges: (west, east) longitude intervals, as from :func:`situation.geo.lon_ranges`
+        :returns: a SQLAlchemy clause
+        """
+        return(db.and_(cls.lat.between(south, north),
+            db.or_(*[cls.lon.between(west, east) for west, east in ranges])))
+
+    @classmethod
+    def in_bbox(cls, south, west, north, east):
+        """
+        Find the places within a latitude/longitude box.
+
+        A box whose western edge is east of its eastern edge crosses the antimeridian.
+
+        :param float south: the southern edge in degrees
+        :param float west: the western edge in degrees
+        :param float north: the northern edge in degrees
+        :param float east: the eastern edge in degrees
+        :returns: a query
+        """
+        return(cls.query.filter(cls.bbox_clause(south, north, geo.lon_ranges(west, east))))
+
+    @classmethod
+    def within_radius(cls, lat, lon, km):
+        """
+        Find the places within a distance of a point.
+
+        :param float lat: latitude of the centre in degrees
+        :param float lon: longitude of the centre in degrees
+        :param float km: the radius in kilometres
+        :returns: a list of places, nearest first
+        """
+        south, north, ranges = geo.bounding_box(lat, lon, km)
+        candidates = cls.query.filter(cls.bbox_clause(south, north, ranges))
+        found = [(place.distance_to(lat, lon), place) for place in candidates]
+        found.sort(key=lambda pair: pair[0])
+        return([place for distance, place in found if distance <= km])
+
+    @classmethod
+    def nearest(cls, lat, lon, k=1, km=1.0):
+        """
+        Find the places nearest to a point.
+
+        The search radius starts at ``km`` and grows until ``k`` places are found.
+
+        :param float lat: latitude in degrees
+        :param float lon: longitude in degrees
+        :param int k: the number of places to find
+        :param float km: the initial search radius in kilometres
+        :returns: a list of at most ``k`` places, nearest first
+        """
+        while True:
+            found = cls.within_radius(lat, lon, km)
+            if len(found) >= k or km >= geo.EARTH_RADIUS_KM * 3.15:
+                return(found[:k])
+            km *= 4
+
+    def __str__(self):
+        return(self.name)
+
+places_owners = db.Table('places_owners',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('place_id', db.Integer, db.ForeignKey('place.id')),
+    db.Column('owner_id', db.Integer, db.ForeignKey('person.id')),
+    *_link_indexes('places_owners', 'place_id', 'owner_id')
+)
+
+
+class ItemSchema(ma.Schema):
+    "Description"
+
+    slug = instrument.Method("get_slugify")
+    excerpts = instrument.Nested('ExcerptSchema', allow_none=True, many=True, only=["id"])
+    owners = instrument.Nested('PersonSchema', allow_none=True, many=True, only=["id"])
+
+    def get_slugify(self, obj):
+        return(obj.slug if obj.slug is not None else slugify(obj.name))
+
+    class Meta:
+        additional = ("id", "unique", "name", "description")
+
+
+class Item(db.Model, BatchCRUDMixin, CachedMarshmallowMixin, RevisionMixin, SlugMixin, AsyncMixin):
+    """
+    Description.
+
+    :param int id: the database object identifier
+    :param str unique: alpha-numeric code for shorthand identifier
+    :param str name: what the item is called
+    :param int :
+    :param int :
+    :param int :
+    """
+
+    __schema__ = ItemSchema
+    id = db.Column(db.Integer, primary_key=True)
+    unique = db.Column(db.String(255), unique=True, default=generate_unique)
+    name = db.Column(db.String(255))
+    description = db.Column(db.String(8**7))
+    owners = db.relationship('Person', secondary="items_owners", lazy='dynamic', backref="items")
+    excerpts = db.relationship('Excerpt', secondary="items_excerpts", lazy='dynamic')
+
+    def __str__(self):
+        return(self.name)
+
+items_owners = db.Table('items_owners',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('item_id', db.Integer, db.ForeignKey('item.id')),
+    db.Column('owner_id', db.Integer, db.ForeignKey('person.id')),
+    *_link_indexes('items_owners', 'item_id', 'owner_id')
+)
+
+
+class GroupSchema(ma.Schema):
+    slug = instrument.Method("get_slugify")
+    excerpts = instrument.Nested('ExcerptSchema', allow_none=True, many=True, only=["id"])
+    members = instrument.Nested('PersonSchema', allow_none=True, many=True, only=["id"])
+
+    def get_slugify(self, obj):
+        return(obj.slug if obj.slug is not None else slugify(obj.name))
+
+    class Meta:
+        additional = ("id", "unique", "name")
+
+
+class Group(db.Model, BatchCRUDMixin, CachedMarshmallowMixin, RevisionMixin, SlugMixin,
+        CountMixin, AsyncMixin):
+    """
+    Description.
+
+    :param int id: the database object identifier
+    :param str unique: alpha-numeric code for shorthand identifier
+    :param str name: what the group is called
+    :param int member_count: the number of members
+    :param int excerpt_count: the number of excerpts about the group
+    :param int :
+    :param int :
+    """
+
+    __schema__ = GroupSchema
+    id = db.Column(db.Integer, primary_key=True)
+    unique = db.Column(db.String(255), unique=True, default=generate_unique)
+    name = db.Column(db.String(255))
+    members = db.relationship('Person', secondary="groups_members", lazy='dynamic',
+        backref="groups")
+    excerpts = db.relationship('Excerpt', secondary="groups_excerpts", lazy='dynamic')
+    member_count = _count_column()
+    excerpt_count = _count_column()
+
+    def __str__(self):
+        return self.name
+
+groups_members = db.Table('groups_members',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('group_id', db.Integer, db.ForeignKey('group.id')),
+    db.Column('member_id', db.Integer, db.ForeignKey('person.id')),
+    *_link_indexes('groups_members', 'group_id', 'member_id')
+)
+
+
+class EventSchema(ma.Schema):
+    slug = instrument.Method("get_slugify")
+    timestamp = instrument.Method("get_timestamp")
+    excerpts = instrument.Nested('ExcerptSchema', allow_none=True, many=True, only=["id"])
+    items = instrument.Nested('ItemSchema', allow_none=True, many=True, only=["id"])
+    actors = instrument.Nested('PersonSchema', allow_none=True, many=True, only=["id"])
+
+    def get_slugify(self, obj):
+        return(obj.slug if obj.slug is not None else slugify(obj.name))
+
+    def get_timestamp(self, obj):
+        return(serialize.timestamp(obj.timestamp))
+
+    class Meta:
+        additional = ("id", "unique", "name", "phone", "description", "place_id")
+
+
+class Event(db.Model, BatchCRUDMixin, CachedMarshmallowMixin, RevisionMixin, SlugMixin,
+        CountMixin, AsyncMixin):
+    """
+    Description.
+
+    :param int id: the database object identifier
+    :param str unique: alpha-numeric code for shorthand identifier
+    :param str name: what the event is called
+    :param int actor_count: the number of actors
+    :param int excerpt_count: the number of excerpts about the event
+    :param int :
+    :param int :
+    :param int :
+    :param int :
+    :param int :
+    :param int :
+    :param int :
+    """
+
+    __schema__ = EventSchema
+    id = db.Column(db.Integer, primary_key=True)
+    unique = db.Column(db.String(255), unique=True, default=generate_unique)
+    name = db.Column(db.String(255))
+    description = db.Column(db.String(8**7))
+    place_id = db.Column(db.Integer, db.ForeignKey('place.id'), index=True)
+    place = db.relationship("Place", backref="events")
+    phone = db.Column(db.Boolean(), default=False)
+    timestamp = db.Column(db.DateTime(), index=True)
+    actors = db.relationship('Person', secondary="events_actors", lazy='dynamic', backref="events")
+    excerpts = db.relationship('Excerpt', secondary="events_excerpts", lazy='dynamic')
+    items = db.relationship('Item', secondary="events_items", lazy='dynamic')
+    actor_count = _count_column()
+    excerpt_count = _count_column()
+
+    @classmethod
+    def between(cls, start, end):
+        """
+        Find the events in a time range.
+
+        :param datetime start: the inclusive start of the range
+        :param datetime end: the exclusive end of the range
+        :returns: a query ordered by timestamp
+        """
+        return(cls.query.filter(cls.timestamp >= start, cls.timestamp < end)
+            .order_by(cls.timestamp, cls.id))
+
+    @classmethod
+    def histogram(cls, bucket="day", start=None, end=None):
+        """
+        Count events per time bucket.
+
+        Only the indexed timestamp column is read.
+
+        :param str bucket: one of "hour", "day", "week", "month" or "year"
+        :param datetime start: the inclusive start of the range, or None
+        :param datetime end: the exclusive end of the range, or None
+        :returns: a list of (bucket start, count) pairs in time order, omitting empty buckets
+        """
+        return(Timeline.load(start=start, end=end).counts(bucket))
+
+    @classmethod
+    def near(cls, lat, lon, km):
+        """
+        Find the events whose place is within a distance of a point.
+
+        :param float lat: latitude of the centre in degrees
+        :param float lon: longitude of the centre in degrees
+        :param float km: the radius in kilometres
+        :returns: a list of events, nearest first
+        """
+        south, north, ranges = geo.bounding_box(lat, lon, km)
+        candidates = cls.query.join(Place, cls.place_id == Place.id) \
+            .filter(Place.bbox_clause(south, north, ranges)) \
+            .options(db.contains_eager(cls.place))
+        found = [(event.place.distance_to(lat, lon), event) for event in candidates]
+        found.sort(key=lambda pair: pair[0])
+        return([event for distance, event in found if distance <= km])
+
+    def __str__(self):
+        return self.name
+
+events_actors = db.Table('events_actors',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('event_id', db.Integer, db.ForeignKey('event.id')),
+    db.Column('actor_id', db.Integer, db.ForeignKey('person.id')),
+    *_link_indexes('events_actors', 'event_id', 'actor_id')
+)
+
+events_items = db.Table('events_items',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('event_id', db.Integer, db.ForeignKey('event.id')),
+    db.Column('item_id', db.Integer, db.ForeignKey('item.id')),
+    *_link_indexes('events_items', 'event_id', 'item_id')
+)
+
+revisions = db.Table('revisions',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('created', db.DateTime, nullable=False)
+)
+
+tombstones = db.Table('tombstones',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('revision', db.Integer, nullable=False, index=True),
+    db.Column('kind', db.String(32), nullable=False),
+    db.Column('key', db.String(255), nullable=False)
+)
+
+
+def _new_revision(conn):
+    "Record a new revision and return its number."
+    result = conn.execute(revisions.insert().values(created=datetime.utcnow()))
+    return(result.inserted_primary_key[0])
+
+
+def _kind(obj):
+    "Find the collection an object is dumped in."
+    for key, name, _, _ in serialize.SECTIONS:
+        if name == obj.__table__.name:
+            return(key)
+
+
+@event.listens_for(Session, "before_flush")
+def _track_revisions(session, flush_context, instances):
+    """
+    Stamp every changed object with a new revision and record tombstones for deletions.
+
+    Objects on the other end of a changed relationship are stamped too, since their nested
+    id lists change as well.
+    """
+    touched = {}
+
+    def touch(obj):
+        if isinstance(obj, RevisionMixin) and obj not in session.deleted:
+            touched[id(obj)] = obj
+
+    def touch_related(obj):
+        state = inspect(obj)
+        for relationship in state.mapper.relationships:
+            history = state.attrs[relationship.key].history
+            for other in chain(history.added or (), history.deleted or ()):
+                if other is not None:
+                    touch(other)
+
+    for obj in session.new:
+        touch(obj)
+        touch_related(obj)
+    for obj in session.dirty:
+        if session.is_modified(obj):
+            touch(obj)
+            touch_related(obj)
+    deleted = [obj for obj in session.deleted if isinstance(obj, RevisionMixin)]
+    for obj in deleted:
+        touch_related(obj)
+    annotations = [obj for obj in chain(session.new, session.deleted)
+        if isinstance(obj, AcquaintanceExcerpt)]
+    if not (touched or deleted or annotations):
+        return
+
+    conn = session.connection()
+    revision = _new_revision(conn)
+    for obj in touched.values():
+        obj.revision = revision
+    if deleted:
+        conn.execute(tombstones.insert(), [
+            {"revision": revision, "kind": _kind(obj), "key": json.dumps(list(inspect(obj).identity))}
+            for obj in deleted])
+    table = Acquaintance.__table__
+    for obj in annotations:
+        conn.execute(table.update().where(db.and_(
+            table.c.person_id == obj.person_id,
+            table.c.acquainted_id == obj.acquainted_id)).values(revision=revision))
+
+
+@event.listens_for(Session, "before_flush")
+def _assign_slugs(session, flush_context, instances):
+    "Give new and renamed objects a slug that no other object of their kind has."
+    def stale(obj):
+        attrs = inspect(obj).attrs
+        if obj.slug is None:
+            return(True)
+        return(attrs.name.history.has_changes() and not attrs.slug.history.has_changes())
+
+    objs = [obj for obj in chain(session.new, session.dirty)
+        if isinstance(obj, SlugMixin) and obj.name is not None and stale(obj)]
+    taken = {}
+    for obj in objs:
+        table = obj.__table__
+        base = (slugify(obj.name) or table.name)[:serialize.SLUG_LENGTH]
+        if table.name not in taken:
+            taken[table.name] = set()
+        conditions = [table.c.slug == base, table.c.slug.like(base + "-%")]
+        # a long base is cut short to make room for its suffix; match what any suffix keeps
+        stem = base[:serialize.SLUG_LENGTH - 11].rstrip("-")
+        if len(stem) < len(base):
+            conditions.append(table.c.slug.like(stem + "%"))
+        query = db.select([table.c.slug]).where(db.or_(*conditions))
+        if obj.id is not None:
+            query = query.where(table.c.id != obj.id)
+        existing = set(row[0] for row in session.connection().execute(query))
+        obj.slug = serialize.unique_slug(base, existing | taken[table.name])
+        taken[table.name].add(obj.slug)
+
+
+counts.install([Event, Group, Person, Place])
+for _model in (Event, Excerpt, Item, Place, Resource):
+    textstore.watch(_model)
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# situation (c) Ian Dennis Miller
+
+"""
+Export of a Situation by a pool of processes.
+
+The collections are split into slices, each a range of the leading ordering
+column of at most ``slice_size`` objects.  Every worker process opens its own
+engine on the same database, reflects its tables as :mod:`situation.core` does,
+serializes the slices it is given, and returns the encoded objects; the parent
+writes the fragments in the order :func:`situation.dump` uses, so the file is
+identical to the one written by a single process.
+
+Workers read committed data only, each in its own transaction, so the database
+should not be written to while an export is running.  The functions in
+:data:`situation.serialize.row_hooks`, such as the one installed by
+:mod:`situation.textstore`, are handed to every worker, so they must be
+module-level functions that can be pickled.  An in-memory SQLite database
+cannot be shared with other processes.
+"""
+
+import multiprocessing
+from itertools import groupby
+from sqlalchemy import MetaData, create_engine, func, select
+from sqlalchemy.engine.url import make_url
+
+from . import serialize
+
+"The engine and tables of a worker process."
+_worker = {}
+
+
+def plan(conn, tables, slice_size=50000):
+    """
+    Split every collection into slices.
+
+    Each boundary is found from the previous one by skipping ``slice_size`` rows of the
+    index on the ordering columns, so planning reads every row once rather than scanning
+    from the start for every slice.
+
+    :param conn: a session or connection
+    :param dict tables: table objects by name
+    :param int slice_size: the largest number of objects in a slice, unless more objects share a value of the leading ordering column
+    :returns: a list of (key, first, last) tuples in dump order, where ``first`` and ``last`` bound the leading ordering column and None means unbounded
+    """
+    tasks = []
+    for key, name, ordering, _ in serialize.SECTIONS:
+        table = tables[name]
+        keys = [table.c[c] for c in ordering]
+        bounds = []
+        while True:
+            query = select([keys[0]]).order_by(*keys)
+            if bounds:
+                query = query.where(keys[0] >= bounds[-1])
+            value = conn.execute(query.offset(slice_size).limit(1)).scalar()
+            if value is not None and bounds and value == bounds[-1]:
+                value = conn.execute(select([func.min(keys[0])])
+                    .where(keys[0] > bounds[-1])).scalar()
+            if value is None:
+                break
+            bounds.append(value)
+        edges = [None] + bounds + [None]
+        tasks.extend((key, edges[i], edges[i + 1]) for i in range(len(edges) - 1))
+    return(tasks)
+
+
+def _check(url):
+    "Refuse databases that other processes cannot open."
+    url = make_url(url)
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        raise ValueError("an in-memory SQLite database cannot be exported by several processes")
+    return(url)
+
+
+def _start(url, row_hooks):
+    "Open the engine of a worker process and install the row hooks of its parent."
+    _worker["engine"] = create_engine(url)
+    metadata = MetaData()
+    metadata.reflect(bind=_worker["engine"])
+    _worker["tables"] = metadata.tables
+    serialize.row_hooks[:] = row_hooks
+
+
+def _fragment(task):
+    "Serialize one slice, returning its key and the encoded objects joined as in a JSON list."
+    key, first, last, batch_size = task
+    encoded = []
+    with _worker["engine"].connect() as conn:
+        for page in serialize.iter_pages(conn, _worker["tables"], key, batch_size,
+                first=first, last=last):
+            encoded.extend(serialize.encode(obj, 2) for obj in page)
+    return(key, ",\n  ".join(encoded))
+
+
+def iter_json(url, tasks, workers, batch_size=1000):
+    """
+    Encode a Situation as JSON using a pool of processes.
+
+    :param url: the database URL
+    :param list tasks: slices from :func:`plan`
+    :param int workers: the number of processes
+    :param int batch_size: the number of objects fetched per query
+    :returns: a generator of JSON strings, identical when joined to the output of :func:`situation.iter_dump`
+    """
+    url = _check(url)
+    pool = multiprocessing.Pool(workers, _start, (url, list(serialize.row_hooks)))
+    try:
+        fragments = pool.imap(_fragment, [task + (batch_size,) for task in tasks])
+        collections = ((key, (text for _, text in group if text))
+            for key, group in groupby(fragments, key=lambda fragment: fragment[0]))
+        for chunk in serialize.iter_json(collections):
+            yield chunk
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def save(filename, url, metadata, workers, batch_size=1000, slice_size=50000):
+    """
+    Write a Situation to a JSON file using a pool of processes.
+
+    :param str filename: the name of the file to output to
+    :param url: the database URL
+    :param metadata: the MetaData holding the Situation tables
+    :param int workers: the number of processes
+    :param int batch_size: the number of objects fetched per query
+    :param int slice_size: the largest number of objects serialized by one task
+    """
+    engine = create_engine(_check(url))
+    try:
+        with engine.connect() as conn:
+            tasks = plan(conn, metadata.tables, slice_size)
+    finally:
+        engine.dispose()
+    with open(filename, "w") as f:
+        for chunk in iter_json(url, tasks, workers, batch_size):
+            f.write(chunk)
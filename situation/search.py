@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+# situation (c) Ian Dennis Miller
+
+"""
+Full-text search over Excerpt content and Resource metadata.
+
+Call :func:`enable` once the database exists.  On SQLite builds with FTS5 the
+index is a pair of FTS5 tables ranked by BM25; elsewhere it is the
+``search_terms`` table, an inverted index of tokens ranked by TF-IDF.  The
+FTS5 tables are created and dropped along with the other tables by
+``db.create_all()`` and ``db.drop_all()``.
+
+The index is kept up to date from the revisions every flush records: the
+``search_state`` table holds the revision the index was last brought up to,
+and :func:`refresh`, which every search calls first, indexes again the
+Excerpts and Resources changed since then and removes those deleted since
+then.  Writes by any process, including :func:`situation.load`, are picked
+up, and :func:`enable` only indexes what changed while no process searched.
+A search runs in the session's transaction, so commit it to keep the work.
+
+::
+
+    search.enable()
+    for hit in search.search_excerpts("incident"):
+        print(hit["id"], hit["persons"])
+"""
+
+import math
+import re
+from sqlalchemy import DDL, and_, distinct, event, func, select, text
+from sqlalchemy.exc import OperationalError
+from . import db, serialize, Excerpt, Resource
+
+"Indexed documents: (kind, model, columns)."
+DOCUMENTS = (
+    ("excerpts", Excerpt, ("content",)),
+    ("resources", Resource, ("name", "author", "publisher", "description")),
+)
+
+"The indexed columns of each kind of document."
+COLUMNS = dict((kind, columns) for kind, _, columns in DOCUMENTS)
+
+"Objects linked to excerpts: (field, association table, column)."
+EXCERPT_LINKS = (
+    ("persons", "persons_excerpts", "person_id"),
+    ("events", "events_excerpts", "event_id"),
+    ("places", "places_excerpts", "place_id"),
+    ("items", "items_excerpts", "item_id"),
+    ("groups", "groups_excerpts", "group_id"),
+)
+
+TOKEN = re.compile(r"\w+", re.UNICODE)
+
+search_terms = db.Table('search_terms',
+    db.Column('kind', db.String(16), nullable=False),
+    db.Column('term', db.String(255), nullable=False),
+    db.Column('doc_id', db.Integer, nullable=False),
+    db.Column('weight', db.Integer, nullable=False),
+    db.Index('ix_search_terms_kind_term', 'kind', 'term'),
+    db.Index('ix_search_terms_kind_doc', 'kind', 'doc_id'),
+)
+
+search_documents = db.Table('search_documents',
+    db.Column('kind', db.String(16), primary_key=True),
+    db.Column('total', db.Integer, nullable=False),
+)
+
+"The revision each kind of index was last brought up to."
+search_state = db.Table('search_state',
+    db.Column('name', db.String(16), primary_key=True),
+    db.Column('revision', db.Integer, nullable=False),
+)
+
+
+def tokenize(value):
+    """
+    Split text into lower-case search terms.
+
+    :param str value: the text
+    :returns: a list of strings
+    """
+    return([token.lower() for token in TOKEN.findall(value or "")])
+
+
+class TermIndex(object):
+    """
+    An inverted index stored in the ``search_terms`` table.
+
+    The number of indexed documents of each kind, which every query needs, is kept in
+    the ``search_documents`` table and updated with the postings.
+    """
+
+    name = "terms"
+
+    def create(self, conn):
+        search_terms.create(bind=conn, checkfirst=True)
+        search_documents.create(bind=conn, checkfirst=True)
+
+    def _count(self, conn, kind):
+        return(conn.execute(select([func.count(distinct(search_terms.c.doc_id))])
+            .where(search_terms.c.kind == kind)).scalar() or 0)
+
+    def _adjust(self, conn, kind, delta):
+        "Add to the number of documents, counting them if no total is stored yet."
+        total = search_documents.c.total
+        if conn.execute(search_documents.update().where(search_documents.c.kind == kind)
+                .values(total=total + delta)).rowcount == 0:
+            conn.execute(search_documents.insert(), {"kind": kind,
+                "total": self._count(conn, kind)})
+
+    def total(self, conn, kind):
+        """
+        Find the number of indexed documents of a kind.
+
+        :param conn: a session or connection
+        :param str kind: "excerpts" or "resources"
+        :returns: an int
+        """
+        total = conn.execute(select([search_documents.c.total])
+            .where(search_documents.c.kind == kind)).scalar()
+        return(total if total is not None else self._count(conn, kind))
+
+    def add(self, conn, kind, doc_id, values):
+        counts = {}
+        for value in values:
+            for term in tokenize(value):
+                counts[term] = counts.get(term, 0) + 1
+        if counts:
+            conn.execute(search_terms.insert(), [
+                {"kind": kind, "term": term[:255], "doc_id": doc_id, "weight": weight}
+                for term, weight in counts.items()])
+            self._adjust(conn, kind, 1)
+
+    def clear(self, conn, kind):
+        conn.execute(search_terms.delete().where(search_terms.c.kind == kind))
+        conn.execute(search_documents.delete().where(search_documents.c.kind == kind))
+
+    def remove(self, conn, kind, doc_id):
+        if conn.execute(search_terms.delete().where(and_(
+                search_terms.c.kind == kind, search_terms.c.doc_id == doc_id))).rowcount:
+            self._adjust(conn, kind, -1)
+
+    def query(self, conn, kind, terms, limit):
+        total = self.total(conn, kind)
+        scores = None
+        for term in set(terms):
+            postings = conn.execute(select([search_terms.c.doc_id, search_terms.c.weight])
+                .where(and_(search_terms.c.kind == kind, search_terms.c.term == term))).fetchall()
+            if not postings:
+                return([])
+            idf = math.log(1.0 + float(total) / len(postings))
+            found = dict((doc_id, weight * idf) for doc_id, weight in postings)
+            if scores is None:
+                scores = found
+            else:
+                scores = dict((doc_id, score + found[doc_id])
+                    for doc_id, score in scores.items() if doc_id in found)
+        ranked = sorted((scores or {}).items(), key=lambda pair: (-pair[1], pair[0]))
+        return(ranked[:limit])
+
+
+def _has_fts5(conn):
+    "Tell whether a database is SQLite with the FTS5 extension."
+    if conn.dialect.name != "sqlite":
+        return(False)
+    try:
+        conn.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS temp.search_probe USING fts5(x)"))
+        conn.execute(text("DROP TABLE temp.search_probe"))
+    except OperationalError:
+        return(False)
+    return(True)
+
+
+def _fts5_ddl(kind, columns):
+    return(DDL("CREATE VIRTUAL TABLE IF NOT EXISTS search_%s USING fts5(%s)" % (
+        kind, ", ".join(columns))))
+
+
+class FTS5Index(object):
+    "One SQLite FTS5 table per kind, keyed by object id."
+
+    name = "fts5"
+
+    def create(self, conn):
+        for kind, columns in COLUMNS.items():
+            conn.execute(_fts5_ddl(kind, columns))
+
+    def add(self, conn, kind, doc_id, values):
+        columns = COLUMNS[kind]
+        params = dict(zip(columns, [value or "" for value in values]))
+        params["doc_id"] = doc_id
+        conn.execute(text("INSERT INTO search_%s (rowid, %s) VALUES (:doc_id, %s)" % (
+            kind, ", ".join(columns), ", ".join(":" + c for c in columns))), params)
+
+    def clear(self, conn, kind):
+        conn.execute(text("DELETE FROM search_%s" % kind))
+
+    def remove(self, conn, kind, doc_id):
+        conn.execute(text("DELETE FROM search_%s WHERE rowid = :doc_id" % kind),
+            {"doc_id": doc_id})
+
+    def query(self, conn, kind, terms, limit):
+        match = " ".join('"%s"' % term for term in terms)
+        rows = conn.execute(text(
+            "SELECT rowid, bm25(search_{0}) FROM search_{0} WHERE search_{0} MATCH :match "
+            "ORDER BY bm25(search_{0}), rowid LIMIT :limit".format(kind)),
+            {"match": match, "limit": limit})
+        return([(row[0], -row[1]) for row in rows])
+
+
+for _kind, _columns in COLUMNS.items():
+    event.listen(db.metadata, "after_create", _fts5_ddl(_kind, _columns).execute_if(
+        callable_=lambda ddl, target, bind, **kw: _has_fts5(bind)))
+    event.listen(db.metadata, "after_drop",
+        DDL("DROP TABLE IF EXISTS search_%s" % _kind).execute_if(dialect="sqlite"))
+
+"The index in use, or None when search is disabled."
+_index = None
+
+
+def _choose(conn):
+    "Use FTS5 when the database supports it, otherwise the term table."
+    if _has_fts5(conn):
+        return(FTS5Index())
+    return(TermIndex())
+
+
+def refresh(conn=None, batch_size=1000):
+    """
+    Bring the index up to date with the changes recorded since it was last refreshed.
+
+    Objects changed after the revision stored in ``search_state`` are indexed again and
+    the objects deleted since then are removed; an index that has no stored revision yet
+    is built from scratch.
+
+    :param conn: a session or connection; defaults to the database session
+    :param int batch_size: the number of rows read per query
+    :returns: the number of documents indexed
+    """
+    if _index is None:
+        raise RuntimeError("search is not enabled; call situation.search.enable()")
+    if conn is None:
+        conn = db.session
+    tables = db.metadata.tables
+    latest = serialize.latest_revision(conn, tables)
+    state = search_state.c
+    since = conn.execute(select([state.revision]).where(state.name == _index.name)).scalar()
+    if since is not None and since >= latest:
+        return(0)
+    # claim the state row first, so that a concurrent refresh waits for this one
+    if since is None:
+        conn.execute(search_state.insert(), {"name": _index.name, "revision": latest})
+    else:
+        conn.execute(search_state.update().where(state.name == _index.name)
+            .values(revision=latest))
+    deleted = {}
+    if since is not None:
+        for tombstone in serialize.tombstones_since(conn, tables, since):
+            deleted.setdefault(tombstone["kind"], []).append(tombstone["key"][0])
+    indexed = 0
+    for kind, _, columns in DOCUMENTS:
+        if since is None:
+            _index.clear(conn, kind)
+        for doc_id in deleted.get(kind, ()):
+            _index.remove(conn, kind, doc_id)
+        for rows in serialize.iter_rows(conn, tables, kind, batch_size, since=since,
+                fields=columns):
+            for row in rows:
+                if since is not None:
+                    _index.remove(conn, kind, row["id"])
+                _index.add(conn, kind, row["id"], [row[c] for c in columns])
+            indexed += len(rows)
+    return(indexed)
+
+
+def enable(rebuild=False, index=None):
+    """
+    Start searching, indexing what changed since the index was last brought up to date.
+
+    :param bool rebuild: index every existing Excerpt and Resource again
+    :param index: a :class:`FTS5Index` or :class:`TermIndex`; chosen from the database by default
+    """
+    global _index
+    with db.engine.begin() as conn:
+        _index = index or _choose(conn)
+        _index.create(conn)
+        if rebuild:
+            conn.execute(search_state.delete().where(search_state.c.name == _index.name))
+        refresh(conn)
+
+
+def disable():
+    "Stop searching; the index is brought up to date when it is enabled again."
+    global _index
+    _index = None
+
+
+def search(query, kind="excerpts", limit=20):
+    """
+    Find documents containing every term of a query.
+
+    :param str query: the words to look for
+    :param str kind: "excerpts" or "resources"
+    :param int limit: the largest number of results
+    :returns: a list of (id, score) pairs, best first
+    """
+    terms = tokenize(query)
+    if not terms:
+        return([])
+    db.session.flush()
+    refresh(db.session)
+    return(_index.query(db.session, kind, terms, limit))
+
+
+def search_excerpts(query, limit=20):
+    """
+    Find excerpts and the objects they are linked to.
+
+    :param str query: the words to look for
+    :param int limit: the largest number of results
+    :returns: a list of dictionaries with the excerpt ``id``, its ``score`` and lists of linked ``persons``, ``events``, ``places``, ``items`` and ``groups`` ids
+    """
+    hits = search(query, "excerpts", limit)
+    ids = [doc_id for doc_id, _ in hits]
+    result = dict((doc_id, {"id": doc_id, "score": score}) for doc_id, score in hits)
+    for field, name, column in EXCERPT_LINKS:
+        for hit in result.values():
+            hit[field] = []
+        if not ids:
+            continue
+        table = db.metadata.tables[name]
+        for excerpt_id, other_id in db.session.execute(
+                select([table.c.excerpt_id, table.c[column]])
+                .where(table.c.excerpt_id.in_(ids)).order_by(table.c.id)):
+            result[excerpt_id][field].append(other_id)
+    return([result[doc_id] for doc_id in ids])
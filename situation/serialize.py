@@ -0,0 +1,484 @@
+# -*- coding: utf-8 -*-
+# situation (c) Ian Dennis Miller
+
+"""
+Bulk serialization of a Situation.
+
+Rather than dumping one object at a time through its marshmallow schema, which
+issues a query per object for every nested relationship, each page of a
+collection is read with one query and every association table feeding that
+page is read with one more query.  The resulting dictionaries have the same
+shape as the schema output.
+
+This module depends only on SQLAlchemy Core.  Functions take an object with an
+``execute()`` method (a session or a connection) and a mapping from table names
+to ``Table`` objects, such as ``db.metadata.tables``.
+"""
+
+import json
+from datetime import datetime
+from itertools import islice
+from sqlalchemy import select, and_, or_, func
+
+
+"The collections of a Situation: (key, table, ordering columns, scalar columns), sorted by key."
+SECTIONS = (
+    ("acquaintances", "acquaintance", ("person_id", "acquainted_id"), ("isa",)),
+    ("events", "event", ("id",),
+        ("id", "unique", "name", "phone", "description", "place_id")),
+    ("excerpts", "excerpt", ("id",), ("id", "unique", "content", "resource_id", "xpath")),
+    ("groups", "group", ("id",), ("id", "unique", "name")),
+    ("items", "item", ("id",), ("id", "unique", "name", "description")),
+    ("persons", "person", ("id",), ("id", "name", "alias", "unique")),
+    ("places", "place", ("id",),
+        ("id", "unique", "name", "description", "address", "lat", "lon")),
+    ("resources", "resource", ("id",),
+        ("id", "unique", "name", "url", "publisher", "author", "description")),
+)
+
+"Nested id lists: (key, field, table, owner columns, target column)."
+LINKS = (
+    ("acquaintances", "excerpts", "acquaintance_excerpts", ("person_id", "acquainted_id"),
+        "excerpt_id"),
+    ("events", "excerpts", "events_excerpts", ("event_id",), "excerpt_id"),
+    ("events", "items", "events_items", ("event_id",), "item_id"),
+    ("events", "actors", "events_actors", ("event_id",), "actor_id"),
+    ("groups", "excerpts", "groups_excerpts", ("group_id",), "excerpt_id"),
+    ("groups", "members", "groups_members", ("group_id",), "member_id"),
+    ("items", "excerpts", "items_excerpts", ("item_id",), "excerpt_id"),
+    ("items", "owners", "items_owners", ("item_id",), "owner_id"),
+    ("persons", "excerpts", "persons_excerpts", ("person_id",), "excerpt_id"),
+    ("persons", "events", "events_actors", ("actor_id",), "event_id"),
+    ("persons", "properties", "places_owners", ("owner_id",), "place_id"),
+    ("persons", "groups", "groups_members", ("member_id",), "group_id"),
+    ("persons", "acquaintances", "acquaintance", ("person_id",), "acquainted_id"),
+    ("places", "excerpts", "places_excerpts", ("place_id",), "excerpt_id"),
+    ("places", "events", "event", ("place_id",), "id"),
+    ("places", "owners", "places_owners", ("place_id",), "owner_id"),
+)
+
+"Single nested ids: (key, field, column)."
+REFERENCES = (
+    ("acquaintances", "person", "person_id"),
+    ("acquaintances", "acquainted", "acquainted_id"),
+)
+
+"Schema fields with no relationship behind them, always empty lists: (key, field)."
+EMPTY = (
+    ("persons", "places"),
+    ("persons", "possessions"),
+)
+
+"The order in which collections are inserted so that foreign keys resolve."
+LOAD_ORDER = ("resources", "excerpts", "persons", "places", "items", "groups", "events",
+    "acquaintances")
+
+"Collections with a slug derived from the name."
+SLUGGED = ("events", "groups", "items", "persons", "places")
+
+"The longest slug, the length of the ``slug`` column."
+SLUG_LENGTH = 255
+
+"Functions rewriting rows as they are read, called as ``hook(conn, tables, table name, rows)``."
+row_hooks = []
+
+"Functions called once :func:`restore` has inserted a Situation, as ``hook(conn, tables, situation)``."
+restore_hooks = []
+
+
+def apply_row_hooks(conn, tables, name, rows):
+    """
+    Pass rows read from a table through every function in :data:`row_hooks`.
+
+    :param conn: a session or connection
+    :param dict tables: table objects by name
+    :param str name: the name of the table
+    :param list rows: dictionaries of column values, modified in place
+    """
+    for hook in row_hooks:
+        hook(conn, tables, name, rows)
+
+
+def section(key):
+    """
+    Look up the definition of a collection.
+
+    :param str key: the name of the collection, e.g. "persons"
+    :returns: a (key, table, ordering columns, scalar columns) tuple
+    """
+    for entry in SECTIONS:
+        if entry[0] == key:
+            return(entry)
+    raise KeyError(key)
+
+
+def slugify(name):
+    "Compute the slug for a name, importing python-slugify on first use."
+    from slugify import slugify as _slugify
+    return(_slugify(name))
+
+
+def unique_slug(base, taken, max_length=SLUG_LENGTH):
+    """
+    Choose a slug that is not already taken, adding a numeric suffix if needed.
+
+    The slug is truncated to ``max_length`` characters, and the base is shortened further
+    to make room for a suffix.
+
+    :param str base: the preferred slug
+    :param set taken: the slugs in use; the chosen slug is added to it
+    :param int max_length: the longest slug
+    :returns: a string
+    """
+    base = base[:max_length]
+    slug = base
+    suffix = 2
+    while slug in taken:
+        tail = "-%d" % suffix
+        slug = base[:max_length - len(tail)].rstrip("-") + tail
+        suffix += 1
+    taken.add(slug)
+    return(slug)
+
+
+def timestamp(value):
+    "Format a timestamp the way EventSchema does."
+    if value is None:
+        return(None)
+    return('%04d-%02d-%02dT%02d:%02d:%02d' % (
+        value.year, value.month, value.day, value.hour, value.minute, value.second))
+
+
+def parse_timestamp(value):
+    "Parse a timestamp formatted by :func:`timestamp`."
+    if value is None:
+        return(None)
+    return(datetime.strptime(value, '%Y-%m-%dT%H:%M:%S'))
+
+
+def after(columns, values):
+    """
+    Build a clause selecting rows that sort after a keyset position.
+
+    :param list columns: the ordering columns
+    :param list values: the values of the ordering columns in the last row seen
+    :returns: a SQLAlchemy clause
+    """
+    clause = columns[-1] > values[-1]
+    for column, value in reversed(list(zip(columns[:-1], values[:-1]))):
+        clause = or_(column > value, and_(column == value, clause))
+    return(clause)
+
+
+def field_names(key):
+    """
+    List every field of the serialized objects of a collection.
+
+    :param str key: the name of the collection
+    :returns: a list of field names
+    """
+    names = list(section(key)[3])
+    names.extend(field for owner, field, _, _, _ in LINKS if owner == key)
+    names.extend(field for owner, field, _ in REFERENCES if owner == key)
+    names.extend(field for owner, field in EMPTY if owner == key)
+    if key in SLUGGED:
+        names.append("slug")
+    if key == "events":
+        names.append("timestamp")
+    return(names)
+
+
+def select_fields(available, only=None, exclude=None):
+    """
+    Resolve a projection to the set of fields it keeps.
+
+    :param available: every field name
+    :param only: the fields to keep, or None for all of them
+    :param exclude: fields to leave out
+    :returns: a frozenset of field names, or None when every field is kept
+    """
+    available = set(available)
+    unknown = (set(only or ()) | set(exclude or ())) - available
+    if unknown:
+        raise ValueError("unknown fields: %s" % ", ".join(sorted(unknown)))
+    selected = set(only) if only is not None else set(available)
+    selected -= set(exclude or ())
+    if selected == available:
+        return(None)
+    return(frozenset(selected))
+
+
+def _links(conn, tables, key, first, last, fields=None):
+    """
+    Fetch every nested id list of a collection for owners within a range.
+
+    :param conn: a session or connection
+    :param dict tables: table objects by name
+    :param str key: the name of the collection
+    :param first: the smallest leading ordering value in the page, or None for no bound
+    :param last: the largest leading ordering value in the page, or None for no bound
+    :param fields: the fields to fetch, or None for all of them
+    :returns: a Dict mapping each field to a Dict of owner key to list of ids
+    """
+    result = {}
+    for owner, field, name, owner_columns, target in LINKS:
+        if owner != key or (fields is not None and field not in fields):
+            continue
+        table = tables[name]
+        columns = [table.c[c] for c in owner_columns]
+        query = select(columns + [table.c[target]])
+        if first is not None:
+            query = query.where(and_(columns[0] >= first, columns[0] <= last))
+        query = query.order_by(*table.primary_key.columns)
+        ids = result[field] = {}
+        width = len(columns)
+        for row in conn.execute(query):
+            row = tuple(row)
+            ids.setdefault(row[:width], []).append(row[width])
+    return(result)
+
+
+def serialize_page(conn, tables, key, rows, fields=None):
+    """
+    Serialize one page of a collection.
+
+    :param conn: a session or connection
+    :param dict tables: table objects by name
+    :param str key: the name of the collection
+    :param list rows: dictionaries of column values, as produced by :func:`iter_rows`
+    :param fields: the fields to include, from :func:`select_fields`, or None for all of them
+    :returns: a list of dictionaries shaped like the schema output
+    """
+    _, _, ordering, scalars = section(key)
+
+    def wanted(field):
+        return(fields is None or field in fields)
+
+    links = _links(conn, tables, key, rows[0][ordering[0]], rows[-1][ordering[0]], fields)
+    references = [(field, column) for owner, field, column in REFERENCES
+        if owner == key and wanted(field)]
+    scalars = [c for c in scalars if wanted(c)]
+    empty = [field for owner, field in EMPTY if owner == key and wanted(field)]
+    result = []
+    for row in rows:
+        owner = tuple(row[c] for c in ordering)
+        obj = dict((c, row[c]) for c in scalars)
+        for field, ids in links.items():
+            obj[field] = [{"id": i} for i in ids.get(owner, [])]
+        for field, column in references:
+            obj[field] = {"id": row[column]}
+        for field in empty:
+            obj[field] = []
+        if key in SLUGGED and wanted("slug"):
+            obj["slug"] = row["slug"] if row["slug"] is not None else slugify(row["name"])
+        if key == "events" and wanted("timestamp"):
+            obj["timestamp"] = timestamp(row["timestamp"])
+        result.append(obj)
+    return(result)
+
+
+def column_names(key, fields=None):
+    """
+    List the columns read for a collection.
+
+    :param str key: the name of the collection
+    :param fields: the fields that will be serialized, or None for all of them
+    :returns: a list of column names, the ordering columns first
+    """
+    _, _, ordering, scalars = section(key)
+
+    def wanted(field):
+        return(fields is None or field in fields)
+
+    names = list(ordering)
+    for name in scalars:
+        if name not in names and wanted(name):
+            names.append(name)
+    for owner, field, column in REFERENCES:
+        if owner == key and column not in names and wanted(field):
+            names.append(column)
+    if key in SLUGGED and wanted("slug"):
+        names.extend(c for c in ("name", "slug") if c not in names)
+    if key == "events" and "timestamp" not in names and wanted("timestamp"):
+        names.append("timestamp")
+    return(names)
+
+
+def iter_rows(conn, tables, key, batch_size=1000, since=None, first=None, last=None,
+        resume=None, fields=None):
+    """
+    Iterate over the rows of a collection using keyset pagination.
+
+    :param conn: a session or connection
+    :param dict tables: table objects by name
+    :param str key: the name of the collection
+    :param int batch_size: the number of rows fetched per query, or None for a single query
+    :param int since: only include rows whose revision is later than this
+    :param first: only include rows whose leading ordering column is at least this
+    :param last: only include rows whose leading ordering column is less than this
+    :param list resume: only include rows sorting after this keyset position, the ordering column values of the last row already seen
+    :param fields: read only the columns these fields need, or None for every column
+    :returns: a generator of pages, each a list of dictionaries of column values
+    """
+    _, name, ordering, _ = section(key)
+    table = tables[name]
+    names = column_names(key, fields)
+    keys = [table.c[c] for c in ordering]
+    query = select([table.c[c] for c in names]).order_by(*keys)
+    if since is not None:
+        query = query.where(table.c.revision > since)
+    if first is not None:
+        query = query.where(keys[0] >= first)
+    if last is not None:
+        query = query.where(keys[0] < last)
+    position = resume
+    while True:
+        page = query
+        if position is not None:
+            page = page.where(after(keys, position))
+        if batch_size is not None:
+            page = page.limit(batch_size)
+        rows = [dict(zip(names, row)) for row in conn.execute(page)]
+        if not rows:
+            return
+        apply_row_hooks(conn, tables, name, rows)
+        yield rows
+        if batch_size is None or len(rows) < batch_size:
+            return
+        position = [rows[-1][c] for c in ordering]
+
+
+def iter_pages(conn, tables, key, batch_size=1000, since=None, first=None, last=None,
+        fields=None):
+    """
+    Iterate over the serialized objects of a collection, a page at a time.
+
+    :param conn: a session or connection
+    :param dict tables: table objects by name
+    :param str key: the name of the collection
+    :param int batch_size: the number of objects per page, or None for a single page
+    :param int since: only include objects whose revision is later than this
+    :param first: only include objects whose leading ordering column is at least this
+    :param last: only include objects whose leading ordering column is less than this
+    :param fields: the fields to include, from :func:`select_fields`, or None for all of them
+    :returns: a generator of lists of dictionaries
+    """
+    for rows in iter_rows(conn, tables, key, batch_size, since, first, last, fields=fields):
+        yield serialize_page(conn, tables, key, rows, fields)
+
+
+def latest_revision(conn, tables):
+    """
+    Find the latest revision recorded in the database.
+
+    :param conn: a session or connection
+    :param dict tables: table objects by name
+    :returns: an int, 0 if nothing has been recorded
+    """
+    table = tables["revisions"]
+    return(conn.execute(select([func.max(table.c.id)])).scalar() or 0)
+
+
+def tombstones_since(conn, tables, since):
+    """
+    List the objects deleted after a revision.
+
+    :param conn: a session or connection
+    :param dict tables: table objects by name
+    :param int since: a revision
+    :returns: a list of dictionaries with the ``kind`` and ``key`` of each deleted object
+    """
+    table = tables["tombstones"]
+    return([{"kind": kind, "key": json.loads(key)} for kind, key in conn.execute(
+        select([table.c.kind, table.c.key]).where(table.c.revision > since).order_by(table.c.id))])
+
+
+def encode(obj, depth):
+    """
+    Encode one object exactly as ``json.dump(..., indent=True, sort_keys=True)`` would at a depth.
+
+    :param obj: the object to encode
+    :param int depth: the nesting level of the object within the document
+    :returns: a JSON string
+    """
+    return(json.dumps(obj, indent=True, sort_keys=True).replace("\n", "\n" + " " * depth))
+
+
+def iter_json(collections):
+    """
+    Frame encoded collections as one JSON document.
+
+    :param collections: (key, iterable of encoded objects) pairs, sorted by key
+    :returns: a generator of JSON strings
+    """
+    yield "{"
+    for index, (key, objs) in enumerate(collections):
+        yield "%s\n %s: " % ("," if index else "", json.dumps(key))
+        empty = True
+        for obj in objs:
+            yield "%s\n  %s" % ("[" if empty else ",", obj)
+            empty = False
+        yield "[]" if empty else "\n ]"
+    yield "\n}"
+
+
+def _insert(conn, table, rows, batch_size):
+    "Insert an iterable of rows with one executemany per batch."
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, batch_size))
+        if not chunk:
+            return
+        conn.execute(table.insert(), chunk)
+
+
+def restore(conn, tables, situation, batch_size=10000):
+    """
+    Insert a dumped Situation using bulk inserts.
+
+    Object ids are preserved.  Each association table is rebuilt from one side of its
+    relationship, since both sides describe the same rows.  Mapper events do not fire, so
+    every function in :data:`restore_hooks` is called afterwards.  The caller is
+    responsible for the transaction.
+
+    :param conn: a session or connection
+    :param dict tables: table objects by name
+    :param dict situation: a Situation as produced by ``dump()``
+    :param int batch_size: the number of rows per executemany
+    """
+    for key in LOAD_ORDER:
+        _, name, _, scalars = section(key)
+        references = [(field, column) for owner, field, column in REFERENCES if owner == key]
+        rows = []
+        slugs = set()
+        for obj in situation.get(key, []):
+            row = dict((c, obj.get(c)) for c in scalars)
+            if key in SLUGGED:
+                row["slug"] = obj.get("slug") and unique_slug(obj["slug"], slugs)
+            for field, column in references:
+                row[column] = obj[field]["id"]
+            if key == "events":
+                row["timestamp"] = parse_timestamp(obj.get("timestamp"))
+            rows.append(row)
+        _insert(conn, tables[name], rows, batch_size)
+
+    entities = set(entry[1] for entry in SECTIONS)
+    for owner, field, name, owner_columns, target in LINKS:
+        if name in entities:
+            continue
+        entities.add(name)
+        _, _, ordering, _ = section(owner)
+        rows = []
+        for obj in situation.get(owner, []):
+            if owner == "acquaintances":
+                key = (obj["person"]["id"], obj["acquainted"]["id"])
+            else:
+                key = (obj["id"],)
+            for nested in obj.get(field, []):
+                row = dict(zip(owner_columns, key))
+                row[target] = nested["id"]
+                rows.append(row)
+        _insert(conn, tables[name], rows, batch_size)
+
+    for hook in restore_hooks:
+        hook(conn, tables, situation)
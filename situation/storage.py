@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+# situation (c) Ian Dennis Miller
+
+"""
+Storage profiles: engine options and SQLite pragmas tuned for throughput.
+
+The ``default`` profile leaves SQLAlchemy and SQLite as they are.  The ``fast``
+profile keeps a pool of connections open, caches compiled statements, and
+configures each SQLite connection with a write-ahead log, ``synchronous=NORMAL``,
+a 64 MB page cache and memory-mapped reads.
+
+::
+
+    from situation.debug_app import create_app
+    app = create_app(profile="fast")
+
+While a bulk load runs, :func:`bulk` relaxes durability further: ``synchronous``
+is turned off, foreign keys are not enforced and the page cache grows.  Each
+pooled connection switches mode when it is next checked out, so enter the
+block between transactions::
+
+    db.session.commit()
+    with storage.bulk(db.engine):
+        load("situation.json")
+
+Pragmas only apply to SQLite; on other databases the engine options still apply.
+"""
+
+import weakref
+from contextlib import contextmanager
+from sqlalchemy import event, __version__ as sqlalchemy_version
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+"Engine options and connection pragmas by profile name."
+PROFILES = {
+    "default": {
+        "engine": {},
+        "pragmas": (),
+    },
+    "fast": {
+        "engine": {"pool_size": 5, "max_overflow": 10, "cached_statements": 512,
+            "query_cache_size": 1000},
+        "pragmas": (("journal_mode", "WAL"), ("synchronous", "NORMAL"), ("cache_size", -65536),
+            ("mmap_size", 268435456), ("temp_store", "MEMORY")),
+    },
+}
+
+"Pragmas applied to connections while :func:`bulk` is active."
+BULK_PRAGMAS = (("synchronous", "OFF"), ("foreign_keys", "OFF"), ("cache_size", -262144))
+
+_engines = weakref.WeakKeyDictionary()
+
+
+def _profile(name):
+    try:
+        return(PROFILES[name])
+    except KeyError:
+        raise ValueError("unknown storage profile: %s" % name)
+
+
+def engine_options(url, profile="fast"):
+    """
+    Build the ``create_engine()`` options of a profile, e.g. for ``SQLALCHEMY_ENGINE_OPTIONS``.
+
+    :param url: the database URL
+    :param str profile: the name of a profile in :data:`PROFILES`
+    :returns: a Dict of keyword arguments
+    """
+    settings = dict(_profile(profile)["engine"])
+    options = {}
+    url = make_url(url)
+    cached_statements = settings.pop("cached_statements", None)
+    query_cache_size = settings.pop("query_cache_size", None)
+    if query_cache_size is not None and tuple(int(v) for v in
+            sqlalchemy_version.split(".")[:2]) >= (1, 4):
+        options["query_cache_size"] = query_cache_size
+    if url.get_backend_name() == "sqlite":
+        if url.database in (None, "", ":memory:"):
+            return(options)
+        connect_args = {}
+        if cached_statements is not None:
+            connect_args["cached_statements"] = cached_statements
+        if settings:
+            options["poolclass"] = QueuePool
+            connect_args["check_same_thread"] = False
+        if connect_args:
+            options["connect_args"] = connect_args
+    options.update(settings)
+    return(options)
+
+
+def _pragmas(dbapi_connection, pragmas):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in pragmas:
+            cursor.execute("PRAGMA %s=%s" % (name, value))
+    finally:
+        cursor.close()
+
+
+def _read_pragmas(dbapi_connection, names):
+    cursor = dbapi_connection.cursor()
+    try:
+        values = []
+        for name in names:
+            cursor.execute("PRAGMA %s" % name)
+            values.append((name, cursor.fetchone()[0]))
+        return(tuple(values))
+    finally:
+        cursor.close()
+
+
+def _listeners(engine, state):
+    "Create the pool listeners applying a profile's pragmas to an engine's connections."
+
+    def connect(dbapi_connection, record):
+        _pragmas(dbapi_connection, _profile(state["profile"])["pragmas"])
+        record.info["storage.saved"] = None
+
+    def checkout(dbapi_connection, record, proxy):
+        saved = record.info.get("storage.saved")
+        if state["bulk"] and saved is None:
+            record.info["storage.saved"] = _read_pragmas(dbapi_connection,
+                [name for name, _ in BULK_PRAGMAS])
+            _pragmas(dbapi_connection, BULK_PRAGMAS)
+        elif not state["bulk"] and saved is not None:
+            _pragmas(dbapi_connection, saved)
+            record.info["storage.saved"] = None
+
+    return([(engine, "connect", connect), (engine, "checkout", checkout)])
+
+
+def apply(engine, profile="fast"):
+    """
+    Configure every connection of an engine with the pragmas of a profile.
+
+    Connections already open keep their settings until they are replaced; call this
+    before the engine is first used.
+
+    :param engine: a SQLAlchemy engine
+    :param str profile: the name of a profile in :data:`PROFILES`
+    """
+    _profile(profile)
+    state = _engines.get(engine)
+    if state is not None:
+        state["profile"] = profile
+        return
+    _engines[engine] = state = {"profile": profile, "bulk": 0}
+    if engine.dialect.name != "sqlite":
+        return
+    for target, name, listener in _listeners(engine, state):
+        event.listen(target, name, listener)
+
+
+def profile(engine):
+    """
+    Find the profile applied to an engine.
+
+    :param engine: a SQLAlchemy engine
+    :returns: the name of the profile, "default" if none was applied
+    """
+    return(_engines.get(engine, {"profile": "default"})["profile"])
+
+
+@contextmanager
+def bulk(engine):
+    """
+    Relax durability and foreign key checks for a bulk load.
+
+    If the profile enforces foreign keys, they are checked once the block exits and a
+    ValueError lists the tables with violations.
+
+    :param engine: a SQLAlchemy engine
+    """
+    if engine not in _engines:
+        apply(engine, "default")
+    state = _engines[engine]
+    state["bulk"] += 1
+    try:
+        yield
+    finally:
+        state["bulk"] -= 1
+    pragmas = dict(_profile(state["profile"])["pragmas"])
+    if not state["bulk"] and str(pragmas.get("foreign_keys", "")).upper() in ("ON", "1"):
+        with engine.connect() as conn:
+            violations = sorted(set(row[0] for row in conn.execute("PRAGMA foreign_key_check")))
+        if violations:
+            raise ValueError("foreign key violations in %s" % ", ".join(violations))
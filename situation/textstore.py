@@ -0,0 +1,466 @@
+# -*- coding: utf-8 -*-
+# situation (c) Ian Dennis Miller
+
+"""
+Content-addressed, compressed storage for long text.
+
+Excerpt content and the descriptions of Resources, Places, Items and Events
+can be long, and the same passage is often quoted many times.  While the store
+is enabled, every such value of at least ``min_size`` characters is written
+once to the ``text_blobs`` table, compressed and keyed by its SHA-256 hash,
+and the column holds a short reference instead.
+
+The settings are kept in the ``text_settings`` table, so the store is enabled
+for the database rather than for one process.  :func:`enable` installs an
+event on the application's engine that rewrites the values of every insert and
+update to the stored tables, including the bulk inserts of
+:func:`situation.load`; other processes writing to the same database call
+:func:`attach`, as :func:`situation.debug_app.create_app` does.
+
+::
+
+    from situation import textstore
+    textstore.enable(pack_existing=True)
+
+Reading needs no setup: whenever this module is imported, which
+:mod:`situation.models` and :mod:`situation.core` do, a row hook in
+:mod:`situation.serialize` resolves references for :func:`situation.dump`,
+:func:`situation.save` and the other bulk readers, and mapper events resolve
+them when objects are loaded.  Values that are not references cost a prefix
+check.
+
+Queries compare against references too: on an engine the store is installed
+on, ``==``, ``!=``, ``in_()`` and ``notin_()`` on a stored column also match
+the reference of a long value, so ``Excerpt.find(content=text)`` keeps
+working.  Pattern matches such as ``like()``, ``contains()`` and
+``startswith()`` cannot see inside a blob and raise ValueError instead of
+silently missing long values; call :func:`unpack` and :func:`disable` before
+relying on them.
+
+Compression uses zlib, or zstd when ``codec="zstd"`` and the zstandard package
+is installed.  Blobs are never modified, so decompressed bodies are cached.
+Blobs that no column refers to any more are removed by :func:`collect`.
+"""
+
+import hashlib
+import threading
+import zlib
+from collections import OrderedDict
+from sqlalchemy import (Column, Integer, LargeBinary, MetaData, String, Table, and_, bindparam,
+    event, func, or_, select, union)
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.sql import operators, visitors
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter
+from sqlalchemy.sql.expression import Delete, Insert, Select, Update
+
+from . import serialize
+
+"The columns whose long values are stored as blobs: (table, column)."
+TEXT_COLUMNS = (
+    ("event", "description"),
+    ("excerpt", "content"),
+    ("item", "description"),
+    ("place", "description"),
+    ("resource", "description"),
+)
+
+"The start of every reference; the SHA-256 hash follows."
+PREFIX = u"\x1esha256:"
+
+"The tables of the store, created by :func:`enable` rather than ``db.create_all()``."
+metadata = MetaData()
+
+text_blobs = Table('text_blobs', metadata,
+    Column('hash', String(64), primary_key=True),
+    Column('codec', String(8), nullable=False),
+    Column('size', Integer, nullable=False),
+    Column('data', LargeBinary, nullable=False),
+)
+
+"A single row holding the settings while the store is enabled."
+text_settings = Table('text_settings', metadata,
+    Column('min_size', Integer, nullable=False),
+    Column('codec', String(8), nullable=False),
+)
+
+"The columns stored as blobs, by table."
+_columns = {}
+for _table, _column in TEXT_COLUMNS:
+    _columns.setdefault(_table, []).append(_column)
+
+"Operators that match part of a value, which a reference cannot do."
+_PATTERNS = frozenset(getattr(operators, name) for name in ("like_op", "notlike_op",
+    "ilike_op", "notilike_op", "contains_op", "notcontains_op", "startswith_op",
+    "notstartswith_op", "endswith_op", "notendswith_op", "match_op", "notmatch_op")
+    if hasattr(operators, name))
+
+_settings = {"min_size": 256, "codec": "zlib"}
+"The (target, event, listener) of every listener installed on an engine."
+_installed = []
+_cache = OrderedDict()
+_cache_size = 1024
+_lock = threading.Lock()
+
+
+def _codec(name):
+    "Find the (compress, decompress) functions of a codec."
+    if name == "zstd":
+        import zstandard
+        return(zstandard.ZstdCompressor().compress, zstandard.ZstdDecompressor().decompress)
+    return(zlib.compress, zlib.decompress)
+
+
+def is_reference(value):
+    "Tell whether a column value is a reference to a blob."
+    return(isinstance(value, type(PREFIX)) and value.startswith(PREFIX))
+
+
+def reference(text):
+    """
+    Compute the reference of a text.
+
+    :param str text: the text
+    :returns: a string
+    """
+    return(PREFIX + hashlib.sha256(text.encode("utf-8")).hexdigest())
+
+
+def _remember(digest, text):
+    with _lock:
+        _cache[digest] = text
+        while len(_cache) > _cache_size:
+            _cache.popitem(last=False)
+
+
+def _insert_missing(conn):
+    "Build an insert into the store that skips hashes another writer stored first."
+    bind = conn if hasattr(conn, "dialect") else conn.get_bind(None, text_blobs)
+    if bind.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+        return(insert(text_blobs).on_conflict_do_nothing(index_elements=["hash"]))
+    return(text_blobs.insert().prefix_with("OR IGNORE", dialect="sqlite")
+        .prefix_with("IGNORE", dialect="mysql"))
+
+
+def _store(conn, texts):
+    "Write the blobs of texts keyed by hash that are not stored yet."
+    if not texts:
+        return
+    stored = set(row[0] for row in conn.execute(
+        select([text_blobs.c.hash]).where(text_blobs.c.hash.in_(list(texts)))))
+    compress = _codec(_settings["codec"])[0]
+    rows = [{"hash": digest, "codec": _settings["codec"], "size": len(text),
+        "data": compress(text.encode("utf-8"))}
+        for digest, text in texts.items() if digest not in stored]
+    if rows:
+        conn.execute(_insert_missing(conn), rows)
+
+
+def fetch(conn, references):
+    """
+    Resolve references to their text.
+
+    :param conn: a session or connection
+    :param references: references from :func:`reference`
+    :returns: a Dict mapping each reference to its text
+    """
+    result = {}
+    missing = set()
+    with _lock:
+        for ref in references:
+            digest = ref[len(PREFIX):]
+            if digest in _cache:
+                result[ref] = _cache[digest]
+            else:
+                missing.add(digest)
+    if missing:
+        for digest, codec, data in conn.execute(select([text_blobs.c.hash, text_blobs.c.codec,
+                text_blobs.c.data]).where(text_blobs.c.hash.in_(list(missing)))):
+            text = _codec(codec)[1](data).decode("utf-8")
+            _remember(digest, text)
+            result[PREFIX + digest] = text
+    return(result)
+
+
+def _pack_rows(rows, columns, texts):
+    "Replace long values with references, collecting the texts to store."
+    packed = []
+    for row in rows:
+        changes = {}
+        for column in columns:
+            value = row.get(column)
+            if _is_long(value):
+                ref = reference(value)
+                texts[ref[len(PREFIX):]] = value
+                changes[column] = ref
+        if changes:
+            row = dict(row)
+            row.update(changes)
+        packed.append(row)
+    return(packed)
+
+
+def _is_long(value):
+    return(isinstance(value, type(u"")) and len(value) >= _settings["min_size"] and
+        not is_reference(value))
+
+
+def _stored_column(element):
+    "Tell whether an expression is one of the columns stored as blobs."
+    table = getattr(element, "table", None)
+    table = getattr(table, "original", table)
+    return(getattr(element, "name", None) in _columns.get(getattr(table, "name", None), ()))
+
+
+def _rewrite(element):
+    "Make a comparison with a stored column match the references of long values."
+    if not isinstance(element, BinaryExpression) or not _stored_column(element.left):
+        return(None)
+    values = []
+    for bind in visitors.iterate(element.right, {}):
+        if isinstance(bind, BindParameter):
+            value = bind.effective_value
+            values.extend(value if isinstance(value, (list, tuple)) else [value])
+    if element.operator in _PATTERNS:
+        if all(is_reference(value) for value in values):
+            return(None)
+        raise ValueError("%s is stored as blobs by situation.textstore and cannot be "
+            "matched by pattern; compare whole values or unpack the store first" % element.left)
+    refs = [reference(value) for value in values if _is_long(value)]
+    if not refs:
+        return(None)
+    if element.operator in (operators.eq, operators.in_op):
+        return(or_(element, element.left.in_(refs)))
+    if element.operator in (operators.ne, operators.notin_op):
+        return(and_(element, element.left.notin_(refs)))
+    return(None)
+
+
+def _stored_tables(element):
+    "Tell whether a statement or selectable reads or writes a table with stored columns."
+    element = getattr(element, "original", element)
+    if isinstance(element, Select):
+        return(any(_stored_tables(table) for table in element.locate_all_froms()))
+    if hasattr(element, "selects"):
+        return(any(_stored_tables(select) for select in element.selects))
+    table = getattr(element, "table", element)
+    return(getattr(table, "name", None) in _columns)
+
+
+def _before_execute(conn, clauseelement, multiparams, params, *args):
+    "Store long values of inserts and updates as blobs and write references instead."
+    if not isinstance(clauseelement, (Select, Insert, Update, Delete)) or \
+            not _stored_tables(clauseelement):
+        return(clauseelement, multiparams, params)
+    if isinstance(clauseelement, (Select, Update, Delete)) and any(
+            isinstance(element, BinaryExpression) and _stored_column(element.left)
+            for element in visitors.iterate(clauseelement, {})):
+        clauseelement = visitors.replacement_traverse(clauseelement, {}, _rewrite)
+    if not isinstance(clauseelement, (Insert, Update)):
+        return(clauseelement, multiparams, params)
+    columns = _columns[clauseelement.table.name]
+    texts = {}
+    if multiparams and isinstance(multiparams[0], (list, tuple)) and multiparams[0] and \
+            isinstance(multiparams[0][0], dict):
+        multiparams = (_pack_rows(multiparams[0], columns, texts),) + tuple(multiparams[1:])
+    elif multiparams and isinstance(multiparams[0], dict):
+        multiparams = tuple(_pack_rows(multiparams, columns, texts))
+    elif params:
+        params = _pack_rows([params], columns, texts)[0]
+    _store(conn, texts)
+    return(clauseelement, multiparams, params)
+
+
+def _resolve_rows(conn, tables, name, rows):
+    "Resolve the references in rows read by the bulk readers."
+    columns = [c for c in _columns.get(name, ()) if rows and c in rows[0]]
+    refs = set(row[c] for row in rows for c in columns if is_reference(row[c]))
+    if not refs:
+        return
+    texts = fetch(conn, refs)
+    for row in rows:
+        for column in columns:
+            if is_reference(row[column]):
+                row[column] = texts.get(row[column])
+
+
+def _loader(columns):
+    "Create the mapper listener resolving the references of loaded objects."
+
+    def resolve(target, context, attrs=None):
+        values = target.__dict__
+        refs = [values[c] for c in columns if is_reference(values.get(c))]
+        if not refs:
+            return
+        texts = fetch(context.session, refs)
+        for column in columns:
+            if is_reference(values.get(column)):
+                set_committed_value(target, column, texts.get(values[column]))
+
+    return(resolve)
+
+
+def watch(model):
+    """
+    Resolve the references of a model's objects when they are loaded or refreshed.
+
+    :mod:`situation.models` calls it for every model with a stored column.
+
+    :param model: a model class
+    """
+    resolve = _loader(_columns[model.__table__.name])
+    for name in ("load", "refresh"):
+        event.listen(model, name, resolve)
+
+
+def _tables(conn, tables):
+    "Default to the tables and session of the application."
+    from . import db
+    if tables is None:
+        tables = db.metadata.tables
+    return(conn if conn is not None else db.session, tables)
+
+
+def pack(conn=None, tables=None):
+    """
+    Move the long values already in the database into the store.
+
+    :param conn: a session or connection; defaults to the database session, which is committed
+    :param dict tables: table objects by name; defaults to the tables of the models
+    """
+    commit = conn is None
+    conn, tables = _tables(conn, tables)
+    for name, columns in sorted(_columns.items()):
+        table = tables[name]
+        for column in columns:
+            rows = conn.execute(select([table.c.id, table.c[column]]).where(
+                func.length(table.c[column]) >= _settings["min_size"])).fetchall()
+            texts = {}
+            updates = [{"row_id": row_id, "packed": value} for row_id, value in
+                ((r[0], _pack_rows([{column: r[1]}], [column], texts)[0][column]) for r in rows)]
+            _store(conn, texts)
+            if updates:
+                conn.execute(table.update().where(table.c.id == bindparam("row_id"))
+                    .values({column: bindparam("packed")}), updates)
+    if commit:
+        conn.commit()
+
+
+def unpack(conn=None, tables=None):
+    """
+    Write the text of every reference back into its column.
+
+    :param conn: a session or connection; defaults to the database session, which is committed
+    :param dict tables: table objects by name; defaults to the tables of the models
+    """
+    commit = conn is None
+    conn, tables = _tables(conn, tables)
+    for name, columns in sorted(_columns.items()):
+        table = tables[name]
+        for column in columns:
+            rows = conn.execute(select([table.c.id, table.c[column]]).where(
+                table.c[column].like(PREFIX + "%"))).fetchall()
+            texts = fetch(conn, set(r[1] for r in rows))
+            if rows:
+                conn.execute(table.update().where(table.c.id == bindparam("row_id"))
+                    .values({column: bindparam("unpacked")}),
+                    [{"row_id": r[0], "unpacked": texts.get(r[1])} for r in rows])
+    if commit:
+        conn.commit()
+
+
+def collect(conn=None, tables=None):
+    """
+    Delete the blobs that no column refers to any more.
+
+    Run it while nothing else writes to the database: a row inserted meanwhile may refer
+    to a blob that is being deleted.
+
+    :param conn: a session or connection; defaults to the database session, which is committed
+    :param dict tables: table objects by name; defaults to the tables of the models
+    :returns: the number of blobs deleted
+    """
+    commit = conn is None
+    conn, tables = _tables(conn, tables)
+    referenced = union(*[select([func.substr(tables[name].c[column],
+        len(PREFIX) + 1)]).where(tables[name].c[column].like(PREFIX + "%"))
+        for name, column in TEXT_COLUMNS])
+    deleted = conn.execute(text_blobs.delete().where(text_blobs.c.hash.notin_(referenced)))
+    if commit:
+        conn.commit()
+    return(deleted.rowcount)
+
+
+def _install(engine, min_size, codec):
+    "Store long text written through an engine."
+    _codec(codec)
+    _uninstall()
+    _settings.update(min_size=min_size, codec=codec)
+    event.listen(engine, "before_execute", _before_execute, retval=True)
+    _installed.append((engine, "before_execute", _before_execute))
+
+
+def _uninstall():
+    while _installed:
+        event.remove(*_installed.pop())
+
+
+def _stored_settings(conn):
+    "Read the settings of the store, or None when it is not enabled for the database."
+    if not conn.dialect.has_table(conn, text_settings.name):
+        return(None)
+    return(conn.execute(select([text_settings.c.min_size, text_settings.c.codec])).first())
+
+
+def attach(engine):
+    """
+    Store long text written through an engine when its database has the store enabled.
+
+    Call it once in every process that writes to a database on which another process
+    called :func:`enable`; reading needs no setup.
+
+    :param engine: the engine of the database
+    :returns: True when the store is enabled for the database
+    """
+    with engine.connect() as conn:
+        settings = _stored_settings(conn)
+    if settings is None:
+        return(False)
+    _install(engine, settings[0], settings[1])
+    return(True)
+
+
+def enable(min_size=256, codec="zlib", pack_existing=False):
+    """
+    Start storing long text as blobs, in this process and in those that call :func:`attach`.
+
+    :param int min_size: the shortest value, in characters, that is stored as a blob
+    :param str codec: "zlib", or "zstd" to use the zstandard package
+    :param bool pack_existing: move the long values already in the database into the store
+    """
+    from . import db
+    _codec(codec)
+    metadata.create_all(bind=db.engine, checkfirst=True)
+    with db.engine.begin() as conn:
+        conn.execute(text_settings.delete())
+        conn.execute(text_settings.insert(), {"min_size": min_size, "codec": codec})
+    _install(db.engine, min_size, codec)
+    if pack_existing:
+        pack()
+
+
+def disable():
+    """
+    Stop storing long text as blobs.
+
+    Values already stored stay references and are still resolved when read; call
+    :func:`unpack` first to restore them.
+    """
+    from . import db
+    _uninstall()
+    with db.engine.begin() as conn:
+        if _stored_settings(conn) is not None:
+            conn.execute(text_settings.delete())
+
+
+serialize.row_hooks.append(_resolve_rows)
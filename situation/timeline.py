@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# situation (c) Ian Dennis Miller
+
+"""
+Sorted, in-memory timelines of Events.
+
+A :class:`Timeline` holds event timestamps and ids in two parallel arrays sorted
+by time, so that range queries are two binary searches and bucketed counts are a
+single pass.  Timelines are read through the index on ``event.timestamp``.
+"""
+
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from sqlalchemy import select, and_
+
+EPOCH = datetime(1970, 1, 1)
+
+"Functions mapping a timestamp to the start of its bucket."
+BUCKETS = {
+    "hour": lambda t: t.replace(minute=0, second=0, microsecond=0),
+    "day": lambda t: datetime(t.year, t.month, t.day),
+    "week": lambda t: datetime(t.year, t.month, t.day) - timedelta(days=t.weekday()),
+    "month": lambda t: datetime(t.year, t.month, 1),
+    "year": lambda t: datetime(t.year, 1, 1),
+}
+
+
+def _seconds(value):
+    "Convert a naive datetime to seconds since the epoch."
+    return((value - EPOCH).total_seconds())
+
+
+class Timeline(object):
+    """
+    Events sorted by timestamp.
+
+    :param array seconds: sorted timestamps, as seconds since the epoch
+    :param array ids: the event id at each position
+    """
+
+    def __init__(self, seconds, ids):
+        self.seconds = seconds
+        self.ids = ids
+
+    @classmethod
+    def load(cls, person_id=None, place_id=None, start=None, end=None, conn=None, tables=None):
+        """
+        Read a timeline from the database.
+
+        Events without a timestamp are left out.
+
+        :param int person_id: only include events with this actor
+        :param int place_id: only include events at this place
+        :param datetime start: only include events at or after this time
+        :param datetime end: only include events before this time
+        :param conn: a session or connection; defaults to the database session
+        :param dict tables: table objects by name; defaults to the model tables
+        :returns: a Timeline
+        """
+        if conn is None:
+            from . import db
+            conn = db.session
+            tables = db.metadata.tables
+        event = tables["event"]
+        query = select([event.c.timestamp, event.c.id]).where(event.c.timestamp.isnot(None))
+        if person_id is not None:
+            actors = tables["events_actors"]
+            query = query.where(and_(actors.c.event_id == event.c.id,
+                actors.c.actor_id == person_id))
+        if place_id is not None:
+            query = query.where(event.c.place_id == place_id)
+        if start is not None:
+            query = query.where(event.c.timestamp >= start)
+        if end is not None:
+            query = query.where(event.c.timestamp < end)
+        seconds, ids = array('d'), array('l')
+        for timestamp, event_id in conn.execute(query.order_by(event.c.timestamp, event.c.id)):
+            seconds.append(_seconds(timestamp))
+            ids.append(event_id)
+        return(cls(seconds, ids))
+
+    def __len__(self):
+        return(len(self.ids))
+
+    def between(self, start, end):
+        """
+        Find the events in a time range.
+
+        :param datetime start: the inclusive start of the range
+        :param datetime end: the exclusive end of the range
+        :returns: a list of event ids in time order
+        """
+        first = bisect_left(self.seconds, _seconds(start))
+        last = bisect_left(self.seconds, _seconds(end))
+        return(list(self.ids[first:last]))
+
+    def counts(self, bucket="day"):
+        """
+        Count the events in each time bucket.
+
+        :param str bucket: one of "hour", "day", "week", "month" or "year"
+        :returns: a list of (bucket start, count) pairs in time order, omitting empty buckets
+        """
+        floor = BUCKETS[bucket]
+        result = []
+        for value in self.seconds:
+            start = floor(EPOCH + timedelta(seconds=value))
+            if result and result[-1][0] == start:
+                result[-1][1] += 1
+            else:
+                result.append([start, 1])
+        return([(start, count) for start, count in result])